@@ -6,19 +6,34 @@ Although defining IncomingInterface is optional, the interface methods are neede
 import AlteryxPythonSDK as Sdk
 import xml.etree.ElementTree as Et
 import cleaner
+import writer
+import uploader
+import metrics
+import compressor
+import session
+import keyrange
+import dedup
+import manifest
+import stats
+import sorter
+import warehouse
 import time
-import csv
 import os
-import glob
-import gzip
-import multiprocessing
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
-import snowflake.connector
+import re
+import sys
+import threading
+import uuid
+import json
 import logging
 
 VERSION = '1.8'
 
+# column holding the row hash used to detect changed rows on update
+HASH_COLUMN = 'ROW_HASH'
+
+# the connector binds more values than this (CLIENT_STAGE_ARRAY_BINDING_THRESHOLD) through a temporary stage, the round trip direct inserts avoid
+DIRECT_MAX_VALUES = 65280
+
 
 class AyxPlugin:
     """
@@ -50,12 +65,45 @@ class AyxPlugin:
         self.sql_type: str = None
         self.temp_dir: str = None
         self.key: str = None
+        self.keys: list = []
         self.case_sensitive: bool = False
         self.suspend_wh: bool = False
         self.delete_tempfiles: bool = False
+        self.staging_format: str = 'csv'
+        self.target_file_mb: float = 150
+        self.buffer_mb: float = 100
+        self.compression: str = None
+        self.compression_level: int = None
+        self.writer_processes: int = 0
+        self.change_detection: bool = False
+        self.store_hash: bool = False
+        self.prune_merge: bool = False
+        self.dedup: str = None
+        self.resume: bool = False
+        self.column_stats: bool = False
+        self.in_memory: bool = False
+        self.staging_memory_mb: float = 600
+        self.direct_max_rows: float = 1000
+        self.direct_max_mb: float = 1
+        self.upsize_wh: bool = False
+        self.max_wh_size: str = None
+        self.sort_keys: list = []
+        self.profile: str = None
+        self.profiler = None
+        self.load_mode: str = None
 
         self.is_initialized: bool = True
-        self.single_input = None
+        self.inputs: list = []
+
+        # The inputs share one session, opened by whichever input's upload thread connects first
+        self.con: 'snowflake.connector.connection' = None
+        self.session_lock = threading.Lock()
+
+        # and take turns on the upload slots, so many inputs do not all PUT at once
+        self.upload_slots = threading.BoundedSemaphore(4)
+
+        # and scale the warehouse up once for their COPY and MERGE, if selected
+        self.warehouse_sizer: warehouse.WarehouseSizer = None
 
         # Alteryx to Snowfake data type mappings
         self.var_type: dict = {}
@@ -98,14 +146,38 @@ class AyxPlugin:
         self.okta_url = root.find('okta_url').text if 'okta_url' in str_xml else None
         self.temp_dir = root.find('temp_dir').text  if 'temp_dir' in str_xml else None
         self.sql_type = root.find('sql_type').text  if 'sql_type' in str_xml else None
-        self.key = root.find('key').text if 'key' in str_xml else None
+        self.key = root.findtext('key')
         self.case_sensitive = root.find('case_sensitive').text == 'True' if 'case_sensitive' in str_xml else False
         self.suspend_wh = root.find('supend_wh').text == 'True' if 'supend_wh' in str_xml else False
         self.delete_tempfiles = root.find('delete_tempfiles').text == 'True' if 'delete_tempfiles' in str_xml else False
+        self.change_detection = root.find('change_detection').text == 'True' if 'change_detection' in str_xml else False
+        self.store_hash = root.find('store_hash').text == 'True' if 'store_hash' in str_xml else False
+        self.prune_merge = root.findtext('prune_merge') == 'True'
+        self.dedup = cleaner.sanitise_inputs(root.findtext('dedup'))
+        self.resume = root.findtext('resume') == 'True'
+        self.column_stats = root.findtext('column_stats') == 'True'
+        self.in_memory = root.findtext('in_memory') == 'True'
+        self.staging_memory_mb = cleaner.sanitise_number(root.findtext('staging_memory_mb'), 600)
+        self.direct_max_rows = cleaner.sanitise_number(root.findtext('direct_max_rows'), 1000, allow_zero=True)
+        self.direct_max_mb = cleaner.sanitise_number(root.findtext('direct_max_mb'), 1, allow_zero=True)
+        self.upsize_wh = root.findtext('upsize_wh') == 'True'
+        self.max_wh_size = cleaner.sanitise_inputs(root.findtext('max_wh_size')) or 'X-Large'
+        self.profile = cleaner.sanitise_inputs(root.findtext('profile'))
+        self.load_mode = cleaner.sanitise_inputs(root.findtext('load_mode'))
+        self.staging_format = (root.find('staging_format').text or 'csv') if 'staging_format' in str_xml else 'csv'
+        self.target_file_mb = cleaner.sanitise_number(root.find('target_file_mb').text if 'target_file_mb' in str_xml else None, 150)
+        self.buffer_mb = cleaner.sanitise_number(root.find('buffer_mb').text if 'buffer_mb' in str_xml else None, 100)
+        # blank uses the default of the staging format, gzip for CSV and snappy for Parquet
+        self.compression = cleaner.sanitise_inputs(root.findtext('compression')) or ('snappy' if self.staging_format == 'parquet' else 'gzip')
+        self.compression_level = cleaner.sanitise_number(root.findtext('compression_level'), 0)
+        self.writer_processes = cleaner.sanitise_number(root.findtext('writer_processes'), 0, allow_zero=True)
 
         # fix for listrunner sending line feeds and spaces
         self.okta_url = cleaner.sanitise_inputs(self.okta_url)
         self.key = cleaner.sanitise_inputs(self.key)
+        # composite keys add further comma separated fields to the selected one
+        self.keys = [key.strip() for key in f"{self.key or ''},{root.findtext('key_extra') or ''}".split(',') if key.strip()]
+        self.sort_keys = [key.strip() for key in (root.findtext('sort_keys') or '').split(',') if key.strip()]
         self.temp_dir = cleaner.sanitise_inputs(self.temp_dir)
             
         # check for okta url is using okta
@@ -117,11 +189,88 @@ class AyxPlugin:
                 self.display_error_msg(f"Supplied Okta URL is not valid")
                 return False        
 
+        # Check target file size
+        if self.target_file_mb is None:
+            self.display_error_msg(f"Enter a valid target file size in MB")
+            return False
+
+        # Check buffer memory
+        if self.buffer_mb is None:
+            self.display_error_msg(f"Enter a valid buffer memory limit in MB")
+            return False
+
+        # Check the direct insert thresholds, 0 always stages the records
+        if self.direct_max_rows is None or self.direct_max_mb is None:
+            self.display_error_msg(f"Enter a valid number of records and MB to insert small inputs directly")
+            return False
+
+        # Check the memory for staging files, files kept in memory cannot be resumed from
+        if self.in_memory and not self.staging_memory_mb:
+            self.display_error_msg(f"Enter a valid staging memory limit in MB")
+            return False
+        if self.in_memory and self.resume:
+            self.display_error_msg(f"Resuming a failed run needs its staging files on disk, clear one of the two options")
+            return False
+
+        # Check the largest warehouse size to scale up to
+        if self.upsize_wh:
+            if warehouse.size_index(self.max_wh_size) is None:
+                self.display_error_msg(f"Enter a valid warehouse size to scale up to, e.g. Large or X-Large")
+                return False
+            self.warehouse_sizer = warehouse.WarehouseSizer(self.warehouse, warehouse.size_index(self.max_wh_size))
+
+        # Check compression, a blank level uses the codec default
+        format_codecs = compressor.parquet_codecs if self.staging_format == 'parquet' else tuple(compressor.codecs)
+        if self.compression not in format_codecs:
+            self.display_error_msg(f"{self.compression} compression is not available for {'Parquet' if self.staging_format == 'parquet' else 'CSV'} staging, "
+                                   f"select {', '.join(format_codecs[:-1])} or {format_codecs[-1]}")
+            return False
+        low, high = compressor.levels.get(self.compression, (None, None))
+        if self.compression_level is None or (self.compression_level and low is not None and
+                                              (self.compression_level != int(self.compression_level) or not low <= self.compression_level <= high)):
+            self.display_error_msg(f"Enter a compression level between {low} and {high} for {self.compression}" if low is not None else "Enter a valid compression level")
+            return False
+        self.compression_level = int(self.compression_level) if self.compression_level and low is not None else None
+
+        # Check the writer processes, 0 writes the files on a thread of the Alteryx process
+        if self.writer_processes is None or self.writer_processes != int(self.writer_processes):
+            self.display_error_msg(f"Enter a valid number of writer processes, 0 to write the files in the Alteryx process")
+            return False
+        self.writer_processes = int(self.writer_processes)
+        if self.writer_processes and self.staging_format == 'parquet':
+            self.display_error_msg(f"Writer processes stage CSV files only, set them to 0 to stage Parquet")
+            return False
+        if self.writer_processes and self.in_memory:
+            self.display_error_msg(f"Writer processes write their files to disk, clear one of the two options")
+            return False
+        if self.writer_processes and self.sort_keys:
+            self.display_error_msg(f"Sorted records are staged by a single writer so each file covers a narrow range, clear one of the two options")
+            return False
+
         # Check key is selected
-        if self.sql_type == 'update' and not self.key:
+        if self.sql_type == 'update' and not self.keys:
             self.display_error_msg(f"Please select a valid update key")
             return False
 
+        # Check which duplicate to keep
+        if self.dedup not in (None, 'first', 'last'):
+            self.display_error_msg(f"Select whether to keep the first or last record of a duplicated key")
+            return False
+
+        # Check how the load waits for Snowflake
+        if self.load_mode not in (None, 'async', 'detached'):
+            self.display_error_msg(f"Select whether to wait for the load, overlap its statements or detach from it")
+            return False
+        # a detached load is still running when the tool finishes, so the warehouse could only be restored under it
+        if self.load_mode == 'detached' and self.upsize_wh:
+            self.display_error_msg(f"A detached load runs on the warehouse as it is, clear scaling the warehouse up or wait for the load")
+            return False
+
+        # Check how the run is profiled
+        if self.profile not in (None, 'sample', 'trace'):
+            self.display_error_msg(f"Select sampling or tracing to profile the run")
+            return False
+
         # data checks
         for item in self.input_list:
             attr = getattr(AyxPlugin, item, None)
@@ -160,8 +309,19 @@ class AyxPlugin:
         :return: The IncomingInterface object.
         """
 
-        self.single_input = IncomingInterface(self)
-        return self.single_input
+        # A wire named by the workflow author loads the table of that name, unnamed wires (#1, #2...) the configured table
+        table = str_name if str_name and not str_name.startswith('#') else None
+        incoming = IncomingInterface(self, table)
+        self.inputs.append(incoming)
+        return incoming
+
+    @property
+    def shared(self) -> bool:
+        """
+        True if several inputs are loaded alongside each other over a shared session.
+        """
+
+        return len(self.inputs) > 1
 
     def pi_add_outgoing_connection(self, str_name: str) -> bool:
         """
@@ -188,7 +348,39 @@ class AyxPlugin:
         :param b_has_errors: Set to true to not do the final processing.
         """
 
-        pass
+        if self.profiler:
+            self.write_profile()
+
+    def start_profiler(self, folder: str):
+        """
+        A non-interface, helper function that starts profiling the run if selected, once the first input has created its run folder.
+        :param folder: The folder of the run's log, which the profile is written next to.
+        """
+
+        if self.profile and self.profiler is None:
+            # only imported when selected, a run without profiling pays nothing for it
+            import profiler
+            self.profiler = profiler.RunProfiler(self.profile, folder)
+            self.profiler.start()
+
+    def write_profile(self):
+        """
+        A non-interface, helper function that stops profiling and writes the profile next to the run's log.
+        """
+
+        self.profiler.stop()
+        try:
+            paths, busiest = self.profiler.write()
+        except OSError as e:
+            logging.warning(f'Unable to write the profile: {e}')
+            self.display_info(f'Unable to write the profile to {self.profiler.folder}: {e}')
+            return
+        finally:
+            self.profiler = None
+        if busiest:
+            self.display_info('Most time spent in ' + ', '.join(f'{label} ({share:.0%})' for label, share in busiest))
+        for path in paths:
+            self.display_file(f"{path} | {path} profile file is created")
 
     def display_error_msg(self, msg_string: str):
         self.alteryx_engine.output_message(self.n_tool_id, Sdk.EngineMessageType.error, msg_string)
@@ -201,17 +393,103 @@ class AyxPlugin:
         self.alteryx_engine.output_message(self.n_tool_id, Sdk.Status.file_output, msg_string)
 
     @staticmethod
-    def write_lists_to_csv(file_path: str, field_lists: list):
+    def error_str(e: Exception) -> str:
         """
-        A non-interface, helper function that handles writing to csv and clearing the list elements.
-        :param file_path: The file path and file name input by user.
-        :param field_lists: The data for all fields.
+        A non-interface, helper function that formats an error for display, including the Snowflake error details if present.
+        :param e: The exception raised.
+        :return: The error message.
+        """
+
+        if hasattr(e, 'sqlstate'):
+            return f'Error {e.errno} ({e.sqlstate}): {e.msg} ({e.sfqid})'
+        return f'Error: {e}'
+
+    def connect(self) -> 'snowflake.connector.connection':
+        """
+        A non-interface, helper function that opens a Snowflake connection using the selected authentication type.
+        :return: The Snowflake connection.
+        """
+
+        # the connector pulls in a large dependency tree, so it is only loaded once a run uploads
+        import snowflake.connector
+        if self.auth_type == 'snowflake':
+            con = snowflake.connector.connect(
+                                            user=self.user,
+                                            password=self.password,
+                                            account=self.account,
+                                            warehouse=self.warehouse,
+                                            database=self.database,
+                                            schema=self.schema,
+                                            paramstyle='qmark',
+                                            ocsp_fail_open=True
+                                            )
+        else:
+            con = snowflake.connector.connect(
+                                            user=self.user,
+                                            password=self.password,
+                                            authenticator=self.okta_url,
+                                            account=self.account,
+                                            warehouse=self.warehouse,
+                                            database=self.database,
+                                            schema=self.schema,
+                                            paramstyle='qmark',
+                                            ocsp_fail_open=True
+                                            )
+        logging.info(f'Authenticated via {"Snowflake" if self.auth_type == "snowflake" else "Okta"}')
+        return con
+
+    def shared_session(self, incoming: object) -> 'snowflake.connector.connection':
+        """
+        A non-interface, helper function that opens the session shared by the inputs, or returns it once it is open.
+        Called from the upload thread of each input.
+        :param incoming: The IncomingInterface asking for the session.
+        :return: The Snowflake connection.
+        """
+
+        with self.session_lock:
+            if self.con is None:
+                self.con = incoming.open_session()
+            else:
+                incoming.session_reused = True
+            return self.con
+
+    def input_closed(self):
         """
+        A non-interface, helper function that waits for the loads of every input once the last one has closed,
+        then suspends the warehouse and hands back the shared session.
+        """
+
+        if not all(incoming.closed for incoming in self.inputs):
+            return
+        for incoming in self.inputs:
+            incoming.join_load()
+        healthy = all(incoming.error is None for incoming in self.inputs)
+        if not self.con:
+            return
+
+        try:
+            if self.suspend_wh and healthy and self.load_mode != 'detached' and any(incoming.loader for incoming in self.inputs):
+                self.con.cursor().execute(f'alter warehouse {self.warehouse} suspend')
+                self.display_info('Suspended the warehouse')
+        except Exception as e:
+            logging.error(str(e))
+            self.display_error_msg(self.error_str(e))
+            healthy = False
 
-        with open(file_path, 'a+', encoding='utf-8', newline='') as output_file:
-            csv.writer(output_file, delimiter='|', quoting=csv.QUOTE_ALL).writerows(zip(*field_lists))
-        for sublist in field_lists:
-            del sublist[:]
+        # keep the session open for the next run if every load succeeded
+        if healthy:
+            session.pool.release(self.session_key(), self.con)
+        else:
+            self.con.close()
+        self.con = None
+
+    def session_key(self) -> str:
+        """
+        A non-interface, helper function that identifies the settings a pooled session can be reused for.
+        :return: The session pool key.
+        """
+
+        return session.pool.key(self.account, self.user, self.password, self.warehouse, self.auth_type, self.okta_url)
 
     @staticmethod
     def msg_str(file_path: str) -> str:
@@ -229,20 +507,8 @@ class AyxPlugin:
         elif not os.access(file_path, os.W_OK):
             msg_str = 'Unable to write to supplied temp path'
         return msg_str  
-    
-    @staticmethod
-    def gzip(file_path: str):
-        '''
-        Gzip supplied file and delete original
-        '''
-
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096*4096), b''):
-                with gzip.open(file_path +'.gz', 'ab',compresslevel=3) as w:
-                    w.write(chunk)
-        os.remove(file_path)
 
-    def create_sql(self, key: str, data_type: str, size: int, scale: int) -> str:
+    def create_sql(self, key: str, data_type: str, size: int, scale: int, keys: list = ()) -> str:
         '''
         Generates Snowflake data type from Alteryx data type.
         Reduces max length if neccessary and adds key field for
@@ -259,7 +525,7 @@ class AyxPlugin:
             field = f'{key} {snow_type} ({size}, {scale})'
         else:
             field = f'{key} {snow_type}'
-        return f'{field} {"NOT NULL" if key == self.key and self.sql_type == "create" else ""}'
+        return f'{field} {"NOT NULL" if key in keys and self.sql_type == "create" else ""}'
 
 class IncomingInterface:
     """
@@ -268,28 +534,208 @@ class IncomingInterface:
     Prefixed with "ii", the Alteryx engine will expect the below four interface methods to be defined.
     """
 
-    def __init__(self, parent: object):
+    def __init__(self, parent: object, table: str = None):
         """
         Constructor for IncomingInterface.
         :param parent: AyxPlugin
+        :param table: The table this input loads, None for the configured table.
         """
 
         # Default properties
         self.parent = parent
+        self.wire_table: str = table
 
         # Custom membersn
         self.record_info_in = None
-        self.field_lists: list = []
+        self.writer: writer.ChunkWriter = None
+        self.uploader: uploader.StageUploader = None
+        self.metrics: metrics.RunMetrics = None
+        self.session_reused: bool = False
+        self.tmp_table: str = None
+        self.hash_column: str = None
+        self.merge_counts: dict = None
+        self.key_range: keyrange.KeyRange = None
+        self.deduplicator: dedup.KeyDeduplicator = None
+        self.duplicates: int = 0
+        self.sorter: sorter.ExternalSorter = None
+        self.sort_keys: list = []
+        self.manifest: manifest.LoadManifest = None
+        self.resumed: bool = False
+        self.stats: stats.ColumnStats = None
+        self.target_columns: dict = None
+        self.stage_table: str = None
+        self.stage_row = None
+        self.direct_rows: list = None
+        self.upsized: bool = False
+        self.truncate_query = None
+        self.pending: list = []
+        self.detached_query: str = None
+        self.temp_files_removed: bool = False
+        self.table: str = None
+        self.keys: list = []
+        self.temp_dir: str = None
+        self.closed: bool = False
+        self.loader: threading.Thread = None
+        self.messages: list = None
+        self.error: str = None
+        self.file_base_name: str = None
+        self.append_record = None
         self.sql_list: dict = {}
         self.headers: list = []
         self.counter: int = 0
+        self.start_time: float = 0
+        self.records_per_second: float = 0
         self.timestamp: int = 0
         self.file_counter: int = 0
-        self.file_size_limit: int = 25000000
-        self.cache_size: int = 100000
+        self.file_size_limit: int = 0
+        self.cache_size: int = 10000
+        self.cache_bytes: int = 0
+        self.cached_records: int = 0
 
     def get_file_name(self, root: str, base_name: str, counter: int) -> str:
-        return os.path.join(root, f'{base_name}{counter}.csv')
+        return os.path.join(root, f'{base_name}{counter}{self.writer.extension}')
+
+    def get_cache_size(self) -> int:
+        """
+        A non-interface, helper function that sizes the number of records cached between writes.
+        Narrow rows are written in larger batches than wide rows so every batch buffers roughly cache_bytes,
+        and a batch never compresses to more than a tenth of the target file size.
+        :return: The number of records to cache.
+        """
+
+        if not self.writer.buffer_bytes_per_row:
+            return self.cache_size
+        records = self.cache_bytes / self.writer.buffer_bytes_per_row
+        # until the first batch is compressed the ratio is unknown, so assume none
+        records = min(records, self.file_size_limit / 10 / (self.writer.compression_ratio or 1) / self.writer.bytes_per_row)
+        return max(1000, min(1000000, int(records)))
+
+    def open_session(self) -> 'snowflake.connector.connection':
+        """
+        Takes over a pooled session or connects to Snowflake, then selects the warehouse and schema.
+        Called from the upload thread as soon as it starts, so it overlaps with receiving records.
+        :return: The Snowflake connection.
+        """
+
+        con = session.pool.acquire(self.parent.session_key())
+        self.session_reused = con is not None
+        while True:
+            if not con:
+                with self.metrics.timer('connect'):
+                    con = self.parent.connect()
+            try:
+                # Set warehouse and schema
+                self.metrics.execute(con, f"USE WAREHOUSE {self.parent.warehouse}", 'setup')
+                self.metrics.execute(con, f"USE SCHEMA {self.parent.database}.{self.parent.schema}", 'setup')
+                break
+            except Exception:
+                con.close()
+                if not self.session_reused:
+                    raise
+                # the pooled session has expired, authenticate again
+                logging.info('Pooled session is no longer valid, reconnecting')
+                con, self.session_reused = None, False
+
+        # Start the warehouse while records are still arriving, this needs OPERATE so failures are only logged
+        try:
+            self.metrics.execute(con, f"ALTER WAREHOUSE {self.parent.warehouse} RESUME IF SUSPENDED", 'setup')
+        except Exception as e:
+            logging.warning(f'Unable to resume warehouse {self.parent.warehouse}: {e}')
+        return con
+
+    def create_tables(self, con: 'snowflake.connector.connection'):
+        """
+        Creates the temporary table the files are staged to, and reads the columns of an existing table the data is checked against.
+        Called from the upload thread once the first records have arrived. A created table is only replaced in load,
+        so a run failing or cancelled while records arrive leaves the existing table as it was.
+        :param con: The Snowflake connection.
+        """
+
+        # Execute Table Creation #
+        if self.stage_table == self.tmp_table:
+            # a detached load outlives the session, which would drop a temporary table under it
+            self.metrics.execute(con, self.table_sql(self.tmp_table, temporary=self.parent.load_mode != 'detached',
+                                                     transient=self.parent.load_mode == 'detached'), 'setup')
+
+        if self.stats and self.parent.sql_type != 'create':
+            self.target_columns = self.fetch_columns(con)
+
+    def table_sql(self, table: str, temporary: bool = False, fit: bool = False, transient: bool = False) -> str:
+        """
+        A non-interface, helper function that builds the statement creating the target or the temporary table.
+        :param table: The table name.
+        :param temporary: True to create a temporary table.
+        :param fit: True to size the columns to the values observed.
+        :param transient: True to create a transient table, which outlives the session unlike a temporary one.
+        :return: The CREATE statement.
+        """
+
+        columns = []
+        for index, (k, (v, s, c)) in enumerate(self.sql_list.items()):
+            if fit:
+                v, s, c = self.stats.fit(index, v, s, c)
+            columns.append(self.parent.create_sql(k, v, s, c, self.keys))
+        table_sql: str = f"Create or Replace {'TEMPORARY TABLE' if temporary else 'TRANSIENT TABLE' if transient else 'table'} {table}  ({', '.join(columns)}"
+        table_sql += f", PRIMARY KEY ({', '.join(self.keys)}))" if self.keys else ')'
+        return table_sql
+
+    def fetch_columns(self, con: 'snowflake.connector.connection') -> dict:
+        """
+        A non-interface, helper function that reads the column definitions of the target table.
+        :param con: The Snowflake connection.
+        :return: Column name: (data type, maximum length, precision, scale, nullable), empty if the table does not exist.
+        """
+
+        # unquoted names are stored in upper case
+        table, schema = [name.strip('"') if name.startswith('"') else name.upper() for name in (self.table, self.parent.schema)]
+        cursor = self.metrics.execute(con, 'select column_name, data_type, character_maximum_length, numeric_precision, numeric_scale, is_nullable '
+                                           f"from information_schema.columns where table_schema = '{schema}' and table_name = '{table}'", 'setup')
+        return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+
+    def check_stats(self):
+        """
+        A non-interface, helper function that fails the run as soon as the data seen so far does not fit the existing table.
+        """
+
+        if self.target_columns:
+            problems = self.stats.check(self.target_columns)
+            if problems:
+                raise ValueError(f"The data does not fit {self.table}: {'; '.join(problems[:5])}")
+
+    def fits_direct_load(self) -> bool:
+        """
+        A non-interface, helper function that decides whether the input is small enough to insert directly instead of staging it.
+        Only possible while every record is still buffered, i.e. nothing has been written to a file yet.
+        """
+
+        return (not self.writer.rows and 0 < self.cached_records <= self.parent.direct_max_rows
+                and self.cached_records * len(self.headers) <= DIRECT_MAX_VALUES
+                and self.writer.buffered_bytes <= self.parent.direct_max_mb * 1024 * 1024)
+
+    def insert_rows(self, con: 'snowflake.connector.connection', table: str):
+        """
+        A non-interface, helper function that inserts the records of a small input with one array bound INSERT.
+        :param con: The Snowflake connection.
+        :param table: The target table, or the temporary table when updating.
+        """
+
+        placeholders = ', '.join('?' for column in self.sql_list)
+        self.metrics.executemany(con, f"insert into {table} ({', '.join(self.sql_list)}) values ({placeholders})", self.direct_rows, 'insert')
+
+    def release_session(self, con: 'snowflake.connector.connection', healthy: bool):
+        """
+        A non-interface, helper function that hands the session back to the pool after a successful run, otherwise closes it.
+        :param con: The Snowflake connection, may be None.
+        :param healthy: True if the session can be reused.
+        """
+
+        # the session shared by several inputs is handed back once they have all closed
+        if not con or self.parent.shared:
+            return
+        if healthy:
+            session.pool.release(self.parent.session_key(), con)
+        else:
+            con.close()
 
     def ii_init(self, record_info_in: object) -> bool:
         """
@@ -304,65 +750,406 @@ class IncomingInterface:
             return False
 
         self.parent.display_info(f'Running Snowflake Output version {VERSION}')
+        self.metrics = metrics.RunMetrics()
         self.record_info_in = record_info_in  # For later reference.
 
         # Storing the field names to use when writing data out.
         for field in range(record_info_in.num_fields):
             field_name = cleaner.reserved_words(record_info_in[field].name, self.parent.case_sensitive)
-            self.field_lists.append([field_name])
             self.headers.append(field_name)
             self.sql_list[field_name] = (str(record_info_in[field].type), record_info_in[field].size, record_info_in[field].scale)
 
+        # Rows are hashed as they arrive into an extra column, so later updates can skip unchanged rows.
+        # Appends and truncates keep it too, as the staged files must have every column of a table that has it
+        if self.parent.store_hash:
+            self.hash_column = cleaner.reserved_words(HASH_COLUMN, self.parent.case_sensitive)
+            if HASH_COLUMN in [header.strip('"').upper() for header in self.headers]:
+                self.parent.display_error_msg(f'The input already has a {HASH_COLUMN} field, rename it to store the row hash')
+                return False
+            self.headers.append(self.hash_column)
+            self.sql_list[self.hash_column] = ('v_string', 16, 0)
+
+        # fix table and key names if case sensitive used or keyswords
+        self.file_base_name = self.wire_table or self.parent.table
+        if sum((incoming.wire_table or self.parent.table) == self.file_base_name for incoming in self.parent.inputs) > 1:
+            self.parent.display_error_msg(f'More than one input loads {self.file_base_name}, name each wire after the table it loads')
+            return False
+        self.table = cleaner.reserved_words(self.file_base_name, self.parent.case_sensitive)
+        # the keys are only used by updates and as the primary key of a created table, appends and truncates ignore any left set
+        keys = self.parent.keys if self.parent.sql_type in ('update', 'create') else []
+        self.keys = [cleaner.reserved_words(key, self.parent.case_sensitive) for key in keys]
+        for key in self.keys:
+            if key not in self.sql_list:
+                self.parent.display_error_msg(f'Key field {key} is not in the input')
+                return False
+        self.sort_keys = [cleaner.reserved_words(key, self.parent.case_sensitive) for key in self.parent.sort_keys]
+        for key in self.sort_keys:
+            if key not in self.sql_list:
+                self.parent.display_error_msg(f'Sort field {key} is not in the input')
+                return False
+
+        # A failed run with the same settings is resumed from its staging files if selected
+        run_settings = dict(table=self.table, sql_type=self.parent.sql_type, staging_format=self.parent.staging_format,
+                            compression=self.parent.compression, compression_level=self.parent.compression_level,
+                            keys=self.keys, dedup=self.parent.dedup, sort_keys=self.sort_keys,
+                            dialect=writer.CsvChunkWriter.dialect if self.parent.staging_format == 'csv' else None,
+                            columns=[[name, field_type, size, scale] for name, (field_type, size, scale) in self.sql_list.items()])
+        # each of several inputs keeps its runs in a folder named after its table
+        temp_root = os.path.join(self.parent.temp_dir, self.file_base_name) if self.parent.shared else self.parent.temp_dir
+        if self.parent.resume:
+            self.manifest = manifest.LoadManifest.find_resumable(temp_root, **run_settings)
+            self.resumed = self.manifest is not None
+
         self.timestamp = str(int(time.time()))
-        self.parent.temp_dir = os.path.join(self.parent.temp_dir, self.timestamp)
+        self.temp_dir = self.manifest.folder if self.resumed else os.path.join(temp_root, self.timestamp)
 
-        # Create filepaths when running
-        self.csv_file = self.get_file_name(self.parent.temp_dir, self.parent.table, self.file_counter)
-        
-        path = os.path.dirname(self.csv_file)
+        path = os.path.abspath(self.temp_dir)
 
-        if not os.path.exists(os.path.abspath(path)):
-            os.makedirs(os.path.abspath(path))
+        if not os.path.exists(path):
+            os.makedirs(path)
         
         # Logging setup
         logging.basicConfig(filename=os.path.join(path, 'snowflake_connector.log'), format='%(asctime)s - %(message)s', level=logging.INFO)
+        self.parent.start_profiler(path)
+
+        # Each chunk file is recorded with its checksum and status as the run progresses
+        if self.resumed:
+            logging.info(f'Resuming the failed run in {path}')
+            self.parent.display_info(f"Resuming the failed run in {path} from its {len(self.manifest.data['files'])} staging files")
+        else:
+            # files kept in memory cannot be resumed from, so their manifest is not written to the run's folder
+            self.manifest = manifest.LoadManifest.create(path, persist=not self.parent.in_memory, **run_settings)
+
+        # Created and updated tables are staged through a table named per run, as pooled sessions and detached loads outlive the run,
+        # unique so two runs starting in the same second never replace each other's table
+        table_name = re.sub(r'[^A-Za-z0-9_]', '_', self.table.strip('"'))[:200]
+        self.tmp_table = f'tmp_{table_name}_{uuid.uuid4().hex[:12]}'
+        self.manifest.update(tmp_table=self.tmp_table)
+        if self.parent.shared:
+            self.parent.display_info(f'Loading input {self.parent.inputs.index(self) + 1} into {self.table}')
+
+        # Column statistics size the columns of a created table, which then waits for the last record, or are checked against an existing table
+        if self.parent.column_stats and self.parent.sql_type in ('create', 'append', 'truncate', 'update'):
+            self.stats = stats.ColumnStats(self.headers, [field_type for field_type, size, scale in self.sql_list.values()])
+        # created tables are staged next to the table they replace, which is only replaced once every record has been staged
+        self.stage_table = self.tmp_table if self.parent.sql_type in ('update', 'create') else self.table
+
+        # Files kept in memory share the staging memory with the file being written, those queued and the one being uploaded
+        spool_bytes = int(self.parent.staging_memory_mb * 1024 * 1024 / (uploader.StageUploader.queue_size + 2)) if self.parent.in_memory else None
+
+        # Chunk files are streamed as records arrive and staged as soon as each one is sealed
+        try:
+            if self.parent.staging_format == 'parquet':
+                # Parquet columns are matched to the table by their unquoted names
+                self.writer = writer.ParquetChunkWriter([header.strip('"') for header in self.headers],
+                                                        [field_type for field_type, size, scale in self.sql_list.values()],
+                                                        compression=self.parent.compression,
+                                                        compresslevel=self.parent.compression_level,
+                                                        metrics=self.metrics,
+                                                        spool_bytes=spool_bytes)
+            elif self.parent.writer_processes:
+                # encoding and compression run in worker processes, each rolling its own files over at the target size
+                import shards
+                self.writer = shards.ShardedCsvWriter(self.headers,
+                                                      processes=self.parent.writer_processes,
+                                                      codec=self.parent.compression,
+                                                      compresslevel=self.parent.compression_level,
+                                                      target_bytes=int(self.parent.target_file_mb * 1024 * 1024),
+                                                      metrics=self.metrics)
+            else:
+                self.writer = writer.CsvChunkWriter(self.headers,
+                                                    codec=self.parent.compression,
+                                                    compresslevel=self.parent.compression_level,
+                                                    metrics=self.metrics,
+                                                    spool_bytes=spool_bytes)
+        except ImportError as e:
+            self.parent.display_error_msg(f'Unable to stage as {self.parent.staging_format} with {self.parent.compression} compression, missing library: {e.name}')
+            return False
+
+        # The session is opened in the background straight away and the tables are created once records arrive
+        self.uploader = uploader.StageUploader((lambda: self.parent.shared_session(self)) if self.parent.shared else self.open_session,
+                                               f'@%{self.stage_table}',
+                                               prepare=self.create_tables,
+                                               metrics=self.metrics,
+                                               slots=self.parent.upload_slots,
+                                               on_staged=lambda file_path: self.manifest.set_file_status(file_path, 'staged'))
+        self.writer.on_sealed = self.file_sealed
+
+        # Files are rolled over once they reach the target compressed size
+        self.file_size_limit = int(self.parent.target_file_mb * 1024 * 1024)
+
+        # Values are read with the accessors matching the staging format, picked once per schema
+        fields = [record_info_in[field] for field in range(record_info_in.num_fields)]
+        self.append_record = self.writer.appender(fields, self.hash_column is not None)
+
+        # Rows read ahead of buffering are staged through stage_row, which also gathers the column statistics
+        self.stage_row = self.writer.row_appender()
+        if self.stats:
+            read, observe, append_row = self.writer.reader(fields, self.hash_column is not None), self.stats.add, self.stage_row
+
+            def stage_row(row):
+                observe(row)
+                append_row(row)
+            self.stage_row = stage_row
+
+            def append_record(record):
+                stage_row(read(record))
+            self.append_record = append_record
+
+        # Sorted records are held back and staged in order once the input has ended, so they load clustered
+        if self.sort_keys and not self.resumed:
+            self.sorter = sorter.ExternalSorter([self.headers.index(key) for key in self.sort_keys],
+                                                [self.sql_list[key][0] for key in self.sort_keys],
+                                                path,
+                                                int(self.parent.buffer_mb * 1024 * 1024))
+            read, hold = self.writer.reader(fields, self.hash_column is not None), self.sorter.add
+
+            def append_record(record):
+                hold(read(record))
+                # held back, so not part of the batch
+                self.cached_records -= 1
+            self.append_record = append_record
+
+        # A resumed run only counts the records, and gathers the statistics, its files are already written
+        if self.resumed:
+            self.append_record = (lambda record: observe(read(record))) if self.stats else (lambda record: None)
+            self.cache_size = sys.maxsize
+
+        # Repeated keys are collapsed before they are staged, the MERGE would otherwise fail or do the work twice
+        elif self.parent.dedup and self.parent.sql_type == 'update':
+            self.deduplicator = dedup.KeyDeduplicator([self.headers.index(key) for key in self.keys],
+                                                      self.parent.dedup,
+                                                      self.sorter.add if self.sorter else self.stage_row,
+                                                      os.path.join(path, 'dedup.sqlite'),
+                                                      int(self.parent.buffer_mb * 1024 * 1024))
+            read, add = self.writer.reader(fields, self.hash_column is not None), self.deduplicator.add
+
+            def append_record(record):
+                if not add(read(record)):
+                    # dropped or held back, so not part of the batch
+                    self.cached_records -= 1
+            self.append_record = append_record
+
+        # Track the range of the keys as they are staged, so the MERGE only scans the matching part of the table
+        if self.parent.prune_merge and self.parent.sql_type == 'update':
+            key_fields = [fields[self.headers.index(key)] for key in self.keys]
+            self.key_range = keyrange.KeyRange(self.keys,
+                                               [str(field.type) for field in key_fields],
+                                               [self.writer.accessor(field) for field in key_fields],
+                                               single_floats=self.parent.staging_format == 'parquet')
+            append, observe = self.append_record, self.key_range.observe
+
+            def append_record(record):
+                observe(record)
+                append(record)
+            self.append_record = append_record
+
+        # The memory ceiling covers the batch being buffered, the batches queued and the one being compressed
+        self.cache_bytes = int(self.parent.buffer_mb * 1024 * 1024 / (self.writer.queue_size + 2))
 
+        # Create filepaths when running
+        if not self.resumed:
+            self.csv_file = self.get_file_name(self.temp_dir, self.file_base_name, self.file_counter)
+            self.writer.open(self.csv_file)
+
+        self.start_time = time.perf_counter()
         return True
 
     def ii_push_record(self, in_record: object) -> bool:
         """
-        Responsible for writing the data to csv in chunks.
+        Responsible for buffering the data and writing it to the chunk files in batches.
         Called when an input record is being sent to the plugin.
         :param in_record: The data for the incoming record.
         :return: False if file path string is invalid, otherwise True.
         """
 
+        if not self.parent.is_initialized or self.error:
+            return False
+
         self.counter += 1  # To keep track for chunking
 
-        if not self.parent.is_initialized:
+        try:
+            # Storing the data of in_record
+            self.append_record(in_record)
+            self.cached_records += 1
+
+            # Writing when chunk mark is met, or earlier if unusually wide records fill the buffer
+            if self.cached_records >= self.cache_size or (not self.cached_records % 1024 and self.writer.buffered_bytes >= self.cache_bytes):
+                self.write_batch()
+        except Exception as e:
+            logging.error(str(e))
+            # kept so closing the input fails the run instead of loading what was written
+            self.error = self.parent.error_str(e)
+            self.parent.display_error_msg(self.error)
             return False
 
-        # Storing the string data of in_record
-        for field in range(self.record_info_in.num_fields):
-            in_value = self.record_info_in[field].get_as_string(in_record)
-            self.field_lists[field].append(in_value) if in_value is not None else self.field_lists[field].append('NULL')
+        return True
 
-        # Writing when chunk mark is met
-        if self.counter % self.cache_size == 0:
-            self.parent.write_lists_to_csv(self.csv_file, self.field_lists)
+    def write_batch(self):
+        """
+        A non-interface, helper function that hands the buffered records to the writer, starting a new file once the target size is reached.
+        """
 
-            # Start new csv file if limit reached
-            if self.counter % (self.file_size_limit) == 0:
-                self.file_counter += 1
-                # create new file name
-                self.csv_file = self.get_file_name(self.parent.temp_dir, self.parent.table, self.file_counter)
+        self.writer.flush(self.cached_records)
+        self.cached_records = 0
 
-                # append headers for new file
-                for record in range(0, len(self.headers)):
-                    self.field_lists[record].append(self.headers[record])
+        # Create the tables in the background now there are records, and stop early if connecting failed
+        self.uploader.prepare()
+        if self.uploader.error:
+            raise self.uploader.error
 
-        return True
-      
+        # Size the next chunk from the observed row width
+        self.cache_size = self.get_cache_size()
+
+        # Fail before uploading the rest if the data seen so far does not fit the existing table
+        if self.stats:
+            self.check_stats()
+
+        # Start new file once the target compressed size is reached, writer processes roll their own files over
+        if self.writer.current_file_size >= self.file_size_limit:
+            self.file_counter += 1
+            # create new file name, the writer seals the previous file and adds the headers
+            self.csv_file = self.get_file_name(self.temp_dir, self.file_base_name, self.file_counter)
+            self.writer.open(self.csv_file)
+
+    def write_held_records(self):
+        """
+        A non-interface, helper function that stages the records held back by the de-duplication once the input has ended.
+        """
+
+        with self.metrics.timer('dedup'):
+            if self.sorter:
+                # sorted along with the records passed on as they arrived
+                for row in self.deduplicator.held():
+                    self.sorter.add(row)
+            else:
+                self.stage_rows(self.deduplicator.held())
+        self.duplicates = self.deduplicator.duplicates
+        if self.duplicates:
+            self.parent.display_info(f'Removed {self.duplicates:,} records with a duplicate key, keeping the {self.parent.dedup} of each'
+                                     f'{" (index spilled to disk)" if self.deduplicator.spilled else ""}')
+
+    def write_sorted_records(self):
+        """
+        A non-interface, helper function that stages the records held back for sorting, in order, once the input has ended.
+        """
+
+        spilled = self.sorter.spilled_runs
+        with self.metrics.timer('sort'):
+            self.stage_rows(self.sorter.sorted_rows())
+        self.parent.display_info(f"Sorted {self.sorter.rows:,} records by {', '.join(self.sort_keys)}"
+                                 f"{f' (merged {spilled} sorted runs from disk)' if spilled else ''}")
+
+    def stage_rows(self, rows):
+        """
+        A non-interface, helper function that stages rows read ahead of buffering, writing batches as they fill up.
+        :param rows: The rows, as returned by the writer's reader.
+        """
+
+        stage_row = self.stage_row
+        for row in rows:
+            stage_row(row)
+            self.cached_records += 1
+            if self.cached_records >= self.cache_size or (not self.cached_records % 1024 and self.writer.buffered_bytes >= self.cache_bytes):
+                self.write_batch()
+
+    def file_sealed(self, file_path: str):
+        """
+        A non-interface, helper function that records a sealed file in the manifest and queues it for upload.
+        Called from the writer thread.
+        :param file_path: The path of the sealed chunk file.
+        """
+
+        # files kept in memory are uploaded from their spool and cannot be resumed from,
+        # the checksum reads the whole file again so it is only taken when the run may be resumed
+        spool = self.writer.spools.pop(file_path, None)
+        if spool is None:
+            self.manifest.add_file(file_path, checksum=self.parent.resume)
+        self.uploader.put(file_path, spool)
+
+    def stage_resumed_files(self):
+        """
+        A non-interface, helper function that uploads the files of the failed run being resumed, skipping those already loaded.
+        Files already staged are skipped too when they were staged to the table's own stage, which outlives the session;
+        a temporary table's stage was dropped with the failed run's session, so they are uploaded again.
+        """
+
+        if self.counter != self.manifest.data['records']:
+            raise ValueError(f"The input has {self.counter:,} records but the failed run had {self.manifest.data['records']:,}, "
+                             f"clear the resume option to load it as a new run")
+        self.duplicates = self.manifest.data['duplicates']
+        self.writer.files = self.manifest.file_paths
+        self.uploader.prepare()
+        skipped = ('loaded', 'staged') if self.stage_table == self.table else ('loaded',)
+        for entry in self.manifest.data['files']:
+            if entry['status'] in skipped:
+                continue
+            if not self.manifest.verify_file(entry):
+                raise ValueError(f"Staging file {entry['file']} is missing or has changed since the failed run")
+            self.uploader.put(os.path.join(self.manifest.folder, entry['file']))
+        self.writer.close()
+
+    def stop_pipeline(self):
+        """
+        A non-interface, helper function that stops the writer and upload threads without staging anything further.
+        The upload connection is closed if the upload failed before it could be handed over.
+        """
+
+        if self.writer:
+            self.writer.abort()
+        if self.deduplicator:
+            self.deduplicator.close()
+        if self.sorter:
+            self.sorter.close()
+        if self.uploader:
+            self.uploader.abort()
+            if self.uploader.error and self.uploader.con and not self.parent.shared:
+                self.uploader.con.close()
+                self.uploader.con = None
+
+    def write_metrics(self, error: str):
+        """
+        A non-interface, helper function that writes the run metrics as JSON to the run's temp folder,
+        or to the log when the staging files are kept in memory so nothing but the log is left in the folder.
+        :param error: The error message if the run failed, otherwise None.
+        """
+
+        metrics_file = os.path.join(self.temp_dir, 'metrics.json')
+        try:
+            run = dict(version=VERSION,
+                       table=self.table,
+                       sql_type=self.parent.sql_type,
+                       staging_format=self.parent.staging_format,
+                       compression=self.parent.compression,
+                       writer_processes=self.parent.writer_processes,
+                       status='error' if error else 'success',
+                       error=error,
+                       records=self.counter,
+                       records_per_second=round(self.records_per_second, 1),
+                       files=len(self.writer.files),
+                       file_bytes=sum(os.path.getsize(f) if os.path.exists(f) else size for f, size in zip(self.writer.files, self.writer.file_sizes)),
+                       in_memory=self.parent.in_memory,
+                       direct_insert=self.direct_rows is not None,
+                       load_mode=self.parent.load_mode or 'blocking',
+                       detached_query=self.detached_query,
+                       tmp_table=self.tmp_table if self.stage_table != self.table else None,
+                       warehouse_size=self.parent.warehouse_sizer.to_dict() if self.parent.warehouse_sizer else None,
+                       spilled_files=self.writer.spilled_files,
+                       raw_bytes=self.writer.raw_bytes,
+                       peak_buffer_bytes=self.writer.peak_buffer_bytes,
+                       duplicates=self.duplicates,
+                       resumed=self.resumed,
+                       columns=self.stats.to_dict() if self.stats else None,
+                       merge_counts=self.merge_counts,
+                       sort_runs=self.sorter.spilled_runs if self.sorter else None,
+                       seconds=round(time.time() - self.metrics.started, 3))
+            if self.parent.in_memory:
+                logging.info(f'Run metrics {json.dumps(self.metrics.to_dict(**run))}')
+                return
+            self.metrics.write(metrics_file, **run)
+            self.parent.display_file(f'{metrics_file} | {metrics_file} metrics file is created')
+        except Exception as e:
+            logging.warning(f'Unable to write metrics: {e}')
 
     def ii_update_progress(self, d_percent: float):
         """
@@ -377,136 +1164,428 @@ class IncomingInterface:
         Handles writing out any residual data out.
         Called when the incoming connection has finished passing all of its records.
         """
-        
-        if self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True' or not self.parent.is_initialized:
-            return False
-        elif self.counter == 0:
-            self.parent.display_info('No records to process')
-            return False
 
-        con: snowflake.connector.connection = None
+        try:
+            self.close_input()
+        finally:
+            # several inputs load alongside each other, the last one to close waits for them all
+            if self.parent.shared:
+                self.closed = True
+                self.parent.input_closed()
 
-        # Outputting the link message that the file was written
-        if len(self.csv_file) > 0 and self.parent.is_initialized:
-            # First element for each list will always be the field names.
-            if len(self.field_lists[0]) > 1:
-                self.parent.write_lists_to_csv(self.csv_file, self.field_lists)
+    def display_info(self, msg_string: str):
+        # messages of a load running in the background are held until it is joined
+        if self.messages is not None:
+            self.messages.append(msg_string)
+        else:
+            self.parent.display_info(msg_string)
 
-        # gzip files
-        files = [os.path.join(self.parent.temp_dir, f) for f in os.listdir(self.parent.temp_dir) if self.parent.table in f]
+    def close_input(self):
+        """
+        A non-interface, helper function that stages the residual data and loads it, on a background thread if there are several inputs.
+        """
 
-        #self.parent.gzip(self.csv_file)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()*10) as executor:
-            executor.map(self.parent.gzip, files) 
+        if self.error:
+            # pushing the records failed, so the run fails with what it has written
+            self.finish(None)
+            return
+        elif self.parent.alteryx_engine.get_init_var(self.parent.n_tool_id, 'UpdateOnly') == 'True' or not self.parent.is_initialized:
+            # a run stopped by an error, e.g. of another input, is left failed and its session is closed
+            healthy = self.parent.is_initialized
+            try:
+                self.stop_pipeline()
+            except Exception as e:
+                logging.error(str(e))
+                self.parent.display_error_msg(self.parent.error_str(e))
+                healthy = False
+            if self.manifest and not healthy:
+                self.manifest.update(status='failed')
+            self.release_session(self.uploader.con if self.uploader else None, healthy)
+            return
+        elif self.counter == 0:
+            try:
+                self.stop_pipeline()
+            except Exception as e:
+                logging.error(str(e))
+                self.error = self.parent.error_str(e)
+                self.parent.display_error_msg(self.error)
+                self.finish(None)
+                return
+            self.parent.display_info('No records to process')
+            # nothing is staged, so the run is complete and the file opened with only its header is not kept
+            if self.parent.delete_tempfiles:
+                for f in self.writer.files:
+                    if os.path.exists(f):
+                        os.remove(f)
+            self.writer.files = []
+            self.manifest.update(status='complete')
+            self.write_metrics(None)
+            self.release_session(self.uploader.con, True)
+            return
+
+        con: 'snowflake.connector.connection' = None
+
+        # Ingestion rate from ii_init until the last record was pushed
+        receive_seconds = max(time.perf_counter() - self.start_time, 1e-6)
+        self.records_per_second = self.counter / receive_seconds
+        self.metrics.add('receive', receive_seconds, self.counter)
+        logging.info(f'Received {self.counter:,} records at {self.records_per_second:,.0f} records/sec')
 
-        for f in files:
-            f = os.path.join(self.parent.temp_dir, f)
-            self.parent.display_file(f'{f} | {f} gzip file is created')
+        try:
+            # Write out the residual records and seal the last file, which queues it for upload
+            drain_start = time.perf_counter()
+            if self.resumed:
+                self.stage_resumed_files()
+            else:
+                if self.deduplicator:
+                    self.write_held_records()
+                if self.sorter:
+                    self.write_sorted_records()
+                # Small inputs skip the files, stage and COPY, and are inserted from the buffer
+                if self.fits_direct_load():
+                    self.direct_rows = self.writer.buffered_rows()
+                    self.writer.abort()
+                    for f in self.writer.files:
+                        if os.path.exists(f):
+                            os.remove(f)
+                    self.writer.files = []
+                else:
+                    if self.cached_records > 0:
+                        self.writer.flush(self.cached_records)
+                    self.writer.close()
+                self.uploader.prepare()
+                self.manifest.update(status='written', sealed=not self.parent.in_memory and self.direct_rows is None,
+                                     records=self.counter, duplicates=self.duplicates)
+
+            # Outputting the link message that the files were written
+            if self.parent.in_memory:
+                self.parent.display_info(f'Kept {len(self.writer.files)} staging files in memory'
+                                         f'{f", {self.writer.spilled_files} spilled to disk" if self.writer.spilled_files else ""}')
+            else:
+                for f in self.writer.files:
+                    self.parent.display_file(f'{f} | {f} staging file is created')
+            self.parent.display_info(f'Peak buffer memory {self.writer.peak_buffer_bytes / 1048576:,.1f} MB')
+
+            # The truncate runs while the tail file is staged, once the data has been checked against the table,
+            # submitted by the upload thread between two files as the connection is busy with the uploads
+            if self.parent.load_mode == 'async' and self.truncates() and not self.stats:
+                self.uploader.submit(f'truncate table {self.table}', 'truncate')
+
+            # Wait for the tail file to be staged
+            con = self.uploader.close()
+            self.truncate_query = self.uploader.submitted.get('truncate')
+            self.metrics.add('drain', time.perf_counter() - drain_start)
+            if self.session_reused:
+                self.parent.display_info('Reused an open Snowflake session')
+            else:
+                self.parent.display_info(f'Authenticated via {"Snowflake" if self.parent.auth_type == "snowflake" else "Okta"}')
+            if self.direct_rows is not None:
+                self.parent.display_info(f'Inserting {len(self.direct_rows):,} records directly instead of staging them')
+            else:
+                self.parent.display_info(f'Staged {len(self.uploader.files)} files to {self.uploader.stage}')
 
-        # clean key field
-        if self.parent.key:
-            self.parent.key = cleaner.reserved_words(self.parent.key, self.parent.case_sensitive)
+            if self.parent.shared:
+                # the load runs alongside those of the other inputs and its messages are shown once it is joined
+                self.messages = []
+                self.loader = threading.Thread(target=self.run_load, args=(con,), name=f'SnowflakeLoad{self.parent.inputs.index(self) + 1}', daemon=True)
+                self.loader.start()
+                return
+            self.load(con)
 
-        # path to gzip files
-        gzip_file = os.path.join(self.parent.temp_dir, self.parent.table).replace('\\', '//')
+        except Exception as e:
+            logging.error(str(e))
+            self.error = self.parent.error_str(e)
+            self.parent.display_error_msg(self.error)
+        self.finish(con)
 
-        # Create Snowflake connection
+    def load(self, con: 'snowflake.connector.connection'):
+        """
+        A non-interface, helper function that loads the staged files into the table with COPY, followed by MERGE when updating.
+        :param con: The Snowflake connection.
+        """
 
-        try:
-            if self.parent.auth_type == 'snowflake':
-                con = snowflake.connector.connect(
-                                                user=self.parent.user,
-                                                password=self.parent.password,
-                                                account=self.parent.account,
-                                                warehouse=self.parent.warehouse,
-                                                database=self.parent.database,
-                                                schema=self.parent.schema,
-                                                ocsp_fail_open=True
-                                                )
-                self.parent.display_info('Authenticated via Snowflake')
+        detached = self.parent.load_mode == 'detached'
+
+        # Check the data fits before loading
+        if self.stats:
+            self.stats.summarise()
+            self.check_stats()
+
+        # Replace the table just before the COPY, sized to the data if selected; a resumed run keeps the rows its earlier attempt already loaded
+        if self.parent.sql_type == 'create' and not (self.resumed and self.manifest.entries('loaded')):
+            self.metrics.execute(con, self.table_sql(self.table, fit=self.stats is not None), 'setup')
+            if self.stats:
+                self.display_info(f'Created {self.table} with columns sized to the data')
+
+        # Files a resumed run already loaded are kept, COPY's load history skips them if they were staged again
+        if self.truncates() and self.truncate_query is None:
+            self.truncate_query = self.statement(con, f'truncate table {self.table}', 'truncate')
+
+        # Scale the warehouse up for COPY and MERGE, small direct inserts run on the size it has
+        if self.parent.warehouse_sizer and self.direct_rows is None:
+            self.upsize_warehouse(con)
+
+        # COPY to Snowflake
+        if self.truncate_query:
+            self.metrics.wait(con, self.truncate_query)
+
+        # Existing tables get the hash column on their first load that keeps it, their rows are then all updated once
+        alter_sql = f'alter table {self.table} add column if not exists {self.hash_column} VARCHAR (16)' if self.hash_column and self.parent.sql_type != 'create' else None
+
+        if self.parent.sql_type in ('create', 'truncate', 'append'):
+            if alter_sql and (not detached or self.direct_rows is not None):
+                self.metrics.execute(con, alter_sql, 'copy')
+            source = f' FROM @%{self.stage_table}' if self.stage_table != self.table else ''
+            copy_sql = f'COPY INTO {self.table}{source} {self.writer.file_format(self.parent.case_sensitive)} PURGE = TRUE'
+            drop_sql = f'drop table if exists {self.stage_table}' if source else None
+            if self.direct_rows is not None:
+                self.insert_rows(con, self.table)
+            elif detached:
+                self.detach(con, [alter_sql, copy_sql, drop_sql], 'copy')
+                drop_sql = None
             else:
-                con = snowflake.connector.connect(
-                                                user=self.parent.user,
-                                                password=self.parent.password,
-                                                authenticator=self.parent.okta_url,
-                                                account=self.parent.account,
-                                                warehouse=self.parent.warehouse,
-                                                database=self.parent.database,
-                                                schema=self.parent.schema,
-                                                ocsp_fail_open=True
-                                                )                
-                self.parent.display_info('Authenticated via Okta')
-
-            # Set warehouse and schema
-            con.cursor().execute(f"USE WAREHOUSE {self.parent.warehouse}")
-            con.cursor().execute(f"USE SCHEMA {self.parent.database}.{self.parent.schema}")
-
-            # fix table name if case sensitive used or keyswords
-            self.parent.table = cleaner.reserved_words(self.parent.table, self.parent.case_sensitive)
-        
-            # Execute Table Creation #
-            if self.parent.sql_type in ('create', 'update'):
-                if self.parent.sql_type == 'create':
-                    table_sql: str = f"Create or Replace table {self.parent.table}  ({', '.join([self.parent.create_sql(k,v,s,c) for k, (v,s,c) in self.sql_list.items()])}"
-
-                elif self.parent.sql_type == 'update':
-                    table_sql: str = f"Create or Replace TEMPORARY TABLE tmp  ({', '.join([self.parent.create_sql(k,v,s,c) for k, (v,s,c) in self.sql_list.items()])}"
+                copy = self.statement(con, copy_sql, 'copy')
+                self.overlap_copy()
+                self.metrics.wait(con, copy)
+                self.manifest.set_all_status('loaded')
+            if drop_sql:
+                self.pending.append(self.statement(con, drop_sql, 'copy'))
+
+        elif self.parent.sql_type == 'update':
+            copy_sql = f'COPY INTO {self.tmp_table} {self.writer.file_format(self.parent.case_sensitive)} PURGE = TRUE'
+            copy = None
+            if self.direct_rows is not None:
+                self.insert_rows(con, self.tmp_table)
+            elif not detached:
+                copy = self.statement(con, copy_sql, 'copy')
+
+
+            insert_fields = ', '.join(self.sql_list)
+            set_fields = ', '.join([f + ' = tmp.' + f for f in self.sql_list])
+            tmp_fields = (', ').join(['tmp.' + fld for fld in self.sql_list])
+
+            # Only rewrite matched rows whose content changed, comparing the stored hash if there is one
+            when_matched = 'when matched then '
+            if self.parent.change_detection:
+                if self.hash_column:
+                    changed = f'{self.table}.{self.hash_column} is distinct from tmp.{self.hash_column}'
+                else:
+                    changed = ' or '.join([f'{self.table}.{f} is distinct from tmp.{f}' for f in self.sql_list if f not in self.keys])
+                when_matched = f'when matched and ({changed or "false"}) then '
+
+            alter = self.statement(con, alter_sql, 'merge') if alter_sql and not detached else None
+
+            # Key range predicates let Snowflake prune the micro-partitions no input row can match
+            on_clause = [f'{self.table}.{k} = tmp.{k}' for k in self.keys]
+            if self.key_range:
+                predicates = self.key_range.predicates(self.table)
+                logging.info(f"Key range predicates: {' and '.join(predicates)}")
+                if predicates:
+                    self.display_info(f'Limited the MERGE to the key range of the input on {len(predicates)} key fields')
+                on_clause += predicates
+
+            merge_query = (f'merge into {self.table} '
+                                f"using {self.tmp_table} tmp on {' and '.join(on_clause)} "
+                                f'{when_matched}'
+                                f'update set {set_fields} '
+                                f'when not matched then '
+                                f'insert ({insert_fields}) values ({tmp_fields});')
+
+            # the session may be reused, so its temporary table is dropped straight away
+            drop_sql = f'drop table if exists {self.tmp_table}'
+
+            if detached:
+                self.detach(con, [None if self.direct_rows is not None else copy_sql, alter_sql, merge_query, drop_sql], 'merge')
+            else:
+                if copy:
+                    self.overlap_copy()
+                    self.metrics.wait(con, copy)
+                if alter:
+                    self.metrics.wait(con, alter)
+                merge_result = self.metrics.wait(con, self.statement(con, merge_query, 'merge')).fetchone()
+                if merge_result:
+                    inserted, updated = merge_result[0], merge_result[1]
+                    self.merge_counts = {'inserted': inserted, 'updated': updated, 'unchanged': self.counter - self.duplicates - inserted - updated}
+                    self.display_info(f"Inserted {inserted:,}, updated {updated:,} and left {self.merge_counts['unchanged']:,} rows unchanged")
+
+                self.manifest.set_all_status('loaded')
+                self.pending.append(self.statement(con, drop_sql, 'merge'))
+
+        if self.upsized:
+            self.restore_warehouse(con)
+
+        self.display_info(f"{'Staged' if self.detached_query else 'Processed'} {self.counter - self.duplicates:,} records "
+                          f'(received at {self.records_per_second:,.0f} records/sec)')
+
+        # several inputs suspend the warehouse once all their loads are done, a detached load leaves it to auto suspend
+        suspend = self.parent.suspend_wh and not self.parent.shared and not self.detached_query
+        if suspend:
+            self.pending.append(self.statement(con, f'alter warehouse {self.parent.warehouse} suspend', 'suspend'))
+
+        # statements nothing else depends on are only waited for at the end
+        for cursor in self.pending:
+            self.metrics.wait(con, cursor)
+        if suspend:
+            self.display_info('Suspended the warehouse')
+
+        # Phase timings, with Snowflake's own elapsed time for each statement
+        self.metrics.fetch_server_times(con)
+        for line in self.metrics.summary():
+            self.display_info(line)
+
+    def truncates(self) -> bool:
+        """
+        A non-interface, helper function that tells whether the load truncates the table first.
+        :return: True unless the SQL type is not truncate or a resumed run has already loaded some of its files.
+        """
 
-                table_sql += f', PRIMARY KEY ({self.parent.key}))' if self.parent.key else ')'
+        return self.parent.sql_type == 'truncate' and not (self.resumed and self.manifest.entries('loaded'))
 
-                con.cursor().execute(table_sql)
+    def statement(self, con: 'snowflake.connector.connection', sql: str, phase: str) -> object:
+        """
+        A non-interface, helper function that runs a statement of the load, only submitting it if the statements overlap.
+        :param con: The Snowflake connection.
+        :param sql: The statement.
+        :param phase: The phase the statement belongs to.
+        :return: The cursor, which metrics.wait returns once the statement has finished.
+        """
 
-            # PUT and COPY to Snowflake
+        if self.parent.load_mode:
+            return self.metrics.execute_async(con, sql, phase)
+        return self.metrics.execute(con, sql, phase)
 
-            if self.parent.sql_type == 'truncate':
-                con.cursor().execute(f'truncate table {self.parent.table}')
+    def overlap_copy(self):
+        """
+        A non-interface, helper function that does the work which does not depend on the COPY while it runs.
+        """
 
-            if self.parent.sql_type in ('create', 'truncate', 'append'):
-                con.cursor().execute("PUT 'file://{0}*' @%{1} PARALLEL=64 OVERWRITE=TRUE".format(gzip_file, self.parent.table))
-                con.cursor().execute("""COPY INTO {0} FILE_FORMAT = (TYPE=CSV FIELD_DELIMITER='|' NULL_IF='NULL' COMPRESSION=GZIP SKIP_HEADER=1 FIELD_OPTIONALLY_ENCLOSED_BY='"') PURGE = TRUE""".format(self.parent.table))
+        # the files are already staged, unless the run may be resumed from them should the COPY fail
+        if self.parent.load_mode and self.parent.delete_tempfiles and not self.parent.in_memory and not self.parent.resume:
+            self.remove_temp_files()
 
-            elif self.parent.sql_type == 'update':
-                con.cursor().execute("PUT 'file://{0}*' @%tmp PARALLEL=64 OVERWRITE=TRUE".format(gzip_file))
-                con.cursor().execute("""COPY INTO tmp FILE_FORMAT = (TYPE=CSV FIELD_DELIMITER='|' NULL_IF='NULL' COMPRESSION=GZIP SKIP_HEADER=1 FIELD_OPTIONALLY_ENCLOSED_BY='"') PURGE = TRUE""")
+    def detach(self, con: 'snowflake.connector.connection', statements: list, phase: str):
+        """
+        A non-interface, helper function that submits the rest of the load as one statement and returns once Snowflake has taken it on,
+        leaving it to run after the tool has finished.
+        :param con: The Snowflake connection.
+        :param statements: The statements in the order they run, None for those not needed.
+        :param phase: The phase the statements belong to.
+        """
 
+        statements = [sql.rstrip(';') for sql in statements if sql]
+        # several statements run as one Snowflake Scripting block, which stops at the first that fails
+        sql = statements[0] if len(statements) == 1 else 'EXECUTE IMMEDIATE $$\nBEGIN\n' + ''.join(f'  {sql};\n' for sql in statements) + 'END;\n$$'
+        cursor = self.metrics.wait(con, self.metrics.execute_async(con, sql, phase), accepted=True)
+        self.detached_query = cursor.sfqid
+        self.manifest.update(detached_query=self.detached_query)
+        self.overlap_copy()
+        self.display_info(f'Submitted the load as query {self.detached_query} and finished without waiting for it, '
+                          f'look it up in the query history to check it succeeded')
+        if self.stage_table != self.table:
+            self.display_info(f'Drop {self.stage_table} should the load fail, it is dropped once the load succeeds')
+
+    def upsize_warehouse(self, con: 'snowflake.connector.connection'):
+        """
+        A non-interface, helper function that scales the warehouse up to the size the staged files, bytes and records call for.
+        :param con: The Snowflake connection.
+        """
 
-                insert_fields = ', '.join(self.sql_list)
-                set_fields = ', '.join([f + ' = tmp.' + f for f in self.sql_list])
-                tmp_fields = (', ').join(['tmp.' + fld for fld in self.sql_list])
+        # resumed runs take the sizes from the manifest, files kept in memory are only in the writer
+        file_sizes = [entry['size'] for entry in self.manifest.data['files']] or self.writer.file_sizes
+        target = warehouse.fit(len(file_sizes), sum(file_sizes), self.counter - self.duplicates)
+        size = self.parent.warehouse_sizer.acquire(con, target, self.metrics)
+        # every load is matched by a release, whether or not it was the one that resized the warehouse
+        self.upsized = True
+        if size:
+            self.display_info(f'Scaled the warehouse up to {size} for the load')
 
-                merge_query = (f'merge into {self.parent.table} '
-                                    f'using tmp on {self.parent.table}.{self.parent.key} = tmp.{self.parent.key} '
-                                    f'when matched then '
-                                    f'update set {set_fields} '
-                                    f'when not matched then '
-                                    f'insert ({insert_fields}) values ({tmp_fields});')
+    def restore_warehouse(self, con: 'snowflake.connector.connection'):
+        """
+        A non-interface, helper function that restores the warehouse size once no other input's load needs the larger one.
+        :param con: The Snowflake connection.
+        """
 
-                con.cursor().execute(merge_query)
+        self.upsized = False
+        restored = self.parent.warehouse_sizer.release(con, self.metrics)
+        if restored:
+            self.display_info(f'Restored the warehouse to {restored}')
 
-            self.parent.display_info(f'Processed {self.counter:,} records')
-            
-            if self.parent.suspend_wh:
-                con.cursor().execute(f'alter warehouse {self.parent.warehouse} suspend')
-                self.parent.display_info('Suspended the warehouse')
+    def run_load(self, con: 'snowflake.connector.connection'):
+        """
+        A non-interface, helper function that runs the load on its background thread, keeping any error for join_load.
+        :param con: The shared Snowflake connection.
+        """
 
+        try:
+            self.load(con)
         except Exception as e:
             logging.error(str(e))
-            self.parent.display_error_msg(f'Error {e.errno} ({e.sqlstate}): {e.msg} ({e.sfqid})')
-        finally:
+            self.error = self.parent.error_str(e)
 
-            # delete temporary files if selected
-            # Get a list of all the file paths that ends with .txt from in specified directory
-            if self.parent.delete_tempfiles:
-                fileList = glob.glob(f'{self.parent.temp_dir}/*.gz')
-                # Iterate over the list of filepaths & remove each file.
-                for filePath in fileList:
-                    try:
-                        self.parent.display_info(f'Removed temp file {filePath}')
-                        os.remove(filePath)
-                    except:
-                        self.parent.display_info(f'Unable to remove temp file {filePath}')
-
-            if con:
-                con.close()
+    def join_load(self):
+        """
+        A non-interface, helper function that waits for the background load, then shows its messages and finishes the run.
+        Called from the engine's thread once every input has closed.
+        """
+
+        if not self.loader:
+            return
+        self.loader.join()
+        messages, self.messages = self.messages, None
+        for message in messages:
+            self.parent.display_info(f'{self.table}: {message}')
+        if self.error:
+            self.parent.display_error_msg(f'{self.table}: {self.error}')
+        self.finish(self.uploader.con)
+
+    def finish(self, con: 'snowflake.connector.connection'):
+        """
+        A non-interface, helper function that records the outcome of the run, removes the temp files if selected and hands back the session.
+        :param con: The Snowflake connection, None if staging failed before it was returned.
+        """
+
+        # stop the background threads if the run failed part way through, a failure stopping them fails the run
+        try:
+            self.stop_pipeline()
+        except Exception as e:
+            logging.error(str(e))
+            if not self.error:
+                self.error = self.parent.error_str(e)
+                self.parent.display_error_msg(self.error)
+        error = self.error
+        con = con or self.uploader.con
+        self.manifest.update(status='failed' if error else 'complete')
+
+        # a failed load still restores the warehouse size it scaled up
+        if self.upsized and con:
+            try:
+                self.restore_warehouse(con)
+            except Exception as e:
+                self.parent.display_error_msg(f'Unable to restore the warehouse size, resize {self.parent.warehouse} by hand: {self.parent.error_str(e)}')
+
+        self.write_metrics(error)
+
+        # delete temporary files if selected, unless they are kept to resume the failed run
+        if error and self.parent.resume and self.manifest.resumable:
+            self.parent.display_info(f'Kept the staging files in {self.temp_dir} so the run can be resumed')
+        elif self.parent.delete_tempfiles and not self.parent.in_memory and not self.temp_files_removed:
+            self.remove_temp_files()
+
+        # keep the session open for the next run if this one succeeded
+        self.release_session(con, error is None)
+
+        self.parent.display_info('Snowflake transaction complete')
+
+    def remove_temp_files(self):
+        """
+        A non-interface, helper function that removes the staging files written, once they are staged.
+        """
 
-        self.parent.display_info('Snowflake transaction complete')
\ No newline at end of file
+        self.temp_files_removed = True
+        # Iterate over the staging files written & remove each file.
+        for filePath in self.writer.files:
+            try:
+                self.display_info(f'Removed temp file {filePath}')
+                os.remove(filePath)
+            except:
+                self.display_info(f'Unable to remove temp file {filePath}')
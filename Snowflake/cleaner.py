@@ -9,107 +9,121 @@ def sanitise_inputs(data: str):
         data = None if data.strip() == '' else data
     return data
 
-def reserved_words(field: str, case_sensitive: bool) -> str:
-    reserved_list: list = ['ACCOUNT',
-                    'ALL',
-                    'ALTER',
-                    'AND',
-                    'ANY',
-                    'AS',
-                    'BETWEEN',
-                    'BY',
-                    'CASE',
-                    'CAST',
-                    'CHECK',
-                    'COLUMN',
-                    'CONNECT',
-                    'CONNECTION',
-                    'CONSTRAINT',
-                    'CREATE',
-                    'CROSS',
-                    'CURRENT',
-                    'CURRENT_DATE',
-                    'CURRENT_TIME',
-                    'CURRENT_TIMESTAMP',
-                    'CURRENT_USER',
-                    'DATABASE',
-                    'DELETE',
-                    'DISTINCT',
-                    'DROP',
-                    'ELSE',
-                    'EXISTS',
-                    'FALSE',
-                    'FOLLOWING',
-                    'FOR',
-                    'FROM',
-                    'FULL',
-                    'GRANT',
-                    'GROUP',
-                    'GSCLUSTER',
-                    'HAVING',
-                    'ILIKE',
-                    'IN',
-                    'INCREMENT',
-                    'INNER',
-                    'INSERT',
-                    'INTERSECT',
-                    'INTO',
-                    'IS',
-                    'ISSUE',
-                    'JOIN',
-                    'LATERAL',
-                    'LEFT',
-                    'LIKE',
-                    'LOCALTIME',
-                    'LOCALTIMESTAMP',
-                    'MINUS',
-                    'NATURAL',
-                    'NOT',
-                    'NULL',
-                    'OF',
-                    'ON',
-                    'OR',
-                    'ORDER',
-                    'ORGANIZATION',
-                    'QUALIFY',
-                    'REGEXP',
-                    'REVOKE',
-                    'RIGHT',
-                    'RLIKE',
-                    'ROW',
-                    'ROWS',
-                    'SAMPLE',
-                    'SCHEMA',
-                    'SELECT',
-                    'SET',
-                    'SOME',
-                    'START',
-                    'TABLE',
-                    'TABLESAMPLE',
-                    'THEN',
-                    'TO',
-                    'TRIGGER',
-                    'TRUE',
-                    'TRY_CAST',
-                    'UNION',
-                    'UNIQUE',
-                    'UPDATE',
-                    'USING',
-                    'VALUES',
-                    'VIEW',
-                    'WHEN',
-                    'WHENEVER',
-                    'WHERE',
-                    'WITH']
+def sanitise_number(data: str, default: float, allow_zero: bool = False):
+    # empty inputs use the default, invalid or non positive numbers return None, unless zero is allowed
+    data = sanitise_inputs(data)
+    if data is None:
+        return default
+    try:
+        number = float(data.strip())
+    except ValueError:
+        return None
+    return number if number > 0 or (allow_zero and number == 0) else None
+
+# built once at import, reserved_words runs for every field name and key
+reserved_list: frozenset = frozenset([
+    'ACCOUNT',
+    'ALL',
+    'ALTER',
+    'AND',
+    'ANY',
+    'AS',
+    'BETWEEN',
+    'BY',
+    'CASE',
+    'CAST',
+    'CHECK',
+    'COLUMN',
+    'CONNECT',
+    'CONNECTION',
+    'CONSTRAINT',
+    'CREATE',
+    'CROSS',
+    'CURRENT',
+    'CURRENT_DATE',
+    'CURRENT_TIME',
+    'CURRENT_TIMESTAMP',
+    'CURRENT_USER',
+    'DATABASE',
+    'DELETE',
+    'DISTINCT',
+    'DROP',
+    'ELSE',
+    'EXISTS',
+    'FALSE',
+    'FOLLOWING',
+    'FOR',
+    'FROM',
+    'FULL',
+    'GRANT',
+    'GROUP',
+    'GSCLUSTER',
+    'HAVING',
+    'ILIKE',
+    'IN',
+    'INCREMENT',
+    'INNER',
+    'INSERT',
+    'INTERSECT',
+    'INTO',
+    'IS',
+    'ISSUE',
+    'JOIN',
+    'LATERAL',
+    'LEFT',
+    'LIKE',
+    'LOCALTIME',
+    'LOCALTIMESTAMP',
+    'MINUS',
+    'NATURAL',
+    'NOT',
+    'NULL',
+    'OF',
+    'ON',
+    'OR',
+    'ORDER',
+    'ORGANIZATION',
+    'QUALIFY',
+    'REGEXP',
+    'REVOKE',
+    'RIGHT',
+    'RLIKE',
+    'ROW',
+    'ROWS',
+    'SAMPLE',
+    'SCHEMA',
+    'SELECT',
+    'SET',
+    'SOME',
+    'START',
+    'TABLE',
+    'TABLESAMPLE',
+    'THEN',
+    'TO',
+    'TRIGGER',
+    'TRUE',
+    'TRY_CAST',
+    'UNION',
+    'UNIQUE',
+    'UPDATE',
+    'USING',
+    'VALUES',
+    'VIEW',
+    'WHEN',
+    'WHENEVER',
+    'WHERE',
+    'WITH'])
 
-    # regex for valid object name
-    p = re.compile('^[A-Za-z_][A-Za-z0-9_$]{1,254}$')
+# regex for valid object name
+valid_name = re.compile('^[A-Za-z_][A-Za-z0-9_$]{1,254}$')
+
+def reserved_words(field: str, case_sensitive: bool) -> str:
     # limit to 255 chars
     field = field.strip()[:255]
 
     if case_sensitive == True:
         return f'"{field}"'
-    elif not p.match(field):
+    elif not valid_name.match(field):
         return f'"{field}"'
     elif field.upper() in reserved_list:
         return f'"{field.upper()}"'
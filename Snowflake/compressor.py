@@ -0,0 +1,162 @@
+"""
+Compressed output streams for the staged CSV files, written to a file or to an in-memory spool.
+Each codec maps to the file extension and the COPY INTO compression option Snowflake needs to read it back.
+"""
+
+import os
+import struct
+import time
+import zlib
+from collections import deque
+
+# codec: (file extension, COPY compression, default level)
+codecs: dict = {
+    'gzip': ('.gz', 'GZIP', 3),
+    'zstd': ('.zst', 'ZSTD', 3),
+    'none': ('', 'NONE', None),
+}
+
+# the codecs pyarrow compresses Parquet pages with, listed here so they are checked without importing pyarrow
+parquet_codecs: tuple = ('snappy', 'gzip', 'brotli', 'lz4', 'zstd', 'none')
+
+# codec: (lowest level, highest level), including the codecs Parquet compresses its pages with
+levels: dict = {
+    'gzip': (1, 9),
+    'zstd': (1, 22),
+}
+
+
+class ParallelGzipFile:
+    """
+    Writes one gzip member whose deflate stream is compressed as independent blocks across a thread pool, like pigz.
+    Each block is primed with the last 32 KB of the block before and ends on a byte boundary with a sync flush,
+    so the blocks join into a single valid stream that compresses almost as well as serial gzip.
+    zlib releases the GIL while compressing, so one large chunk file keeps every core busy.
+    """
+
+    block_size: int = 1024 * 1024
+    window: int = 32 * 1024
+
+    def __init__(self, file_path: str, compresslevel: int = 3, pool: object = None, workers: int = 1, sink: object = None):
+        """
+        Constructor for ParallelGzipFile.
+        :param file_path: The path of the gzip file.
+        :param compresslevel: The deflate compression level.
+        :param pool: Optional executor compressing the blocks, otherwise they are compressed on the calling thread.
+        :param workers: The number of threads in the pool, which bounds the blocks in flight.
+        :param sink: Optional binary file object written instead of the path, left open when the stream is closed.
+        """
+
+        self.compresslevel: int = compresslevel
+        self._pool = pool
+        self._max_pending: int = max(1, workers) * 2
+        self._pending: deque = deque()
+        self._buffer: bytearray = bytearray()
+        self._tail: bytes = b''
+        self._crc: int = 0
+        self._size: int = 0
+        self._file = _open(file_path, sink)
+        # magic, deflate, no flags, modification time, no extra flags, unknown OS
+        self._file.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', int(time.time())) + b'\x00\xff')
+
+    def write(self, data: bytes) -> int:
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        if len(self._buffer) >= self.block_size:
+            view = memoryview(self._buffer)
+            blocks = len(self._buffer) // self.block_size
+            for block in range(blocks):
+                self._submit(bytes(view[block * self.block_size:(block + 1) * self.block_size]))
+            view.release()
+            del self._buffer[:blocks * self.block_size]
+        return len(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            # an empty final block ends the deflate stream
+            self._file.write(zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self._file.write(struct.pack('<II', self._crc, self._size & 0xffffffff))
+        finally:
+            self._file.close()
+
+    def _submit(self, block: bytes):
+        zdict, self._tail = self._tail, block[-self.window:]
+        if not self._pool:
+            self._file.write(self._deflate(block, zdict))
+            return
+        self._pending.append(self._pool.submit(self._deflate, block, zdict))
+        # write out finished blocks in order, waiting once too many are in flight
+        while self._pending and (self._pending[0].done() or len(self._pending) > self._max_pending):
+            self._file.write(self._pending.popleft().result())
+
+    def _deflate(self, block: bytes, zdict: bytes) -> bytes:
+        if zdict:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        else:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class UnclosedFile:
+    """
+    Passes writes on to a binary file object which stays open when this stream is closed,
+    so an in-memory spool can still be read and uploaded once the file is finished.
+    """
+
+    def __init__(self, file: object):
+        self._file = file
+        self.closed: bool = False
+
+    def write(self, data: bytes) -> int:
+        return self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def close(self):
+        self.closed = True
+
+
+def _open(file_path: str, sink: object = None):
+    return UnclosedFile(sink) if sink is not None else open(file_path, 'wb')
+
+
+def open_compressed(file_path: str, codec: str, compresslevel: int = None, pool: object = None, workers: int = 1, sink: object = None):
+    """
+    Opens a binary output stream compressing with the given codec.
+    :param file_path: The path of the file.
+    :param codec: One of the keys of codecs.
+    :param compresslevel: The compression level, None for the codec default.
+    :param pool: Optional executor for compressing gzip blocks in parallel.
+    :param workers: The number of compression threads.
+    :param sink: Optional binary file object written instead of the path, e.g. an in-memory spool, left open when the stream is closed.
+    :return: A writable stream, closed to finish the file.
+    """
+
+    level = compresslevel if compresslevel is not None else codecs[codec][2]
+    if codec == 'gzip':
+        return ParallelGzipFile(file_path, level, pool, workers, sink)
+    if codec == 'zstd':
+        import zstandard
+        # zstd compresses independent blocks on its own worker threads
+        return zstandard.ZstdCompressor(level=level, threads=workers if workers > 1 else 0).stream_writer(_open(file_path, sink))
+    return _open(file_path, sink)
+
+
+def default_workers() -> int:
+    """
+    The number of compression threads, one per core.
+    """
+
+    return os.cpu_count() or 1
@@ -0,0 +1,155 @@
+"""
+Local de-duplication of the update key before the records are staged.
+Keys are indexed in memory until the index outgrows its budget, then the index moves to a SQLite file
+in the run's temp folder, so inputs of any size are de-duplicated without holding them in memory.
+"""
+
+import os
+import pickle
+import sys
+
+
+class KeyDeduplicator:
+    """
+    Keeps the first or the last record of each key.
+    Keeping the first streams the surviving records on straight away, only the keys are indexed.
+    Keeping the last holds the records until the input ends, as a later record may still replace any of them.
+    """
+
+    # index entries added between checks of the memory estimate
+    check_every: int = 4096
+
+    def __init__(self, key_indexes: list, keep: str, emit, spill_path: str, budget_bytes: int):
+        """
+        Constructor for KeyDeduplicator.
+        :param key_indexes: The positions of the key columns in each row.
+        :param keep: first or last.
+        :param emit: Callable receiving each surviving row straight away when keeping the first.
+        :param spill_path: The path of the SQLite file the index moves to once it outgrows the budget.
+        :param budget_bytes: The memory the in-memory index may use.
+        """
+
+        self.key_indexes: list = key_indexes
+        self.keep: str = keep
+        self.emit = emit
+        self.spill_path: str = spill_path
+        self.budget_bytes: int = budget_bytes
+        self.duplicates: int = 0
+        self.spilled: bool = False
+
+        self._keys: set = set()
+        self._rows: dict = {}
+        self._sequence: int = 0
+        self._db: 'sqlite3.Connection' = None
+
+    def key(self, row: list):
+        """
+        The key of a row, a tuple for composite keys.
+        """
+
+        if len(self.key_indexes) == 1:
+            return row[self.key_indexes[0]]
+        return tuple(row[index] for index in self.key_indexes)
+
+    def add(self, row: list) -> bool:
+        """
+        Indexes one row.
+        :param row: The values read from the record, owned by the caller no longer.
+        :return: True if the row was emitted straight away.
+        """
+
+        key = self.key(row)
+        if self._db:
+            return self._add_spilled(key, row)
+        if self.keep == 'first':
+            if key in self._keys:
+                self.duplicates += 1
+                return False
+            self._keys.add(key)
+            self.emit(row)
+            if not len(self._keys) % self.check_every:
+                self._check_budget(len(self._keys), sys.getsizeof(key) + 100)
+            return True
+
+        if key in self._rows:
+            self.duplicates += 1
+        self._rows[key] = row
+        if not len(self._rows) % self.check_every:
+            self._check_budget(len(self._rows), sys.getsizeof(key) + sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) + 150)
+        return False
+
+    def held(self):
+        """
+        Yields the rows held back when keeping the last, in the order their keys first arrived, then removes the spill file.
+        """
+
+        try:
+            rows, self._rows = self._rows, {}
+            yield from rows.values()
+            if self._db and self.keep == 'last':
+                for row, in self._db.execute('select row from rows order by seq'):
+                    yield pickle.loads(row)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Drops the index and deletes the spill file.
+        """
+
+        self._keys = set()
+        self._rows = {}
+        if self._db:
+            self._db.close()
+            self._db = None
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+
+    def _check_budget(self, entries: int, entry_bytes: int):
+        # the size of the entry just added stands in for the average
+        if entries * entry_bytes > self.budget_bytes:
+            self._spill()
+
+    def _spill(self):
+        import sqlite3
+        self.spilled = True
+        self._db = sqlite3.connect(self.spill_path, isolation_level=None)
+        # the index only lives for this run, so it is not made crash safe
+        self._db.execute('pragma journal_mode = off')
+        self._db.execute('pragma synchronous = off')
+        self._db.execute('begin')
+        if self.keep == 'first':
+            self._db.execute('create table keys (key blob primary key) without rowid')
+            self._db.executemany('insert into keys values (?)', ((self._encode(key),) for key in self._keys))
+            self._keys = set()
+        else:
+            self._db.execute('create table rows (key blob primary key, seq integer, row blob)')
+            self._db.executemany('insert into rows values (?, ?, ?)',
+                                 ((self._encode(key), seq, pickle.dumps(row, pickle.HIGHEST_PROTOCOL))
+                                  for seq, (key, row) in enumerate(self._rows.items())))
+            self._sequence = len(self._rows)
+            self._rows = {}
+
+    def _add_spilled(self, key, row: list) -> bool:
+        if self.keep == 'first':
+            if self._db.execute('insert or ignore into keys values (?)', (self._encode(key),)).rowcount:
+                self.emit(row)
+                return True
+            self.duplicates += 1
+            return False
+
+        # a replaced row keeps its position, as it does in memory
+        encoded = self._encode(key)
+        blob = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        if self._db.execute('update rows set row = ? where key = ?', (blob, encoded)).rowcount:
+            self.duplicates += 1
+        else:
+            self._db.execute('insert into rows values (?, ?, ?)', (encoded, self._sequence, blob))
+            self._sequence += 1
+        return False
+
+    @staticmethod
+    def _encode(key) -> bytes:
+        return pickle.dumps(key, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,118 @@
+"""
+Key range tracking for pruning the update MERGE.
+The key values are observed as records are staged, and the resulting predicates let Snowflake skip the
+micro-partitions of the target table the input cannot match.
+"""
+
+import math
+import struct
+from decimal import Decimal, InvalidOperation
+
+# Alteryx field type: conversion of the staged text to a value comparing like the Snowflake column
+converters: dict = {
+    'byte': int,
+    'int16': int,
+    'int32': int,
+    'int64': int,
+    'float': float,
+    'double': float,
+    'fixeddecimal': Decimal,
+}
+
+# types not pruned on, bool ranges prune nothing and blobs cannot be compared
+unsupported: tuple = ('bool', 'blob', 'spatialobj')
+
+
+class KeyRange:
+    """
+    Tracks the minimum, maximum and, while there are few of them, the distinct values of each key column.
+    Values are read with the accessors used for staging, so the range covers exactly the values loaded.
+    """
+
+    def __init__(self, names: list, field_types: list, getters: list, max_distinct: int = 1000, single_floats: bool = False):
+        """
+        Constructor for KeyRange.
+        :param names: The key column names as used in SQL.
+        :param field_types: The Alteryx field type of each key.
+        :param getters: The record accessor staging each key.
+        :param max_distinct: The most distinct values listed in an IN predicate, above it a range is used.
+        :param single_floats: True if float fields are staged as 32 bit floats, as Parquet stages them.
+        """
+
+        self.names: list = names
+        self.field_types: list = field_types
+        self.getters: list = getters
+        self.max_distinct: int = max_distinct
+        self.single_floats: bool = single_floats
+        self.minimums: list = [None] * len(names)
+        self.maximums: list = [None] * len(names)
+        self.distinct: list = [set() for name in names]
+        self.valid: list = [field_type not in unsupported for field_type in field_types]
+
+    def observe(self, record: object):
+        """
+        Adds the key values of one record.
+        :param record: The Alteryx record.
+        """
+
+        for index, getter in enumerate(self.getters):
+            if not self.valid[index]:
+                continue
+            value = getter(record)
+            if value is None:
+                continue
+            convert = converters.get(self.field_types[index])
+            if convert and isinstance(value, str):
+                try:
+                    value = convert(value)
+                except (ValueError, InvalidOperation):
+                    self.valid[index] = False
+                    continue
+            if isinstance(value, float) and not math.isfinite(value):
+                self.valid[index] = False
+                continue
+            if self.single_floats and self.field_types[index] == 'float':
+                # the range must hold the value as loaded, rounded to 32 bits, or rows fall just outside it
+                value = struct.unpack('f', struct.pack('f', value))[0]
+            minimum = self.minimums[index]
+            if minimum is None:
+                self.minimums[index] = self.maximums[index] = value
+            elif value < minimum:
+                self.minimums[index] = value
+            elif value > self.maximums[index]:
+                self.maximums[index] = value
+            distinct = self.distinct[index]
+            if distinct is not None:
+                distinct.add(value)
+                if len(distinct) > self.max_distinct:
+                    self.distinct[index] = None
+
+    def predicates(self, table: str) -> list:
+        """
+        The SQL conditions on the target table covering every key value observed.
+        :param table: The target table name.
+        :return: One condition per prunable key column.
+        """
+
+        conditions = []
+        for index, name in enumerate(self.names):
+            if not self.valid[index] or self.minimums[index] is None:
+                continue
+            distinct = self.distinct[index]
+            if distinct is not None and len(distinct) > 1:
+                conditions.append(f"{table}.{name} in ({', '.join(self.literal(value) for value in sorted(distinct))})")
+            else:
+                conditions.append(f'{table}.{name} between {self.literal(self.minimums[index])} and {self.literal(self.maximums[index])}')
+        return conditions
+
+    @staticmethod
+    def literal(value) -> str:
+        """
+        Formats a key value as a SQL literal.
+        """
+
+        if isinstance(value, str):
+            return "'" + value.replace('\\', '\\\\').replace("'", "''") + "'"
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
@@ -0,0 +1,184 @@
+"""
+Manifest of the chunk files of a run, kept as manifest.json in the run's temp folder.
+It records each file's size, checksum and how far it got, so a failed run can be resumed
+from its staging files instead of writing and uploading everything again.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+
+class LoadManifest:
+    """
+    The files of one run and their status: written, staged or loaded.
+    The run itself is writing until every file is sealed, then written, and finally complete or failed.
+    The manifest is saved after every change, from whichever thread made it.
+    """
+
+    file_name: str = 'manifest.json'
+
+    def __init__(self, folder: str, data: dict, persist: bool = True):
+        """
+        Constructor for LoadManifest, use create or load.
+        :param folder: The run's temp folder holding the chunk files and the manifest.
+        :param data: The manifest contents.
+        :param persist: False to only keep the manifest in memory, for runs that cannot be resumed.
+        """
+
+        self.folder: str = folder
+        self.path: str = os.path.join(folder, self.file_name)
+        self.data: dict = data
+        self.persist: bool = persist
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, folder: str, persist: bool = True, **run) -> 'LoadManifest':
+        """
+        Starts the manifest of a new run.
+        :param folder: The run's temp folder.
+        :param persist: False to only keep the manifest in memory, for runs that cannot be resumed.
+        :param run: The settings a resumed run must match, e.g. the table and columns.
+        """
+
+        manifest = cls(folder, {'run': run, 'status': 'writing', 'records': 0, 'duplicates': 0, 'files': []}, persist)
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, folder: str) -> 'LoadManifest':
+        """
+        Reads the manifest of an earlier run.
+        :param folder: The run's temp folder.
+        :return: The manifest, None if there is none or it cannot be read.
+        """
+
+        try:
+            with open(os.path.join(folder, cls.file_name)) as file:
+                return cls(folder, json.load(file))
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def find_resumable(cls, temp_dir: str, **run) -> 'LoadManifest':
+        """
+        Finds the latest failed run with the same settings whose files were all written.
+        :param temp_dir: The temp folder the runs' timestamped folders are created in.
+        :param run: The settings of this run.
+        :return: The manifest of the run to resume, None if there is none.
+        """
+
+        try:
+            folders = sorted((name for name in os.listdir(temp_dir) if name.isdigit()), key=int, reverse=True)
+        except OSError:
+            return None
+        # a JSON round trip turns tuples into lists
+        run = json.loads(json.dumps(run))
+        for name in folders:
+            manifest = cls.load(os.path.join(temp_dir, name))
+            if manifest and manifest.resumable and manifest.data['run'] == run:
+                return manifest
+        return None
+
+    @property
+    def resumable(self) -> bool:
+        """
+        True if the run failed after all its files were written, with their checksums.
+        """
+
+        return (self.data['status'] == 'failed' and self.data.get('sealed', False)
+                and all(entry.get('md5') for entry in self.data['files']))
+
+    @property
+    def file_paths(self) -> list:
+        return [os.path.join(self.folder, entry['file']) for entry in self.data['files']]
+
+    def entries(self, status: str) -> list:
+        """
+        The manifest entries of the files with the given status.
+        """
+
+        with self._lock:
+            return [entry for entry in self.data['files'] if entry['status'] == status]
+
+    def add_file(self, file_path: str, checksum: bool = True):
+        """
+        Records a sealed chunk file with its size and checksum.
+        :param file_path: The path of the file, in the run's temp folder.
+        :param checksum: False to skip reading the file again for its checksum, the run then cannot be resumed.
+        """
+
+        entry = {'file': os.path.basename(file_path), 'size': os.path.getsize(file_path),
+                 'md5': self.checksum(file_path) if checksum else None, 'status': 'written'}
+        with self._lock:
+            self.data['files'].append(entry)
+        self.save()
+
+    def set_file_status(self, file_path: str, status: str):
+        """
+        Moves a file on to staged or loaded.
+        :param file_path: The path of the file.
+        :param status: The new status.
+        """
+
+        name = os.path.basename(file_path)
+        with self._lock:
+            for entry in self.data['files']:
+                if entry['file'] == name:
+                    entry['status'] = status
+        self.save()
+
+    def set_all_status(self, status: str):
+        """
+        Moves every file on, e.g. to loaded once COPY has succeeded.
+        """
+
+        with self._lock:
+            for entry in self.data['files']:
+                entry['status'] = status
+        self.save()
+
+    def update(self, **values):
+        """
+        Sets run level values, e.g. the status and the number of records.
+        """
+
+        with self._lock:
+            self.data.update(values)
+        self.save()
+
+    def verify_file(self, entry: dict) -> bool:
+        """
+        Checks a file is still as it was written.
+        :param entry: The manifest entry of the file.
+        :return: True if the file exists with the recorded size and checksum.
+        """
+
+        file_path = os.path.join(self.folder, entry['file'])
+        return os.path.exists(file_path) and os.path.getsize(file_path) == entry['size'] and self.checksum(file_path) == entry['md5']
+
+    def save(self):
+        """
+        Writes the manifest, replacing the previous one in a single step so it is never left half written.
+        """
+
+        if not self.persist:
+            return
+        with self._lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self.data, file, indent=2)
+            os.replace(temp_path, self.path)
+
+    @staticmethod
+    def checksum(file_path: str) -> str:
+        """
+        The MD5 of a file, read in 1 MB blocks.
+        """
+
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                md5.update(block)
+        return md5.hexdigest()
@@ -0,0 +1,241 @@
+"""
+Timing and throughput metrics for a run of the Snowflake Output tool.
+Phases are timed from the Alteryx thread as well as the writer and upload threads, and every Snowflake statement
+is recorded with its query ID so the server side elapsed time can be looked up once the load is done.
+Statements submitted asynchronously are timed from their submission until they are seen to have finished.
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class RunMetrics:
+    """
+    Accumulates the time, rows and bytes of each phase of a run.
+    Phases on the background threads overlap with receiving records, so their times do not add up to the total.
+    """
+
+    # the order phases are summarised in, following the flow of a run
+    order: tuple = ('receive', 'dedup', 'sort', 'batch', 'writer_wait', 'compress', 'upload_wait', 'connect', 'setup', 'put', 'drain',
+                    'resize', 'truncate', 'insert', 'copy', 'merge', 'suspend')
+    # the first and longest wait between polls of an asynchronous statement, in seconds
+    poll_seconds: tuple = (0.05, 1.0)
+
+    def __init__(self):
+        """
+        Constructor for RunMetrics.
+        """
+
+        self.phases: dict = {}
+        self.queries: list = []
+        self.started: float = time.time()
+        self._lock = threading.Lock()
+        # query ID: (submitted at, query entry) of the asynchronous statements not waited for yet
+        self._pending: dict = {}
+
+    def add(self, phase: str, seconds: float, rows: int = 0, size: int = 0):
+        """
+        Adds one timed step to a phase, safe to call from any thread.
+        :param phase: The name of the phase.
+        :param seconds: The wall time of the step.
+        :param rows: The records processed by the step.
+        :param size: The bytes processed by the step.
+        """
+
+        with self._lock:
+            entry = self.phases.setdefault(phase, {'seconds': 0.0, 'count': 0, 'rows': 0, 'bytes': 0})
+            entry['seconds'] += seconds
+            entry['count'] += 1
+            entry['rows'] += rows
+            entry['bytes'] += size
+
+    @contextmanager
+    def timer(self, phase: str, rows: int = 0, size: int = 0):
+        """
+        Times the enclosed block as one step of a phase.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, rows, size)
+
+    def execute(self, con: object, sql: str, phase: str, size: int = 0, **kwargs) -> object:
+        """
+        Executes a Snowflake statement, recording its query ID and client side time.
+        :param con: The Snowflake connection.
+        :param sql: The statement.
+        :param phase: The phase the statement belongs to.
+        :param size: The bytes the statement transfers, e.g. the file size for PUT.
+        :param kwargs: Further arguments for the cursor, e.g. file_stream to PUT from memory.
+        :return: The cursor, for fetching results.
+        """
+
+        cursor = con.cursor()
+        start = time.perf_counter()
+        try:
+            cursor.execute(sql, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(phase, seconds, size=size)
+            with self._lock:
+                self.queries.append({'phase': phase, 'query_id': cursor.sfqid, 'seconds': round(seconds, 3), 'statement': sql[:200]})
+            logging.info(f'{phase} query {cursor.sfqid} took {seconds:.2f}s')
+        return cursor
+
+    def execute_async(self, con: object, sql: str, phase: str) -> object:
+        """
+        Submits a Snowflake statement without waiting for it, recording its query ID. Its time is recorded by wait.
+        :param con: The Snowflake connection.
+        :param sql: The statement.
+        :param phase: The phase the statement belongs to.
+        :return: The cursor, to pass to wait.
+        """
+
+        cursor = con.cursor()
+        start = time.perf_counter()
+        cursor.execute_async(sql)
+        query = {'phase': phase, 'query_id': cursor.sfqid, 'seconds': None, 'statement': sql[:200], 'async': True}
+        with self._lock:
+            self.queries.append(query)
+            self._pending[cursor.sfqid] = (start, query)
+        logging.info(f'{phase} query {cursor.sfqid} submitted')
+        return cursor
+
+    def wait(self, con: object, cursor: object, accepted: bool = False) -> object:
+        """
+        Polls a statement submitted by execute_async until it has finished, raising its error if it failed, and fetches its results.
+        The cursor of a statement which was executed, or already waited for, is returned as it is.
+        :param con: The Snowflake connection.
+        :param cursor: The cursor returned by execute_async or execute.
+        :param accepted: True to only wait until Snowflake has taken the statement on, leaving it running.
+        :return: The cursor, for fetching results.
+        """
+
+        with self._lock:
+            start, query = self._pending.pop(cursor.sfqid, (None, None))
+        if query is None:
+            return cursor
+        delay = self.poll_seconds[0]
+        try:
+            while True:
+                status = con.get_query_status_throw_if_error(cursor.sfqid)
+                # a statement Snowflake has no status for yet has not been taken on
+                if not con.is_still_running(status) or (accepted and status.name != 'NO_DATA'):
+                    break
+                time.sleep(delay)
+                delay = min(delay * 1.5, self.poll_seconds[1])
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(query['phase'], seconds)
+            query['seconds'] = round(seconds, 3)
+            logging.info(f"{query['phase']} query {cursor.sfqid} {'was accepted after' if accepted else 'took'} {seconds:.2f}s")
+        if accepted:
+            query['detached'] = True
+        else:
+            cursor.get_results_from_sfqid(cursor.sfqid)
+        return cursor
+
+    def executemany(self, con: object, sql: str, rows: list, phase: str) -> object:
+        """
+        Executes a Snowflake statement once for each row of parameters, as a single array bound statement, recording it like execute.
+        :param con: The Snowflake connection.
+        :param sql: The statement, with a ? placeholder per value.
+        :param rows: The parameters, a sequence of values per row.
+        :param phase: The phase the statement belongs to.
+        :return: The cursor.
+        """
+
+        cursor = con.cursor()
+        start = time.perf_counter()
+        try:
+            cursor.executemany(sql, rows)
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(phase, seconds, len(rows))
+            with self._lock:
+                self.queries.append({'phase': phase, 'query_id': cursor.sfqid, 'seconds': round(seconds, 3), 'statement': sql[:200]})
+            logging.info(f'{phase} query {cursor.sfqid} with {len(rows):,} rows took {seconds:.2f}s')
+        return cursor
+
+    def fetch_server_times(self, con: object):
+        """
+        Adds Snowflake's own elapsed, compilation, queued and execution times to the recorded queries.
+        Failures are only logged as the load has already succeeded.
+        :param con: The Snowflake connection which ran the queries, as the history is read for its session.
+        """
+
+        query_ids = [query['query_id'] for query in self.queries if query['query_id']]
+        if not query_ids:
+            return
+        try:
+            cursor = con.cursor()
+            cursor.execute('select query_id, total_elapsed_time, compilation_time, queued_provisioning_time + queued_overload_time, execution_time '
+                           'from table(information_schema.query_history_by_session(result_limit => 10000)) '
+                           f"where query_id in ({', '.join(repr(query_id) for query_id in query_ids)})")
+            server_times = {row[0]: row[1:] for row in cursor.fetchall()}
+        except Exception as e:
+            logging.warning(f'Unable to read the query history: {e}')
+            return
+        for query in self.queries:
+            if query['query_id'] in server_times:
+                query['server_ms'], query['compilation_ms'], query['queued_ms'], query['execution_ms'] = server_times[query['query_id']]
+
+    def summary(self) -> list:
+        """
+        A concise summary of the phases for the Alteryx messages.
+        :return: A list of message lines.
+        """
+
+        parts = []
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: self.order.index(item[0]) if item[0] in self.order else len(self.order))
+        for phase, entry in phases:
+            # steps taking under a twentieth of a second are left to the metrics file
+            if entry['seconds'] < 0.05 and phase != 'receive':
+                continue
+            part = f"{phase} {entry['seconds']:,.1f}s"
+            if entry['bytes']:
+                part += f" ({entry['bytes'] / 1048576:,.1f} MB at {entry['bytes'] / 1048576 / entry['seconds']:,.1f} MB/sec)"
+            elif entry['rows']:
+                part += f" ({entry['rows'] / entry['seconds']:,.0f} records/sec)"
+            parts.append(part)
+        lines = [f"Timings: {', '.join(parts)}"]
+        server = {}
+        for query in self.queries:
+            if 'server_ms' in query:
+                server[query['phase']] = server.get(query['phase'], 0) + query['server_ms']
+        if any(ms >= 50 for ms in server.values()):
+            lines.append(f"Snowflake elapsed: {', '.join(f'{phase} {ms / 1000:,.1f}s' for phase, ms in server.items() if ms >= 50)}")
+        return lines
+
+    def to_dict(self, **run) -> dict:
+        """
+        The metrics as a JSON serialisable dictionary.
+        :param run: Further run level values to include, e.g. the table and record count.
+        """
+
+        with self._lock:
+            phases = {phase: dict(entry, seconds=round(entry['seconds'], 3)) for phase, entry in self.phases.items()}
+            queries = list(self.queries)
+        for entry in phases.values():
+            if entry['seconds'] and entry['rows']:
+                entry['records_per_second'] = round(entry['rows'] / entry['seconds'], 1)
+            if entry['seconds'] and entry['bytes']:
+                entry['mb_per_second'] = round(entry['bytes'] / 1048576 / entry['seconds'], 3)
+        return dict(run, started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                    finished=time.strftime('%Y-%m-%dT%H:%M:%S'), phases=phases, queries=queries)
+
+    def write(self, file_path: str, **run):
+        """
+        Writes the metrics as JSON, for collecting across scheduled runs.
+        :param file_path: The path of the metrics file.
+        :param run: Further run level values to include.
+        """
+
+        with open(file_path, 'w') as file:
+            json.dump(self.to_dict(**run), file, indent=2)
@@ -0,0 +1,202 @@
+"""
+Opt-in profiling of a run, to see where the Python time goes while records are read, batched, staged and loaded.
+The profile is written next to the run's log as a pstats file, a collapsed stack file for flamegraphs and a text summary.
+Nothing here is imported unless profiling is selected, so a run without it pays nothing.
+"""
+
+import collections
+import cProfile
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+# functions in these files are threads blocked on a queue, lock or event rather than running
+idle_files: tuple = ('threading.py', 'queue.py')
+
+
+class RunProfiler:
+    """
+    Profiles a run from start() to stop(). Sampling reads the stack of every thread at a fixed interval,
+    so its cost does not depend on how many calls the run makes, and its pstats file is built from the samples:
+    times are estimates and call counts are the number of samples a function was seen in.
+    Tracing records every call on the thread that starts it, the one Alteryx pushes records on, and samples
+    the other threads as well for the flamegraph.
+    """
+
+    modes: tuple = ('sample', 'trace')
+    # seconds between samples
+    interval: float = 0.005
+    # functions listed per table of the summary
+    top: int = 30
+
+    def __init__(self, mode: str, folder: str):
+        """
+        Constructor for RunProfiler.
+        :param mode: sample or trace.
+        :param folder: The folder the profile is written to.
+        """
+
+        self.mode: str = mode
+        self.folder: str = folder
+        self.samples: collections.Counter = collections.Counter()
+        self.sample_count: int = 0
+        self.seconds: float = 0
+
+        self._profile: cProfile.Profile = None
+        self._thread: threading.Thread = None
+        self._stop = threading.Event()
+        self._names: dict = {}
+        self._started: float = None
+
+    def start(self):
+        """
+        Starts profiling, tracing the calling thread if selected.
+        """
+
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        if self.mode == 'trace':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        """
+        Stops profiling, on the thread that started it.
+        """
+
+        if self._profile:
+            self._profile.disable()
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._started is not None:
+            self.seconds = time.perf_counter() - self._started
+
+    def write(self) -> tuple:
+        """
+        Writes profile.pstats, profile.collapsed and profile.txt to the folder.
+        :return: The paths written, and the three busiest functions as (label, share of the time profiled).
+        """
+
+        pstats_path = os.path.join(self.folder, 'profile.pstats')
+        collapsed_path = os.path.join(self.folder, 'profile.collapsed')
+        summary_path = os.path.join(self.folder, 'profile.txt')
+
+        if self._profile:
+            self._profile.dump_stats(pstats_path)
+        else:
+            with open(pstats_path, 'wb') as file:
+                marshal.dump(self.sampled_stats(), file)
+
+        # one line per distinct stack, root first, as flamegraph.pl, speedscope and inferno read them
+        with open(collapsed_path, 'w', encoding='utf-8') as file:
+            for (thread, codes), count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                file.write(';'.join([thread] + [self.label(code) for code in codes]) + f' {count}\n')
+
+        stats = pstats.Stats(pstats_path, stream=io.StringIO())
+        busiest = sorted(((self.label_func(func), entry[2]) for func, entry in stats.stats.items()
+                          if not self.idle(func)),
+                         key=lambda item: -item[1])[:3]
+        total = max(stats.total_tt, 1e-9)
+        with open(summary_path, 'w', encoding='utf-8') as file:
+            file.write(f"{'Sampled' if self.mode == 'sample' else 'Traced'} {self.seconds:.1f}s of the run, "
+                       f'{self.sample_count} samples every {self.interval * 1000:g} ms\n\n')
+            file.write('Samples per thread, running or waiting:\n')
+            for thread, (running, waiting) in sorted(self.thread_samples().items()):
+                file.write(f'  {thread:<30} {running:>8} running {waiting:>8} waiting\n')
+            for order, title in (('tottime', 'time in the function itself'), ('cumulative', 'time including calls')):
+                stream = io.StringIO()
+                pstats.Stats(pstats_path, stream=stream).sort_stats(order).print_stats(self.top)
+                file.write(f'\nBy {title}:\n{stream.getvalue()}')
+        logging.info(f'Profile written to {pstats_path}, {collapsed_path} and {summary_path}')
+        return [pstats_path, collapsed_path, summary_path], [(label, seconds / total) for label, seconds in busiest]
+
+    def sampled_stats(self) -> dict:
+        """
+        Builds pstats data from the samples, keyed by (file, line, function) with the calls, calls, own time,
+        cumulative time and callers of each function. Recursive functions count once per sample.
+        :return: The dict pstats loads.
+        """
+
+        stats = {}
+        for (thread, codes), count in self.samples.items():
+            seconds = count * self.interval
+            funcs = [self.func(code) for code in codes]
+            seen = set()
+            for depth, func in enumerate(funcs):
+                entry = stats.setdefault(func, [0, 0, 0.0, 0.0, {}])
+                leaf = depth == len(funcs) - 1
+                if func not in seen:
+                    seen.add(func)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if leaf:
+                    entry[2] += seconds
+                if depth:
+                    edge = entry[4].setdefault(funcs[depth - 1], [0, 0, 0.0, 0.0])
+                    edge[0] += count
+                    edge[1] += count
+                    edge[2] += seconds if leaf else 0
+                    edge[3] += seconds
+        return {func: (cc, nc, tt, ct, {caller: tuple(edge) for caller, edge in callers.items()})
+                for func, (cc, nc, tt, ct, callers) in stats.items()}
+
+    def thread_samples(self) -> dict:
+        """
+        Counts the samples of each thread spent running and waiting.
+        :return: A dict of thread name to (running, waiting).
+        """
+
+        threads = {}
+        for (thread, codes), count in self.samples.items():
+            running, waiting = threads.get(thread, (0, 0))
+            if self.idle(self.func(codes[-1])):
+                waiting += count
+            else:
+                running += count
+            threads[thread] = (running, waiting)
+        return threads
+
+    @staticmethod
+    def idle(func: tuple) -> bool:
+        # traced lock waits show up as the built in acquire of _thread.lock
+        return os.path.basename(func[0]) in idle_files or '_thread.' in func[2]
+
+    @staticmethod
+    def func(code) -> tuple:
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    @classmethod
+    def label(cls, code) -> str:
+        return cls.label_func(cls.func(code)).replace(';', ',')
+
+    @staticmethod
+    def label_func(func: tuple) -> str:
+        filename, line, name = func
+        return f'{name} ({os.path.basename(filename)}:{line})' if line else name
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample_count += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = self._names.get(ident)
+                if name is None:
+                    self._names = {thread.ident: thread.name for thread in threading.enumerate()}
+                    name = self._names.get(ident, str(ident))
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                self.samples[(name, tuple(codes))] += 1
@@ -0,0 +1,92 @@
+"""
+Process level pool of open Snowflake sessions.
+Alteryx runs the tools of a workflow in one engine process, so later tool instances and runs can take over
+a warm session instead of authenticating again, which saves the most with Okta.
+"""
+
+import atexit
+import hashlib
+import logging
+import threading
+import time
+
+
+class SessionPool:
+    """
+    Keeps idle Snowflake connections by account, user, warehouse and authentication.
+    A connection is used by one tool instance at a time: it is taken out of the pool while in use
+    and only handed back after a successful run.
+    """
+
+    def __init__(self, max_idle: float = 600):
+        """
+        Constructor for SessionPool.
+        :param max_idle: Seconds an idle session is kept before it is closed instead of reused.
+        """
+
+        self.max_idle: float = max_idle
+        self._idle: dict = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        Builds the pool key from the connection settings, hashed so no credentials are held in the key.
+        """
+
+        return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def acquire(self, key: str) -> object:
+        """
+        Takes an idle session out of the pool.
+        :param key: The pool key of the connection settings.
+        :return: The most recently used open session, None if there is none.
+        """
+
+        stale = []
+        con = None
+        with self._lock:
+            sessions = self._idle.get(key, [])
+            while sessions:
+                candidate, released = sessions.pop()
+                if time.time() - released < self.max_idle and not candidate.is_closed():
+                    con = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            self._close(candidate)
+        return con
+
+    def release(self, key: str, con: object):
+        """
+        Hands a session back to the pool for the next run.
+        :param key: The pool key of the connection settings.
+        :param con: The Snowflake connection, which must not be in use any more.
+        """
+
+        if con.is_closed():
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((con, time.time()))
+
+    def close_all(self):
+        """
+        Closes every idle session, called when the engine process exits.
+        """
+
+        with self._lock:
+            sessions = [con for idle in self._idle.values() for con, released in idle]
+            self._idle.clear()
+        for con in sessions:
+            self._close(con)
+
+    @staticmethod
+    def _close(con: object):
+        try:
+            con.close()
+        except Exception as e:
+            logging.warning(f'Unable to close idle Snowflake session: {e}')
+
+
+pool = SessionPool()
+atexit.register(pool.close_all)
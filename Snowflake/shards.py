@@ -0,0 +1,299 @@
+"""
+Chunk files written by several worker processes at once, so encoding and compressing the records is spread over the cores
+instead of sharing one interpreter. The Alteryx thread only reads the values of each record and hands batches of rows over,
+and each worker encodes the batches it takes as CSV into chunk files of its own, sealing each once it reaches the target size.
+"""
+
+import csv
+import io
+import multiprocessing
+import multiprocessing.spawn
+import os
+import queue
+import sys
+import threading
+import time
+
+import compressor
+from metrics import RunMetrics
+from writer import ChunkWriter, CsvChunkWriter
+
+
+def python_executable() -> str:
+    """
+    The Python interpreter the worker processes are started with.
+    Embedded interpreters, as in the Alteryx engine, report the program hosting them as sys.executable.
+    """
+
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    for candidate in (os.path.join(sys.exec_prefix, 'python.exe'), os.path.join(sys.exec_prefix, 'bin', 'python3')):
+        if os.path.exists(candidate):
+            return candidate
+    return sys.executable
+
+
+def write_shard(index: int, tasks: object, results: object, headers: list, codec: str, compresslevel: int, target_bytes: int,
+                stem: str, extension: str):
+    """
+    The worker process: encodes the batches it takes as CSV and compresses them into its own chunk files.
+    Every batch written and file sealed is reported on the results queue, ending with done or the error that stopped it.
+    :param index: The number of the worker, part of its file names.
+    :param tasks: The queue of batches, (rows, size in memory), shared by the workers and ended by a None per worker.
+    :param results: The queue the worker reports on.
+    :param headers: The field names of the staged columns.
+    :param codec: The compression codec, gzip, zstd or none.
+    :param compresslevel: The compression level, None for the codec default.
+    :param target_bytes: The compressed size a file is sealed at.
+    :param stem: The path of the chunk files without their extension.
+    :param extension: The file extension.
+    """
+
+    try:
+        buffer = io.BytesIO()
+        text = io.TextIOWrapper(buffer, encoding='utf-8', newline='')
+        writerow = csv.writer(text, delimiter='|', quoting=csv.QUOTE_MINIMAL).writerow
+        write = text.write
+        encode_row = CsvChunkWriter.encode_row
+        # as in CsvChunkWriter, empty strings and single column records are encoded by hand
+        single = len(headers) == 1
+        header = io.StringIO()
+        csv.writer(header, delimiter='|', quoting=csv.QUOTE_MINIMAL).writerow(headers)
+        header = header.getvalue().encode('utf-8')
+
+        stream = None
+        file_path: str = None
+        files: int = 0
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                break
+            rows, size = batch
+            start = time.perf_counter()
+            for row in rows:
+                if '' in row or single:
+                    write(encode_row(row))
+                else:
+                    writerow(row)
+            text.flush()
+            payload = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if stream is None:
+                file_path = f'{stem}_{index}_{files}{extension}'
+                files += 1
+                stream = compressor.open_compressed(file_path, codec, compresslevel)
+                stream.write(header)
+            stream.write(payload)
+            results.put(('written', index, size, len(payload), time.perf_counter() - start))
+            if os.path.getsize(file_path) >= target_bytes:
+                stream.close()
+                stream = None
+                results.put(('sealed', index, file_path, os.path.getsize(file_path), 0))
+        if stream:
+            stream.close()
+            results.put(('sealed', index, file_path, os.path.getsize(file_path), 0))
+        results.put(('done', index, None, 0, 0))
+    except BaseException as e:
+        # the exception is sent as text, as not every exception survives pickling
+        results.put(('error', index, f'{type(e).__name__}: {e}', 0, 0))
+
+
+class ShardedCsvWriter(ChunkWriter):
+    """
+    Buffers records as lists of values on the Alteryx thread and hands each batch to whichever worker process is free.
+    The batches are bounded by a queue, so slow workers apply back-pressure to the Alteryx thread as the single writer does.
+    Workers roll their own files over, so current_file_size stays 0 and the caller never starts a new file; open only names them.
+    Files are sealed in no particular order and the records of a file are not consecutive, which COPY, loading files
+    in parallel, does not preserve anyway. Workers are only started once the first batch is flushed, so small inputs
+    inserted directly never start them.
+    """
+
+    extension: str = '.csv.gz'
+    dialect: str = CsvChunkWriter.dialect
+
+    def __init__(self, headers: list, on_sealed=None, processes: int = 2, codec: str = 'gzip', compresslevel: int = None,
+                 target_bytes: int = 150 * 1024 * 1024, metrics: RunMetrics = None):
+        """
+        Constructor for ShardedCsvWriter.
+        :param processes: The number of worker processes.
+        :param codec: The compression codec, gzip, zstd or none.
+        :param compresslevel: The compression level, None for the codec default.
+        :param target_bytes: The compressed size each worker seals its file at.
+        """
+
+        if codec == 'zstd':
+            # only needed when compressing with zstd, fails here rather than in the workers
+            import zstandard
+        self.processes: int = processes
+        self.codec: str = codec
+        self.compresslevel: int = compresslevel
+        self.target_bytes: int = target_bytes
+        self.extension = '.csv' + compressor.codecs[codec][0]
+        super().__init__(headers, on_sealed, 1, metrics)
+        # every batch alive at once: the one buffering, one handed over, one per worker and one queued per worker
+        self.queue_size = 2 * processes + 1
+
+        self._rows: list = []
+        self._stem: str = None
+        self._workers: list = []
+        self._tasks = None
+        self._results = None
+        self._collector: threading.Thread = None
+        self._aborted: bool = False
+
+    def appender(self, fields: list, hash_rows: bool = False):
+        getters = [self.accessor(field) for field in fields]
+        append = self._rows.append
+        row_hash = self.row_hash
+
+        def append_record(record):
+            append([getter(record) for getter in getters])
+
+        def append_hashed_record(record):
+            row = [getter(record) for getter in getters]
+            row.append(row_hash(row))
+            append(row)
+        return append_hashed_record if hash_rows else append_record
+
+    def row_appender(self):
+        return self._rows.append
+
+    def buffered_rows(self) -> list:
+        return [list(row) for row in self._rows]
+
+    def file_format(self, case_sensitive: bool) -> str:
+        return CsvChunkWriter.file_format(self, case_sensitive)
+
+    @property
+    def buffered_bytes(self) -> int:
+        # the size of the last row stands in for the average, as the rows are only sized every 1024 records
+        if not self._rows:
+            return 0
+        row = self._rows[-1]
+        return len(self._rows) * (sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row))
+
+    @property
+    def current_file_size(self) -> int:
+        return 0
+
+    def open(self, file_path: str):
+        if self._stem is None:
+            self._stem = file_path[:-len(self.extension)] if file_path.endswith(self.extension) else file_path
+
+    def abort(self):
+        self._aborted = True
+        super().abort()
+
+    def _take_buffer(self) -> tuple:
+        size = self.buffered_bytes
+        # emptied in place, the appenders hold on to the list
+        rows = self._rows[:]
+        del self._rows[:]
+        return rows, size
+
+    def _payload_size(self, payload) -> int:
+        return payload[1]
+
+    def _queue_payload(self, payload):
+        self.raw_bytes += payload[1]
+        # time blocked here is back-pressure from the workers
+        with self.metrics.timer('writer_wait'):
+            self._put(('data', payload))
+
+    def _run(self):
+        # hands the batches to the workers, a hand-off of its own so pickling them overlaps with reading records
+        while True:
+            action, payload = self._queue.get()
+            if action == 'close':
+                break
+            if self.error or self._aborted:
+                # drain the queue so the producer never blocks after a failure
+                continue
+            try:
+                if not self._workers:
+                    self._start()
+                self._hand_over(payload)
+            except Exception as e:
+                self.error = e
+        self._shutdown()
+
+    def _start(self):
+        context = multiprocessing.get_context('spawn')
+        self._tasks = context.Queue(maxsize=self.processes)
+        self._results = context.Queue()
+        self._workers = [context.Process(target=write_shard, name=f'SnowflakeShard{index}', daemon=True,
+                                         args=(index, self._tasks, self._results, self.headers, self.codec, self.compresslevel,
+                                               self.target_bytes, self._stem, self.extension))
+                         for index in range(self.processes)]
+        # the executable is shared by everything spawning in the process, so it is only set while the workers start
+        previous = multiprocessing.spawn.get_executable()
+        executable = python_executable()
+        if executable != previous:
+            context.set_executable(executable)
+        try:
+            for worker in self._workers:
+                worker.start()
+        finally:
+            if executable != previous:
+                context.set_executable(previous)
+        self._collector = threading.Thread(target=self._collect, name='SnowflakeShardCollector', daemon=True)
+        self._collector.start()
+
+    def _hand_over(self, item):
+        while True:
+            try:
+                self._tasks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self.error or self._aborted:
+                    return
+                if not any(worker.is_alive() for worker in self._workers):
+                    raise RuntimeError('The writer processes have stopped')
+
+    def _collect(self):
+        done = set()
+        while len(done) < len(self._workers):
+            try:
+                kind, index, value, size, seconds = self._results.get(timeout=1)
+            except queue.Empty:
+                # a worker killed from outside never reports done
+                for index, worker in enumerate(self._workers):
+                    if index not in done and not worker.is_alive() and worker.exitcode is not None:
+                        self.error = self.error or RuntimeError(f'Writer process {index} exited with code {worker.exitcode}')
+                        done.add(index)
+                continue
+            if kind == 'written':
+                self.written_raw_bytes += value
+                self.metrics.add('compress', seconds, size=size)
+            elif kind == 'sealed':
+                self.files.append(value)
+                self.file_sizes.append(size)
+                try:
+                    if self.on_sealed:
+                        self.on_sealed(value)
+                except Exception as e:
+                    self.error = self.error or e
+            elif kind == 'error':
+                self.error = self.error or RuntimeError(f'Writer process {index} failed: {value}')
+                done.add(index)
+            else:
+                done.add(index)
+
+    def _shutdown(self):
+        if not self._workers:
+            return
+        if self._aborted or self.error:
+            for worker in self._workers:
+                worker.terminate()
+        else:
+            for worker in self._workers:
+                self._hand_over(None)
+        self._collector.join()
+        for worker in self._workers:
+            worker.join()
+        # batches or ends left over by a failed worker are dropped rather than waited on
+        self._tasks.cancel_join_thread()
+        self._tasks.close()
+        self._results.close()
+        self._workers = []
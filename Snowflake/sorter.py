@@ -0,0 +1,140 @@
+"""
+External merge sort of the records by one or more fields before they are staged, so they land in Snowflake clustered.
+Rows are sorted in memory until they outgrow their budget, then written as a sorted run to the run's temp folder,
+and the runs are merged into a single sorted stream once the input has ended.
+"""
+
+import heapq
+import os
+import pickle
+import sys
+
+from keyrange import converters
+
+
+class ExternalSorter:
+    """
+    Sorts rows ascending with nulls last, as ORDER BY does by default. Numbers staged as text are compared as numbers,
+    other values as staged, which orders dates and times as well. Rows with equal sort values keep their arrival order.
+    Runs are pickled in blocks of rows, and once there are max_runs of them they are merged into one,
+    so the files open at once stay bounded whatever the size of the input.
+    """
+
+    # rows added between checks of the memory estimate
+    check_every: int = 4096
+    # rows pickled together in a run file
+    block_rows: int = 1024
+    max_runs: int = 64
+
+    def __init__(self, key_indexes: list, field_types: list, folder: str, budget_bytes: int):
+        """
+        Constructor for ExternalSorter.
+        :param key_indexes: The positions of the sort fields in each row.
+        :param field_types: The Alteryx field type of each sort field.
+        :param folder: The folder the sorted runs are written to.
+        :param budget_bytes: The memory the rows held in memory may use.
+        """
+
+        self.key_indexes: list = key_indexes
+        self.folder: str = folder
+        self.budget_bytes: int = budget_bytes
+        self.rows: int = 0
+        self.runs: list = []
+        self.spilled_runs: int = 0
+        self.key = self.key_function(key_indexes, field_types)
+
+        self._rows: list = []
+        self._files: int = 0
+
+    @staticmethod
+    def key_function(key_indexes: list, field_types: list):
+        """
+        Builds the sort key of a row, a tuple of (is null, value) per sort field.
+        :param key_indexes: The positions of the sort fields.
+        :param field_types: The Alteryx field type of each sort field.
+        :return: A callable taking a row.
+        """
+
+        fields = [(index, converters.get(field_type)) for index, field_type in zip(key_indexes, field_types)]
+
+        def key(row):
+            return tuple((True, 0) if row[index] is None else (False, convert(row[index]) if convert else row[index])
+                         for index, convert in fields)
+        return key
+
+    def add(self, row: list):
+        """
+        Adds one row.
+        :param row: The values read from the record, owned by the caller no longer.
+        """
+
+        self._rows.append(row)
+        self.rows += 1
+        if not len(self._rows) % self.check_every:
+            # the size of the row just added stands in for the average, with room for its sort key
+            if len(self._rows) * (sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) + 150) > self.budget_bytes:
+                self._spill()
+
+    def sorted_rows(self):
+        """
+        Yields every row added in sorted order, then removes the run files.
+        """
+
+        try:
+            rows, self._rows = self._rows, []
+            rows.sort(key=self.key)
+            if not self.runs:
+                yield from rows
+            else:
+                # the rows still in memory arrived last, so they come last among equal values
+                yield from heapq.merge(*[self._read_run(path) for path in self.runs], rows, key=self.key)
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Drops the rows held and deletes the run files.
+        """
+
+        self._rows = []
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+
+    def _spill(self):
+        self._rows.sort(key=self.key)
+        self.runs.append(self._write_run(self._rows))
+        self.spilled_runs += 1
+        self._rows = []
+        if len(self.runs) >= self.max_runs:
+            runs = self.runs
+            self.runs = [self._write_run(heapq.merge(*[self._read_run(path) for path in runs], key=self.key))]
+            for path in runs:
+                os.remove(path)
+
+    def _write_run(self, rows) -> str:
+        path = os.path.join(self.folder, f'sort_{self._files}.run')
+        self._files += 1
+        block = []
+        with open(path, 'wb') as file:
+            for row in rows:
+                block.append(row)
+                if len(block) >= self.block_rows:
+                    pickle.dump(block, file, pickle.HIGHEST_PROTOCOL)
+                    block = []
+            if block:
+                pickle.dump(block, file, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    @staticmethod
+    def _read_run(path: str):
+        with open(path, 'rb') as file:
+            while True:
+                try:
+                    block = pickle.load(file)
+                except EOFError:
+                    return
+                yield from block
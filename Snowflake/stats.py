@@ -0,0 +1,154 @@
+"""
+Statistics of the staged columns, gathered while the records stream through.
+They size the columns of created tables to the data and check appended data fits an existing table
+before it is loaded.
+"""
+
+from keyrange import converters
+
+# Alteryx field types sized as NUMBER (p, 0) from the observed values
+integer_types: tuple = ('byte', 'int16', 'int32', 'int64')
+
+# Alteryx field types created as VARCHAR
+string_types: tuple = ('string', 'v_string', 'wstring', 'v_wstring')
+
+
+class ColumnStats:
+    """
+    The null count, minimum, maximum and longest value of each staged column.
+    Rows are summarised a few hundred at a time column by column, so the work is done by builtins
+    rather than by Python code per value. Text columns only track their longest value, as comparing
+    long strings for a minimum and maximum costs more than it tells.
+    """
+
+    chunk_rows: int = 512
+
+    def __init__(self, names: list, field_types: list):
+        """
+        Constructor for ColumnStats.
+        :param names: The staged column names.
+        :param field_types: The Alteryx field type of each column.
+        """
+
+        self.names: list = names
+        self.field_types: list = field_types
+        self.rows: int = 0
+        self.nulls: list = [0] * len(names)
+        self.minimums: list = [None] * len(names)
+        self.maximums: list = [None] * len(names)
+        self.max_lengths: list = [0] * len(names)
+        self._converters: list = [converters.get(field_type) for field_type in field_types]
+        self._text: list = [field_type in string_types for field_type in field_types]
+        self._rows: list = []
+
+    def add(self, row: list):
+        """
+        Adds the values of one staged row.
+        :param row: The values as staged, text for CSV and typed for Parquet.
+        """
+
+        self._rows.append(row)
+        if len(self._rows) >= self.chunk_rows:
+            self.summarise()
+
+    def summarise(self):
+        """
+        Folds the rows added since the last call into the statistics.
+        """
+
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        self.rows += len(rows)
+        for index, column in enumerate(zip(*rows)):
+            nulls = column.count(None)
+            if self._text[index]:
+                self.nulls[index] += nulls
+                # empty strings are skipped along with the nulls as they do not change the longest value
+                self.max_lengths[index] = max(self.max_lengths[index], max(map(len, filter(None, column)), default=0))
+                continue
+            if nulls:
+                self.nulls[index] += nulls
+                column = [value for value in column if value is not None]
+                if not column:
+                    continue
+            if isinstance(column[0], str):
+                self.max_lengths[index] = max(self.max_lengths[index], max(map(len, column)))
+                # numbers staged as text are compared as numbers
+                if self._converters[index]:
+                    try:
+                        column = list(map(self._converters[index], column))
+                    except (ValueError, ArithmeticError):
+                        continue
+            low, high = min(column), max(column)
+            if self.minimums[index] is None or low < self.minimums[index]:
+                self.minimums[index] = low
+            if self.maximums[index] is None or high > self.maximums[index]:
+                self.maximums[index] = high
+
+    def digits(self, index: int) -> int:
+        """
+        The number of digits of the largest absolute value of a numeric column, 0 if it only held nulls.
+        """
+
+        if self.minimums[index] is None:
+            return 0
+        return len(str(max(abs(self.minimums[index]), abs(self.maximums[index]))).split('.')[0])
+
+    def fit(self, index: int, field_type: str, size: int, scale: int) -> tuple:
+        """
+        Sizes a column to its observed values, for creating a table.
+        :param index: The column position.
+        :param field_type: The declared Alteryx field type.
+        :param size: The declared size.
+        :param scale: The declared scale.
+        :return: The field type, size and scale to create the column with.
+        """
+
+        if self.rows == self.nulls[index]:
+            return field_type, size, scale
+        if field_type in string_types:
+            return field_type, max(1, self.max_lengths[index]), scale
+        if field_type in integer_types:
+            # rendered as NUMBER (p, 0)
+            return 'fixeddecimal', max(1, self.digits(index)), 0
+        return field_type, size, scale
+
+    def check(self, columns: dict) -> list:
+        """
+        Checks the observed values fit the columns of an existing table.
+        :param columns: Column name: (data type, maximum length, precision, scale, nullable) as in information_schema.columns.
+        :return: A list of problems, empty if the data fits.
+        """
+
+        problems = []
+        for index, name in enumerate(self.names):
+            # unquoted names are stored in upper case
+            name = name.strip('"') if name.startswith('"') else name.upper()
+            column = columns.get(name)
+            if not column or not self.rows:
+                continue
+            data_type, max_length, precision, scale, nullable = column
+            if self.nulls[index] and nullable == 'NO':
+                problems.append(f'{name} has {self.nulls[index]:,} null values but does not allow nulls')
+            if data_type == 'TEXT' and max_length and self.max_lengths[index] > max_length:
+                problems.append(f'{name} has values of {self.max_lengths[index]:,} characters but is VARCHAR ({max_length})')
+            if data_type == 'NUMBER' and precision and self.field_types[index] in integer_types and self.digits(index) > precision - (scale or 0):
+                problems.append(f'{name} has values of {self.digits(index)} digits but is NUMBER ({precision}, {scale or 0})')
+        return problems
+
+    def to_dict(self) -> dict:
+        """
+        The statistics by column, for the metrics file.
+        """
+
+        return {name.strip('"'): {'nulls': self.nulls[index],
+                                  'min': self._json(self.minimums[index]),
+                                  'max': self._json(self.maximums[index]),
+                                  'max_length': self.max_lengths[index]}
+                for index, name in enumerate(self.names)}
+
+    @staticmethod
+    def _json(value):
+        # decimals are written as text
+        return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
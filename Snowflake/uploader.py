@@ -0,0 +1,186 @@
+"""
+Background upload of sealed chunk files to a Snowflake stage.
+The session is opened as soon as the uploader starts and files are PUT as soon as the writer seals them,
+so authentication and network time overlap with record delivery. Files kept in memory are PUT from their stream.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from metrics import RunMetrics
+
+
+class StageUploader:
+    """
+    Connects and uploads sealed chunk files one by one from a background thread.
+    The queue of sealed files is bounded so a slow network applies back-pressure to the writer
+    instead of filling the temp disk. A failed PUT is retried with a growing delay before the run fails.
+    """
+
+    # the default number of sealed files waiting to be uploaded
+    queue_size: int = 2
+
+    def __init__(self, connect, stage: str, prepare=None, queue_size: int = None, metrics: RunMetrics = None,
+                 on_staged=None, retries: int = 3, backoff: float = 2, slots: threading.Semaphore = None):
+        """
+        Constructor for StageUploader.
+        :param connect: Callable returning a Snowflake connection, called as soon as the thread starts.
+        :param stage: The stage the files are uploaded to, e.g. @%table.
+        :param prepare: Optional callable receiving the connection, e.g. to create the table, called once before the first upload.
+        :param queue_size: The maximum number of sealed files waiting to be uploaded.
+        :param metrics: The run metrics the PUT statements and waiting times are added to.
+        :param on_staged: Optional callable receiving the path of each file once it is uploaded.
+        :param retries: The number of times a failed PUT is retried.
+        :param backoff: Seconds before the first retry, doubled for each further retry.
+        :param slots: Optional semaphore shared by the uploaders of several inputs, limiting how many PUT at once.
+        """
+
+        self.connect = connect
+        self.stage: str = stage
+        self.on_prepare = prepare
+        self.on_staged = on_staged
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.slots: threading.Semaphore = slots
+        self.metrics: RunMetrics = metrics or RunMetrics()
+        self.con = None
+        self.files: list = []
+        self.error: Exception = None
+        # the cursors of the statements submitted from the upload thread, by phase
+        self.submitted: dict = {}
+
+        self._prepared: bool = False
+        self._aborted: bool = False
+        self._statements: list = []
+        self.queue_size: int = queue_size or self.queue_size
+        self._queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = threading.Thread(target=self._run, name='SnowflakeStageUploader', daemon=True)
+        self._thread.start()
+
+    def prepare(self):
+        """
+        Queues the prepare step, e.g. once the first records have arrived. Only the first call has an effect.
+        """
+
+        if not self._prepared:
+            self._prepared = True
+            self._queue.put(('prepare', None))
+
+    def put(self, file_path: str, stream: object = None):
+        """
+        Queues a sealed file for upload, blocking while the queue is full.
+        :param file_path: The path of the sealed chunk file, only its name is used if the file is uploaded from a stream.
+        :param stream: Optional binary file object holding the file, closed once it is uploaded.
+        """
+
+        if (self.error or self._aborted) and stream:
+            stream.close()
+        if self.error:
+            raise self.error
+        if not self._aborted:
+            self.prepare()
+            # time blocked here is back-pressure from the upload
+            with self.metrics.timer('upload_wait'):
+                self._queue.put(('put', (file_path, stream)))
+
+    def submit(self, sql: str, phase: str):
+        """
+        Has a statement submitted without waiting for it, from the upload thread before its next file or once the files are uploaded,
+        so it never runs on the connection alongside a PUT. Its cursor is in submitted once the uploader is closed.
+        :param sql: The statement.
+        :param phase: The phase the statement belongs to.
+        """
+
+        self._statements.append((sql, phase))
+
+    def close(self) -> object:
+        """
+        Waits for all queued files to be uploaded.
+        :return: The Snowflake connection used for the uploads.
+        """
+
+        self._stop()
+        if self.error:
+            raise self.error
+        return self.con
+
+    def abort(self):
+        """
+        Stops the upload thread, skipping any steps still queued.
+        """
+
+        self._aborted = True
+        self._stop()
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(('close', None))
+            self._thread.join()
+
+    def _run(self):
+        try:
+            self.con = self.connect()
+        except Exception as e:
+            self.error = e
+        while True:
+            action, payload = self._queue.get()
+            if action != 'prepare':
+                self._submit_statements()
+            if action == 'close':
+                break
+            file_path, stream = payload if action == 'put' else (None, None)
+            if self.error or self._aborted:
+                if stream:
+                    stream.close()
+                continue
+            try:
+                if action == 'prepare':
+                    if self.on_prepare:
+                        self.on_prepare(self.con)
+                    continue
+                if self.slots:
+                    self.slots.acquire()
+                try:
+                    self._put(file_path, stream)
+                finally:
+                    if self.slots:
+                        self.slots.release()
+                    if stream:
+                        stream.close()
+                self.files.append(file_path)
+                logging.info(f'Uploaded {file_path} to {self.stage}')
+                if self.on_staged:
+                    self.on_staged(file_path)
+            except Exception as e:
+                self.error = e
+
+    def _submit_statements(self):
+        while self._statements and not (self.error or self._aborted):
+            sql, phase = self._statements.pop(0)
+            try:
+                self.submitted[phase] = self.metrics.execute_async(self.con, sql, phase)
+            except Exception as e:
+                self.error = e
+
+    def _put(self, file_path: str, stream: object = None):
+        size = stream.seek(0, os.SEEK_END) if stream else os.path.getsize(file_path)
+        for attempt in range(self.retries + 1):
+            try:
+                # the files are compressed by the tool, or deliberately left uncompressed, so the connector must not gzip them again
+                sql = "PUT 'file://{0}' {1} PARALLEL=64 OVERWRITE=TRUE AUTO_COMPRESS=FALSE".format(file_path.replace('\\', '//'), self.stage)
+                if stream:
+                    # the connector names the staged file after the path and reads the content from the stream
+                    stream.seek(0)
+                    self.metrics.execute(self.con, sql, 'put', size, file_stream=stream)
+                else:
+                    self.metrics.execute(self.con, sql, 'put', size)
+                return
+            except Exception as e:
+                if attempt == self.retries or self._aborted:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f'Upload of {file_path} failed, retrying in {delay:.0f}s: {e}')
+                time.sleep(delay)
@@ -0,0 +1,140 @@
+"""
+Temporary upsizing of the warehouse for the COPY and MERGE of a run.
+Records are received and staged on the warehouse's own size, and only the server side load runs on a larger one,
+sized from the files, bytes and records staged. The original size is restored once the load is done, or has failed.
+"""
+
+import logging
+import math
+import threading
+
+from metrics import RunMetrics
+
+# warehouse sizes from smallest to largest as SHOW WAREHOUSES reports them, each size doubles the nodes of the one before
+sizes: tuple = ('X-Small', 'Small', 'Medium', 'Large', 'X-Large', '2X-Large', '3X-Large', '4X-Large', '5X-Large', '6X-Large')
+
+# further spellings ALTER WAREHOUSE accepts, without dashes
+aliases: dict = {'XXLARGE': '2XLARGE', 'X2LARGE': '2XLARGE', 'XXXLARGE': '3XLARGE', 'X3LARGE': '3XLARGE',
+                 'X4LARGE': '4XLARGE', 'X5LARGE': '5XLARGE', 'X6LARGE': '6XLARGE'}
+
+# files each node loads in parallel
+threads_per_node: int = 8
+
+# the staged bytes and records worth giving each node before adding more
+bytes_per_node: int = 1024 ** 3
+rows_per_node: int = 50000000
+
+
+def size_index(name: str) -> int:
+    """
+    The position of a warehouse size in sizes, whichever way it is spelt.
+    :param name: The size, e.g. X-Large, XLARGE or xl.
+    :return: The index, None if the name is not a warehouse size.
+    """
+
+    if not name:
+        return None
+    name = name.upper().replace('-', '').replace(' ', '').replace('_', '')
+    name = aliases.get(name, name)
+    names = [size.upper().replace('-', '') for size in sizes]
+    # short forms, e.g. XS, S, M, L, XL, 2XL
+    short = {'XS': 'XSMALL', 'S': 'SMALL', 'M': 'MEDIUM', 'L': 'LARGE', 'XL': 'XLARGE'}
+    if name in short:
+        name = short[name]
+    elif name.endswith('XL') and name[:-2].isdigit():
+        name = f'{name[:-2]}XLARGE'
+    return names.index(name) if name in names else None
+
+
+def fit(files: int, staged_bytes: int, rows: int) -> int:
+    """
+    The smallest warehouse size whose nodes can load every file at once and share out the bytes and records.
+    :param files: The number of staged files.
+    :param staged_bytes: The compressed bytes staged.
+    :param rows: The records staged.
+    :return: The index in sizes, unbounded above.
+    """
+
+    nodes = max(1, files / threads_per_node, staged_bytes / bytes_per_node, rows / rows_per_node)
+    return math.ceil(math.log2(nodes))
+
+
+class WarehouseSizer:
+    """
+    Scales the warehouse up for the loads of a run and back down once the last of them is done.
+    Shared by the inputs of the tool, so several loads running at once upsize the warehouse once and restore it once.
+    ALTER WAREHOUSE needs MODIFY, failing to resize is only logged as the load still succeeds on the original size.
+    """
+
+    def __init__(self, warehouse: str, maximum: int):
+        """
+        Constructor for WarehouseSizer.
+        :param warehouse: The warehouse name.
+        :param maximum: The index in sizes of the largest size to scale up to.
+        """
+
+        self.warehouse: str = warehouse
+        self.maximum: int = maximum
+        self.original: int = None
+        self.current: int = None
+        self.largest: int = None
+        self._users: int = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, con: object, target: int, metrics: RunMetrics) -> str:
+        """
+        Upsizes the warehouse for one load, waiting until the new size is provisioned. Each call must be matched by release.
+        :param con: The Snowflake connection.
+        :param target: The index in sizes the load would like, capped at the maximum.
+        :param metrics: The run metrics the statements are added to.
+        :return: The size the warehouse was scaled to, None if it was left as it is.
+        """
+
+        with self._lock:
+            self._users += 1
+            try:
+                if self.original is None:
+                    name = self.warehouse.strip('"')
+                    cursor = metrics.execute(con, f"show warehouses like '{name}'", 'resize')
+                    # LIKE treats _ as a wildcard, so the name is matched exactly, name, state, type, size, ...
+                    row = next((row for row in cursor.fetchall() if row[0].upper() == name.upper()), None)
+                    self.original = self.current = size_index(row[3]) if row else None
+                target = min(target, self.maximum)
+                if self.current is None or target <= self.current:
+                    return None
+                metrics.execute(con, f"alter warehouse {self.warehouse} set warehouse_size = '{sizes[target].upper()}' wait_for_completion = true", 'resize')
+                self.current = self.largest = target
+                logging.info(f'Scaled warehouse {self.warehouse} up from {sizes[self.original]} to {sizes[target]}')
+                return sizes[target]
+            except Exception as e:
+                logging.warning(f'Unable to scale warehouse {self.warehouse} up: {e}')
+                return None
+
+    def release(self, con: object, metrics: RunMetrics) -> str:
+        """
+        Ends one load, restoring the original size once no load needs the larger one.
+        :param con: The Snowflake connection.
+        :param metrics: The run metrics the statement is added to.
+        :return: The size restored, None if nothing was restored.
+        """
+
+        with self._lock:
+            self._users -= 1
+            if self._users or self.current == self.original:
+                return None
+            try:
+                metrics.execute(con, f"alter warehouse {self.warehouse} set warehouse_size = '{sizes[self.original].upper()}'", 'resize')
+                self.current = self.original
+                logging.info(f'Restored warehouse {self.warehouse} to {sizes[self.original]}')
+                return sizes[self.original]
+            except Exception as e:
+                logging.warning(f'Unable to restore warehouse {self.warehouse} to {sizes[self.original]}: {e}')
+                raise
+
+    def to_dict(self) -> dict:
+        """
+        The original and largest size of the run, for the metrics file.
+        """
+
+        return {'original': sizes[self.original] if self.original is not None else None,
+                'upsized_to': sizes[self.largest] if self.largest is not None else None}
@@ -0,0 +1,602 @@
+"""
+Streaming writers for the chunk files staged to Snowflake.
+Records are buffered and encoded on the Alteryx callback thread and handed to a background thread
+which owns the open compressed stream, so compression overlaps with record delivery.
+"""
+
+import csv
+import hashlib
+import io
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+import compressor
+from metrics import RunMetrics
+
+# characters a staged CSV value is quoted for, empty strings are quoted too
+csv_special = re.compile(r'[|"\r\n]')
+
+# one staged CSV value and the delimiter or line end after it, quoted values keep their quotes doubled
+csv_field = re.compile(r'(?:"((?:[^"]|"")*)"|([^|\r\n]*))(\||\r\n|\Z)')
+
+
+class ChunkWriter:
+    """
+    Base class keeping one output stream open per chunk file and writing encoded batches into it from a background thread.
+    The hand-off queue is bounded so a slow disk applies back-pressure instead of buffering everything in memory.
+    Files are written to disk, or to in-memory spools which only move to disk once they outgrow their share of memory.
+    Subclasses implement the record buffer on the caller thread and the stream handling on the writer thread.
+    """
+
+    extension: str = ''
+    null_value = None
+    # True if the accessors read every value as text
+    text_values: bool = True
+
+    def __init__(self, headers: list, on_sealed=None, queue_size: int = 4, metrics: RunMetrics = None, spool_bytes: int = None):
+        """
+        Constructor for ChunkWriter.
+        :param headers: The field names of the staged columns.
+        :param on_sealed: Optional callable receiving the path of each file once it is sealed, called from the writer thread.
+        :param queue_size: The maximum number of encoded batches waiting to be written.
+        :param metrics: The run metrics the batching, waiting and compression times are added to.
+        :param spool_bytes: Keep each file in memory up to this size, spilling to the file's folder beyond it, None to write files to disk.
+        """
+
+        self.headers: list = headers
+        self.on_sealed = on_sealed
+        self.queue_size: int = queue_size
+        self.metrics: RunMetrics = metrics or RunMetrics()
+        self.spool_bytes: int = spool_bytes
+        # the sealed in-memory files by path, taken over by whoever uploads them
+        self.spools: dict = {}
+        self.spilled_files: int = 0
+        self.files: list = []
+        self.file_sizes: list = []
+        self.file_raw_bytes: list = []
+        self.rows: int = 0
+        self.raw_bytes: int = 0
+        self.written_raw_bytes: int = 0
+        self.peak_buffer_bytes: int = 0
+        self.error: Exception = None
+
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, name='SnowflakeChunkWriter', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def accessor(field: object):
+        """
+        Picks the record accessor used to read a field's values for this format.
+        :param field: The Alteryx field.
+        :return: The bound accessor, called with the record.
+        """
+
+        return field.get_as_string
+
+    def appender(self, fields: list, hash_rows: bool = False):
+        """
+        Builds the function buffering one record, compiled once per schema.
+        :param fields: The Alteryx fields of the incoming connection.
+        :param hash_rows: True to add a hash of the record's values as the last column, the headers must include it.
+        :return: A callable taking a record.
+        """
+
+        raise NotImplementedError
+
+    def reader(self, fields: list, hash_rows: bool = False):
+        """
+        Builds the function reading one record into a list of values, for records held back before they are buffered.
+        :param fields: The Alteryx fields of the incoming connection.
+        :param hash_rows: True to add a hash of the record's values as the last value.
+        :return: A callable taking a record and returning its values.
+        """
+
+        getters = [self.accessor(field) for field in fields]
+        record_hash = self.record_hash(fields)
+
+        def read_record(record):
+            return [getter(record) for getter in getters]
+
+        def read_hashed_record(record):
+            row = [getter(record) for getter in getters]
+            row.append(record_hash(record, row))
+            return row
+        return read_hashed_record if hash_rows else read_record
+
+    def row_appender(self):
+        """
+        Builds the function buffering one row returned by a reader.
+        :return: A callable taking a list of values.
+        """
+
+        raise NotImplementedError
+
+    def buffered_rows(self) -> list:
+        """
+        The records buffered since the last flush as lists of values, None for nulls, e.g. to insert them instead of staging them.
+        The values read as COPY would load them from the staged file.
+        """
+
+        raise NotImplementedError
+
+    @staticmethod
+    def row_hash(row: list) -> str:
+        """
+        A stable 64 bit hash of a record's values, stored with the row to detect changed rows on update.
+        Nulls and empty strings hash differently.
+        :param row: The values of the record as text, None for nulls.
+        :return: The hash as 16 hex characters.
+        """
+
+        return hashlib.blake2b(repr(row).encode('utf-8', 'surrogatepass'), digest_size=8).hexdigest()
+
+    def record_hash(self, fields: list):
+        """
+        Builds the function hashing one record from the text of its values, as CSV stages them,
+        so the stored hash is the same whichever staging format loaded the row.
+        :param fields: The Alteryx fields of the incoming connection.
+        :return: A callable taking a record and the values read from it, returning the hash.
+        """
+
+        row_hash = self.row_hash
+        if self.text_values:
+            return lambda record, row: row_hash(row)
+        getters = [field.get_as_string for field in fields]
+        return lambda record, row: row_hash([getter(record) for getter in getters])
+
+    def file_format(self, case_sensitive: bool) -> str:
+        """
+        The COPY INTO options loading the staged files.
+        :param case_sensitive: True if the column names were quoted to preserve case.
+        :return: The FILE_FORMAT clause and any further copy options.
+        """
+
+        raise NotImplementedError
+
+    @property
+    def buffered_bytes(self) -> int:
+        """
+        The memory held by the records buffered since the last flush.
+        """
+
+        raise NotImplementedError
+
+    @property
+    def buffer_bytes_per_row(self) -> float:
+        """
+        The average memory a buffered record takes, 0 until the first batch is flushed.
+        """
+
+        return self.bytes_per_row
+
+    @property
+    def pending_bytes(self) -> int:
+        """
+        The encoded bytes handed to the writer thread but not yet written.
+        """
+
+        return self.raw_bytes - self.written_raw_bytes
+
+    @property
+    def bytes_per_row(self) -> float:
+        """
+        The average encoded size of a row before compression, 0 until the first batch is flushed.
+        """
+
+        return self.raw_bytes / self.rows if self.rows else 0
+
+    @property
+    def compression_ratio(self) -> float:
+        """
+        The observed ratio of file bytes to encoded bytes, 0 until the first batch is written.
+        """
+
+        return sum(self.file_sizes) / self.written_raw_bytes if self.written_raw_bytes else 0
+
+    @property
+    def current_file_size(self) -> int:
+        """
+        The estimated size of the current file, including the batches still queued for the writer thread.
+        """
+
+        if not self.file_sizes:
+            return 0
+        return max(self.file_sizes[-1], int(self.file_raw_bytes[-1] * self.compression_ratio))
+
+    def open(self, file_path: str):
+        """
+        Starts a new chunk file, sealing the current one if there is one.
+        :param file_path: The path of the new chunk file.
+        """
+
+        self._put(('open', file_path))
+        self.files.append(file_path)
+        self.file_sizes.append(0)
+        self.file_raw_bytes.append(0)
+
+    def flush(self, rows: int):
+        """
+        Encodes the buffered records and queues them for the writer thread, emptying the buffer.
+        :param rows: The number of records buffered since the last flush.
+        """
+
+        self.peak_buffer_bytes = max(self.peak_buffer_bytes, self.buffered_bytes + self.pending_bytes)
+        self.rows += rows
+        start = time.perf_counter()
+        payload = self._take_buffer()
+        self.metrics.add('batch', time.perf_counter() - start, rows, self._payload_size(payload))
+        self._queue_payload(payload)
+
+    def close(self):
+        """
+        Seals the last chunk file and waits for the background thread to finish.
+        """
+
+        self._stop()
+        self._raise_error()
+
+    def abort(self):
+        """
+        Stops the background thread without passing the last file on, used when the run fails part way through.
+        """
+
+        self.on_sealed = None
+        self._stop()
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
+
+    def _stop(self):
+        if self._thread.is_alive():
+            self._queue.put(('close', None))
+            self._thread.join()
+
+    def _queue_payload(self, payload):
+        size = self._payload_size(payload)
+        self.raw_bytes += size
+        self.file_raw_bytes[-1] += size
+        # time blocked here is back-pressure from compression
+        with self.metrics.timer('writer_wait'):
+            self._put(('data', payload))
+
+    def _put(self, item: tuple):
+        self._raise_error()
+        self._queue.put(item)
+
+    def _raise_error(self):
+        if self.error:
+            raise self.error
+
+    def _take_buffer(self):
+        raise NotImplementedError
+
+    def _payload_size(self, payload) -> int:
+        return len(payload)
+
+    def _open_stream(self, file_path: str, sink: object = None):
+        raise NotImplementedError
+
+    def _write_stream(self, stream, payload):
+        stream.write(payload)
+
+    def _run(self):
+        stream = None
+        spool = None
+        file_path: str = None
+        file_index: int = -1
+        while True:
+            action, payload = self._queue.get()
+            if self.error:
+                # drain the queue so the producer never blocks after a failure
+                if action == 'close':
+                    break
+                continue
+            try:
+                if action == 'data':
+                    with self.metrics.timer('compress', size=self._payload_size(payload)):
+                        self._write_stream(stream, payload)
+                    self.written_raw_bytes += self._payload_size(payload)
+                    self.file_sizes[file_index] = spool.tell() if spool else os.path.getsize(file_path)
+                else:
+                    if stream:
+                        with self.metrics.timer('compress'):
+                            stream.close()
+                        stream = None
+                        if spool:
+                            self.file_sizes[file_index] = spool.tell()
+                            # a spool written past its share of memory has moved to a temporary file
+                            self.spilled_files += self.file_sizes[file_index] > self.spool_bytes
+                            spool.seek(0)
+                            self.spools[file_path], spool = spool, None
+                        if self.on_sealed:
+                            self.on_sealed(file_path)
+                    if action == 'open':
+                        file_path = payload
+                        file_index += 1
+                        if self.spool_bytes:
+                            import tempfile
+                            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes, dir=os.path.dirname(file_path))
+                        stream = self._open_stream(file_path, spool)
+                    else:
+                        break
+            except Exception as e:
+                self.error = e
+                if action == 'close':
+                    break
+        if stream:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        if spool:
+            spool.close()
+
+
+class CsvChunkWriter(ChunkWriter):
+    """
+    Writes pipe delimited CSV into one compressed stream per chunk file, with the field names as the first row.
+    Records are encoded to UTF-8 as they arrive into a single byte buffer, so a buffered record costs
+    its encoded size rather than a Python string per value.
+    Values are only quoted when they hold a delimiter, quote or line break. Nulls are written as empty fields
+    and empty strings as "", so COPY tells them apart without a null marker that real text could match.
+    """
+
+    extension: str = '.csv.gz'
+    # recorded in the manifest, so runs staged in another dialect are not resumed with this file format
+    dialect: str = 'minimal'
+
+    def __init__(self, headers: list, on_sealed=None, codec: str = 'gzip', compresslevel: int = None, workers: int = None,
+                 queue_size: int = 4, metrics: RunMetrics = None, spool_bytes: int = None):
+        """
+        Constructor for CsvChunkWriter.
+        :param codec: The compression codec, gzip, zstd or none.
+        :param compresslevel: The compression level, None for the codec default.
+        :param workers: The number of compression threads, defaults to one per core.
+        """
+
+        if codec == 'zstd':
+            # only needed when compressing with zstd, fails here rather than on the writer thread
+            import zstandard
+        self.codec: str = codec
+        self.compresslevel: int = compresslevel
+        self.workers: int = workers or compressor.default_workers()
+        self.extension = '.csv' + compressor.codecs[codec][0]
+        self._pool = None
+        if codec == 'gzip' and self.workers > 1:
+            # loaded with the first writer rather than with the plugin, which metadata refreshes also load
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='SnowflakeCompress')
+        super().__init__(headers, on_sealed, queue_size, metrics, spool_bytes)
+
+        self._buffer = io.BytesIO()
+        self._text = io.TextIOWrapper(self._buffer, encoding='utf-8', newline='')
+        self._writerow = csv.writer(self._text, delimiter='|', quoting=csv.QUOTE_MINIMAL).writerow
+        # csv quotes the value of a single column record when it is empty, so such records are encoded by hand too
+        self._single: bool = len(self.headers) == 1
+
+    def appender(self, fields: list, hash_rows: bool = False):
+        getters = [self.accessor(field) for field in fields]
+        writerow = self._writerow
+        write = self._text.write
+        encode_row = self.encode_row
+        single = self._single
+        row_hash = self.row_hash
+
+        # csv writes nulls and empty strings alike, so the few records holding an empty string are encoded by hand
+        def append_record(record):
+            row = [getter(record) for getter in getters]
+            if '' in row or single:
+                write(encode_row(row))
+            else:
+                writerow(row)
+
+        def append_hashed_record(record):
+            row = [getter(record) for getter in getters]
+            row.append(row_hash(row))
+            if '' in row:
+                write(encode_row(row))
+            else:
+                writerow(row)
+        return append_hashed_record if hash_rows else append_record
+
+    def row_appender(self):
+        writerow = self._writerow
+        write = self._text.write
+        encode_row = self.encode_row
+        single = self._single
+
+        def append_row(row):
+            if '' in row or single:
+                write(encode_row(row))
+            else:
+                writerow(row)
+        return append_row
+
+    @staticmethod
+    def encode_row(row: list) -> str:
+        """
+        Encodes one record as the csv writer does, but with empty strings quoted.
+        :param row: The values as text, None for nulls.
+        :return: The CSV line.
+        """
+
+        return '|'.join('' if value is None else '"' + value.replace('"', '""') + '"' if not value or csv_special.search(value) else value
+                        for value in row) + '\r\n'
+
+    @staticmethod
+    def decode_rows(text: str) -> list:
+        """
+        Reads encoded records back as COPY loads them, empty fields as nulls and "" as empty strings.
+        :param text: The CSV lines.
+        :return: The records as lists of values.
+        """
+
+        rows, row, position = [], [], 0
+        while position < len(text):
+            match = csv_field.match(text, position)
+            quoted, value, end = match.groups()
+            row.append(quoted.replace('""', '"') if quoted is not None else value or None)
+            position = match.end()
+            if end != '|':
+                rows.append(row)
+                row = []
+        return rows
+
+    def buffered_rows(self) -> list:
+        self._text.flush()
+        return self.decode_rows(self._buffer.getvalue().decode('utf-8'))
+
+    def file_format(self, case_sensitive: bool) -> str:
+        # unquoted empty fields load as nulls, and backslashes are loaded as they are rather than as escapes
+        return (f"""FILE_FORMAT = (TYPE=CSV FIELD_DELIMITER='|' FIELD_OPTIONALLY_ENCLOSED_BY='"' EMPTY_FIELD_AS_NULL=TRUE NULL_IF=() """
+                f"""ESCAPE_UNENCLOSED_FIELD=NONE COMPRESSION={compressor.codecs[self.codec][1]} SKIP_HEADER=1)""")
+
+    @property
+    def buffered_bytes(self) -> int:
+        # excludes the few KB still held by the text wrapper
+        return self._buffer.tell()
+
+    def open(self, file_path: str):
+        super().open(file_path)
+        header = io.StringIO()
+        csv.writer(header, delimiter='|', quoting=csv.QUOTE_MINIMAL).writerow(self.headers)
+        self._queue_payload(header.getvalue().encode('utf-8'))
+
+    def _take_buffer(self) -> bytes:
+        self._text.flush()
+        payload = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return payload
+
+    def _stop(self):
+        super()._stop()
+        if self._pool:
+            self._pool.shutdown()
+
+    def _open_stream(self, file_path: str, sink: object = None):
+        return compressor.open_compressed(file_path, self.codec, self.compresslevel, self._pool, self.workers, sink)
+
+
+class ParquetChunkWriter(ChunkWriter):
+    """
+    Writes typed Parquet files, one row group per batch, loaded with MATCH_BY_COLUMN_NAME.
+    Values are read with typed accessors so numbers and booleans are never formatted as text.
+    Dates, times and fixed decimals stay as text and are cast by Snowflake on load.
+    """
+
+    extension: str = '.parquet'
+    text_values: bool = False
+
+    # Alteryx field type: (record accessor, Arrow type)
+    field_types: dict = {
+        'bool': ('get_as_bool', 'bool_'),
+        'byte': ('get_as_int32', 'int32'),
+        'int16': ('get_as_int32', 'int32'),
+        'int32': ('get_as_int32', 'int32'),
+        'int64': ('get_as_int64', 'int64'),
+        'float': ('get_as_double', 'float32'),
+        'double': ('get_as_double', 'float64'),
+    }
+
+    def __init__(self, headers: list, field_types: list, on_sealed=None, compression: str = 'snappy', compresslevel: int = None,
+                 queue_size: int = 4, metrics: RunMetrics = None, spool_bytes: int = None):
+        """
+        Constructor for ParquetChunkWriter.
+        :param headers: The column names, matched by name against the table columns.
+        :param field_types: The Alteryx field type of each column.
+        :param compression: The Parquet compression codec.
+        :param compresslevel: The compression level, None for the codec default.
+        """
+
+        # only needed when staging as Parquet
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.compression: str = compression
+        self.compresslevel: int = compresslevel
+        self.schema = pyarrow.schema([(header, getattr(pyarrow, self.field_types.get(field_type, (None, 'string'))[1])())
+                                      for header, field_type in zip(headers, field_types)])
+        super().__init__(headers, on_sealed, queue_size, metrics, spool_bytes)
+
+        # typed values are buffered per column, their memory is estimated from a sample of each batch
+        self._columns: list = [[] for header in headers]
+        self._row_memory: float = 0
+
+    @classmethod
+    def accessor(cls, field: object):
+        return getattr(field, cls.field_types.get(str(field.type), ('get_as_string', None))[0])
+
+    def appender(self, fields: list, hash_rows: bool = False):
+        # each accessor is paired with the append of its column list so there is no indexing per value
+        pairs = [(column.append, self.accessor(field)) for field, column in zip(fields, self._columns)]
+
+        def append_record(record):
+            for append, getter in pairs:
+                append(getter(record))
+
+        if not hash_rows:
+            return append_record
+
+        # the hash needs the whole row, so values are read first and then appended
+        getters = [getter for append, getter in pairs]
+        appends = [append for append, getter in pairs]
+        append_hash = self._columns[-1].append
+        record_hash = self.record_hash(fields)
+
+        def append_hashed_record(record):
+            row = [getter(record) for getter in getters]
+            for append, value in zip(appends, row):
+                append(value)
+            append_hash(record_hash(record, row))
+        return append_hashed_record
+
+    def row_appender(self):
+        appends = [column.append for column in self._columns]
+
+        def append_row(row):
+            for append, value in zip(appends, row):
+                append(value)
+        return append_row
+
+    def buffered_rows(self) -> list:
+        return [list(row) for row in zip(*self._columns)]
+
+    def file_format(self, case_sensitive: bool) -> str:
+        return f"FILE_FORMAT = (TYPE=PARQUET) MATCH_BY_COLUMN_NAME={'CASE_SENSITIVE' if case_sensitive else 'CASE_INSENSITIVE'}"
+
+    @property
+    def buffered_bytes(self) -> int:
+        return int(len(self._columns[0]) * self._row_memory) if self._columns else 0
+
+    @property
+    def buffer_bytes_per_row(self) -> float:
+        return self._row_memory
+
+    def _take_buffer(self):
+        rows = len(self._columns[0]) if self._columns else 0
+        if rows:
+            # a list slot plus the value object for a sample of up to 100 records
+            sample = range(0, rows, max(1, rows // 100))
+            self._row_memory = sum(8 + sys.getsizeof(column[row]) for column in self._columns for row in sample) / len(sample)
+        payload = self.pa.Table.from_arrays([self.pa.array(column, type=field.type) for column, field in zip(self._columns, self.schema)], schema=self.schema)
+        for column in self._columns:
+            del column[:]
+        return payload
+
+    def _open_stream(self, file_path: str, sink: object = None):
+        # a file object passed to pyarrow is left open when the writer is closed
+        return self.pq.ParquetWriter(sink if sink is not None else file_path, self.schema, compression=self.compression, compression_level=self.compresslevel)
+
+    def _payload_size(self, payload) -> int:
+        return payload.nbytes
+
+    def _write_stream(self, stream, payload):
+        stream.write_table(payload)
@@ -0,0 +1,467 @@
+"""
+Offline benchmark for the Snowflake Output tool.
+Drives AyxPlugin and IncomingInterface end to end through pi_init, ii_init, ii_push_record and ii_close
+with stand-ins for the Alteryx SDK and the Snowflake connector, so the local pipeline (encoding, compression,
+chunking, staging) can be measured without an Alteryx install or a Snowflake account.
+
+Usage:
+    python benchmarks/bench_output.py --schema all --rows 100000
+    python benchmarks/bench_output.py --schema strings --rows 20000 --verify
+    python benchmarks/bench_output.py --schema narrow --inputs 4 --latency 0.5
+"""
+
+import argparse
+import json
+import operator
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from decimal import Decimal
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKES = os.path.join(HERE, 'fakes')
+PLUGIN = os.path.join(os.path.dirname(HERE), 'Snowflake')
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789      '
+# delimiters, quotes, line breaks and multi-byte characters which the staging format has to survive
+SPECIAL = ALPHABET + '|"\'\n\r,;\\\t' + 'éüß€中文'
+
+# name: list of (field type, size, scale, column count)
+SCHEMAS: dict = {
+    'narrow': [('int64', 8, 0, 1), ('v_wstring', 50, 0, 1), ('double', 8, 0, 1), ('date', 10, 0, 1)],
+    'wide': [('int64', 8, 0, 1)] + [('int64', 8, 0, 80), ('double', 8, 0, 80), ('v_wstring', 50, 0, 80),
+                                    ('date', 10, 0, 80), ('bool', 1, 0, 79)],
+    'strings': [('int64', 8, 0, 1), ('v_wstring', 20, 0, 10), ('v_wstring', 200, 0, 15), ('v_wstring', 2000, 0, 4),
+                ('v_string', 32, 0, 10)],
+    'numeric': [('int64', 8, 0, 1), ('int64', 8, 0, 10), ('int32', 4, 0, 10), ('int16', 2, 0, 5), ('double', 8, 0, 15),
+                ('fixeddecimal', 19, 4, 5), ('bool', 1, 0, 4)],
+}
+
+
+class Engine:
+    """
+    Stand-in for AlteryxEngine, collecting the messages the tool sends.
+    """
+
+    def __init__(self, temp_path: str):
+        self.temp_path: str = temp_path
+        self.messages: list = []
+        self.errors: list = []
+
+    def get_init_var(self, n_tool_id: int, str_init_var: str) -> str:
+        return {'TempPath': self.temp_path}.get(str_init_var, 'False')
+
+    def output_message(self, n_tool_id: int, message_type: str, message: str):
+        self.messages.append((message_type, message))
+        if message_type == 'error':
+            self.errors.append(message)
+
+    def output_tool_progress(self, n_tool_id: int, d_percent: float):
+        pass
+
+
+class Field:
+    """
+    Stand-in for an Alteryx Field. Records are tuples holding the typed values followed by their string
+    forms, so every accessor is a C level itemgetter and the harness adds little to the measured time.
+    """
+
+    def __init__(self, name: str, field_type: str, size: int, scale: int, index: int, num_fields: int):
+        self.name: str = name
+        self.type: str = field_type
+        self.size: int = size
+        self.scale: int = scale
+        self.get_as_string = operator.itemgetter(num_fields + index)
+        self.get_as_int32 = self.get_as_int64 = self.get_as_double = self.get_as_bool = operator.itemgetter(index)
+
+
+class RecordInfo(list):
+    """
+    Stand-in for an Alteryx RecordInfo, a list of Fields.
+    """
+
+    @property
+    def num_fields(self) -> int:
+        return len(self)
+
+
+def build_fields(schema: str) -> RecordInfo:
+    """
+    Expands a schema definition into named fields, the first being the key column id.
+    """
+
+    types = [(field_type, size, scale) for field_type, size, scale, count in SCHEMAS[schema] for i in range(count)]
+    return RecordInfo(Field('id' if i == 0 else f'{field_type}_{i}', field_type, size, scale, i, len(types))
+                      for i, (field_type, size, scale) in enumerate(types))
+
+
+def generate_value(rng: random.Random, field: Field, row: int):
+    """
+    Generates one typed value and its string form, with 5% nulls outside the key column.
+    """
+
+    if field.name == 'id':
+        return row, str(row)
+    if rng.random() < 0.05:
+        return None, None
+    if field.type == 'int64':
+        value = rng.randrange(-10 ** 12, 10 ** 12)
+    elif field.type == 'int32':
+        value = rng.randrange(-2 ** 31, 2 ** 31)
+    elif field.type == 'int16':
+        value = rng.randrange(-2 ** 15, 2 ** 15)
+    elif field.type == 'double':
+        value = round(rng.uniform(-1e6, 1e6), rng.randrange(0, 7))
+    elif field.type == 'bool':
+        value = rng.random() < 0.5
+    elif field.type == 'fixeddecimal':
+        value = f'{rng.uniform(-1e9, 1e9):.{field.scale}f}'
+    elif field.type == 'date':
+        value = f'{rng.randrange(1990, 2030)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}'
+    else:
+        alphabet = SPECIAL if field.type == 'v_wstring' and field.size >= 200 else ALPHABET
+        value = ''.join(rng.choices(alphabet, k=rng.randrange(0, min(field.size, 500) + 1)))
+        # text that a null marker could be mistaken for
+        if rng.random() < 0.01:
+            value = rng.choice(['NULL', '\\N', '""'])
+    return value, str(value)
+
+
+def build_pool(fields: RecordInfo, pool_size: int, seed: int) -> list:
+    """
+    Generates the distinct records which are cycled through during the run.
+    """
+
+    rng = random.Random(seed)
+    pool = []
+    for row in range(pool_size):
+        values = [generate_value(rng, field, row) for field in fields]
+        pool.append(tuple(value for value, text in values) + tuple(text for value, text in values))
+    return pool
+
+
+def current_rss() -> int:
+    """
+    The resident memory of this process in bytes, None if it cannot be read.
+    """
+
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss() -> int:
+    """
+    The peak resident memory of this process in bytes, None if it cannot be read.
+    """
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def config_xml(args: argparse.Namespace) -> str:
+    """
+    The tool configuration for a run, as saved by the GUI.
+    """
+
+    options = {
+        'account': 'bench', 'user': 'bench', 'password': 'drowssap', 'warehouse': 'bench_wh', 'database': 'bench_db',
+        'schema': 'public', 'table': 'bench_table', 'auth_type': 'snowflake', 'sql_type': args.mode, 'key': 'id',
+        'case_sensitive': 'False', 'delete_tempfiles': 'True', 'staging_format': args.format,
+    }
+    if args.resume:
+        options['resume'] = 'True'
+    if args.target_mb:
+        options['target_file_mb'] = str(args.target_mb)
+    if args.buffer_mb:
+        options['buffer_mb'] = str(args.buffer_mb)
+    for option in args.option:
+        name, value = option.split('=', 1)
+        options[name] = value
+    return '<Configuration>' + ''.join(f'<{name}>{value}</{name}>' for name, value in options.items()) + '</Configuration>'
+
+
+def expected_row(fields: RecordInfo, record: tuple, typed: set) -> list:
+    offset = len(fields)
+    return [record[i] if i in typed else record[offset + i] for i in range(offset)]
+
+
+def verify(fields: RecordInfo, pool: list, rows: int, account: object, staging_format: str, table: str = None,
+           sort_fields: list = None, ordered: bool = True) -> list:
+    """
+    Compares the rows loaded by the fake COPY INTO with the records pushed.
+    :param table: The table to compare, by default the only table rows were loaded into.
+    :param sort_fields: The fields the tool sorted the records by, in the order pushed otherwise.
+    :param ordered: False to compare the rows in any order, as loaded from files written by several processes.
+    :return: A list of problems, empty if the round trip was exact.
+    """
+
+    import writer
+    if table:
+        loaded = account.tables.get(table, [])
+    else:
+        loaded = [table for table in account.tables.values() if table]
+        if len(loaded) != 1:
+            return [f'Expected one loaded table, found {len(loaded)}']
+        loaded = loaded[0]
+    problems = []
+    if len(loaded) != rows:
+        problems.append(f'Loaded {len(loaded)} rows, pushed {rows}')
+    typed = set(i for i, field in enumerate(fields) if staging_format == 'parquet' and field.type in writer.ParquetChunkWriter.field_types)
+    records = [pool[row % len(pool)] for row in range(rows)]
+    if sort_fields:
+        # ascending with nulls last, equal values in the order pushed
+        indexes = [[field.name for field in fields].index(name) for name in sort_fields]
+        records.sort(key=lambda record: tuple((record[i] is None, Decimal(record[i]) if record[i] is not None and fields[i].type == 'fixeddecimal' else record[i])
+                                              for i in indexes))
+    expected_rows = [expected_row(fields, record, typed) for record in records]
+    for expected, record in zip(expected_rows, records):
+        if loaded and len(loaded[0]) == len(expected) + 1:
+            # the row hash column added for change detection, taken from the text of the values whatever the format
+            expected.append(writer.ChunkWriter.row_hash(expected_row(fields, record, set())))
+    loaded = loaded[:rows]
+    if not ordered:
+        loaded, expected_rows = sorted(loaded, key=repr), sorted(expected_rows, key=repr)
+    for row, values in enumerate(loaded):
+        expected = expected_rows[row]
+        if values != expected:
+            diff = [(fields[i].name, expected[i], values[i] if i < len(values) else '<missing>')
+                    for i in range(len(expected)) if i >= len(values) or values[i] != expected[i]]
+            problems.append(f'Row {row} differs: {diff[:3]}')
+            if len(problems) >= 10:
+                break
+    return problems
+
+
+def run_tool(args: argparse.Namespace, fields: RecordInfo, pool: list, result: dict, run: int = 0, temp_path: str = None) -> tuple:
+    """
+    Runs one tool instance from pi_init to pi_close, adding the file and metrics measurements to the result.
+    :param run: The number of the run in this process, failures are only simulated in the first --fail-runs runs.
+    :param temp_path: The temp folder to run in, shared by the runs when resuming, otherwise a new one is removed afterwards.
+    :return: The fake account, the fake engine and the wall time of each stage.
+    """
+
+    import snowflake.connector
+    import SnowflakeEngine
+
+    fail_on = args.fail_on if args.fail_runs is None or run < args.fail_runs else None
+    account = snowflake.connector.reset(keep_stages=args.resume, put_mbps=args.put_mbps, latency=args.latency, verify=args.verify,
+                                        fail_on=fail_on, fail_times=args.fail_times)
+    owns_temp_path = temp_path is None
+    temp_path = temp_path or tempfile.mkdtemp(prefix='snowflake_bench_')
+    engine = Engine(temp_path)
+    pool_size = len(pool)
+    stages = {}
+
+    try:
+        start = time.perf_counter()
+        plugin = SnowflakeEngine.AyxPlugin(1, engine, None)
+        plugin.pi_init(config_xml(args))
+        # unnamed wires load the configured table, named wires each load their own table
+        wires = ['#1'] if args.inputs == 1 else [f'bench_table_{i}' for i in range(1, args.inputs + 1)]
+        inputs = [plugin.pi_add_incoming_connection('Input', wire) for wire in wires]
+        stages['pi_init'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for incoming in inputs:
+            incoming.ii_init(fields)
+        stages['ii_init'] = time.perf_counter() - start
+
+        # the engine pushes one input after the other
+        start = time.perf_counter()
+        for incoming in inputs:
+            push_record = incoming.ii_push_record
+            for row in range(args.rows):
+                if push_record(pool[row % pool_size]) is False:
+                    break
+        stages['ii_push_record'] = time.perf_counter() - start
+
+        # keep the chunk files until they have been measured
+        plugin.delete_tempfiles = False
+        # a later run in the same second would otherwise share the run folder
+        if args.resume:
+            time.sleep(max(0.0, 1.0 - time.time() % 1))
+        start = time.perf_counter()
+        for incoming in inputs:
+            incoming.ii_close()
+        plugin.pi_close(False)
+        stages['ii_close'] = time.perf_counter() - start
+
+        files = [file for incoming in inputs if incoming.writer for file in incoming.writer.files]
+        result['files'] = len(files)
+        sizes = [size for incoming in inputs if incoming.writer for size in incoming.writer.file_sizes]
+        # files staged from memory only have their recorded size
+        result['bytes_written'] = sum(os.path.getsize(file) if os.path.exists(file) else size for file, size in zip(files, sizes))
+        result['raw_bytes'] = sum(incoming.writer.raw_bytes for incoming in inputs if incoming.writer)
+        metrics_file = os.path.join(inputs[0].temp_dir or temp_path, 'metrics.json')
+        if os.path.exists(metrics_file):
+            with open(metrics_file) as file:
+                result['tool_metrics'] = json.load(file)
+        if args.verify and not engine.errors:
+            # a detached load may still be running
+            account.join_async()
+            # records with a repeated key are removed when de-duplicating
+            result['verify'] = []
+            for wire, incoming in zip(wires, inputs):
+                # the fake MERGE only counts rows, so updates are compared in the temporary table
+                table = (incoming.tmp_table if args.mode == 'update' else wire) if args.inputs > 1 else None
+                result['verify'] += verify(fields, pool, args.rows - getattr(incoming, 'duplicates', 0), account, args.format, table,
+                                           getattr(incoming, 'sort_keys', None), not getattr(incoming.writer, 'processes', 0))
+    finally:
+        if owns_temp_path:
+            shutil.rmtree(temp_path, ignore_errors=True)
+    return account, engine, stages
+
+
+def run_scenario(args: argparse.Namespace, schema: str) -> dict:
+    """
+    Runs one schema through the tool in this process.
+    :return: The measurements of the last run.
+    """
+
+    sys.path.insert(0, PLUGIN)
+    sys.path.insert(0, FAKES)
+
+    fields = build_fields(schema)
+    pool_size = args.pool or max(1000, min(20000, 2000000 // len(fields)))
+    pool = build_pool(fields, pool_size, args.seed)
+    result = {'schema': schema, 'format': args.format, 'mode': args.mode, 'columns': len(fields), 'rows': args.rows,
+              'baseline_rss': current_rss(), 'connections': 0, 'run_seconds': []}
+    # later runs in the same process behave like further tool instances in one engine process
+    temp_path = tempfile.mkdtemp(prefix='snowflake_bench_') if args.resume else None
+    try:
+        for run in range(args.runs):
+            account, engine, stages = run_tool(args, fields, pool, result, run, temp_path)
+            result['connections'] += account.connections
+            result['run_seconds'].append(round(sum(stages.values()), 3))
+            if engine.errors and not args.fail_on:
+                break
+    finally:
+        if temp_path:
+            shutil.rmtree(temp_path, ignore_errors=True)
+
+    result['stages'] = stages
+    result['total_seconds'] = sum(stages.values())
+    result['rows_per_second'] = args.rows * args.inputs / stages['ii_push_record'] if stages.get('ii_push_record') else 0
+    result['end_to_end_rows_per_second'] = args.rows * args.inputs / result['total_seconds'] if result['total_seconds'] else 0
+    result['peak_rss'] = peak_rss()
+    queries = {}
+    for query in account.queries:
+        summary = queries.setdefault(query['kind'], {'count': 0, 'seconds': 0.0, 'threads': set()})
+        summary['count'] += 1
+        summary['seconds'] += query['seconds']
+        summary['threads'].add(query['thread'])
+    result['queries'] = {kind: dict(summary, threads=sorted(summary['threads'])) for kind, summary in queries.items()}
+    # the sizes the warehouse was altered to, in order
+    result['warehouse_sizes'] = account.warehouse_sizes
+    result['errors'] = engine.errors
+    result['messages'] = engine.messages
+    return result
+
+
+def mb(value) -> str:
+    return '-' if value is None else f'{value / 1024 / 1024:.1f}'
+
+
+def print_report(results: list, show_messages: bool = False):
+    columns = [('schema', 8), ('cols', 5), ('rows', 9), ('rows/s', 10), ('e2e rows/s', 10), ('files', 5), ('MB raw', 8),
+               ('MB out', 7), ('peak MB', 8), ('pi_init', 7), ('ii_init', 7), ('push s', 7), ('close s', 7), ('PUT s', 6), ('COPY s', 6)]
+    print(' '.join(name.rjust(width) for name, width in columns))
+    for result in results:
+        stages = result.get('stages', {})
+        queries = result.get('queries', {})
+        values = [result['schema'], result.get('columns', ''), result['rows'], f"{result.get('rows_per_second', 0):.0f}",
+                  f"{result.get('end_to_end_rows_per_second', 0):.0f}", result.get('files', ''), mb(result.get('raw_bytes')),
+                  mb(result.get('bytes_written')), mb(result.get('peak_rss')),
+                  f"{stages.get('pi_init', 0):.3f}", f"{stages.get('ii_init', 0):.3f}", f"{stages.get('ii_push_record', 0):.2f}",
+                  f"{stages.get('ii_close', 0):.2f}", f"{queries.get('PUT', {}).get('seconds', 0):.2f}",
+                  f"{queries.get('COPY', {}).get('seconds', 0):.2f}"]
+        print(' '.join(str(value).rjust(width) for value, (name, width) in zip(values, columns)))
+    for result in results:
+        if show_messages:
+            for message_type, message in result.get('messages', []):
+                print(f"{result['schema']}: {message_type} {message}")
+        if result.get('warehouse_sizes'):
+            print(f"{result['schema']}: warehouse resized to {' then '.join(result['warehouse_sizes'])}")
+        for error in result.get('errors', []):
+            print(f"{result['schema']}: ERROR {error}")
+        if 'verify' in result:
+            print(f"{result['schema']}: round trip {'OK' if not result['verify'] else 'FAILED'}")
+            for problem in result['verify']:
+                print(f"{result['schema']}:   {problem}")
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--schema', default='all', choices=sorted(SCHEMAS) + ['all'], help='the record layout to push')
+    parser.add_argument('--rows', type=int, default=100000, help='records pushed per schema')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet'], help='the staging file format')
+    parser.add_argument('--mode', default='create', choices=['create', 'append', 'truncate', 'update'], help='the SQL type')
+    parser.add_argument('--target-mb', type=float, help='target compressed chunk file size')
+    parser.add_argument('--buffer-mb', type=float, help='buffer memory limit')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE', help='any further tool setting')
+    parser.add_argument('--put-mbps', type=float, default=0, help='simulated upload bandwidth, 0 for none')
+    parser.add_argument('--latency', type=float, default=0, help='simulated seconds per statement')
+    parser.add_argument('--fail-on', metavar='STATEMENT', help='make statements starting with this text fail, e.g. COPY')
+    parser.add_argument('--fail-times', type=int, default=0, help='only fail this many statements per run, e.g. to exercise retries')
+    parser.add_argument('--fail-runs', type=int, help='only simulate failures in this many runs, e.g. 1 to resume in the second')
+    parser.add_argument('--resume', action='store_true', help='share the temp folder across runs and resume failed runs')
+    parser.add_argument('--inputs', type=int, default=1, help='named input wires, each loading its own table of --rows records')
+    parser.add_argument('--runs', type=int, default=1, help='tool runs in one process, the last one is reported')
+    parser.add_argument('--pool', type=int, help='distinct records generated and cycled through')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--verify', action='store_true', help='decode the staged files on COPY and compare every row')
+    parser.add_argument('--messages', action='store_true', help='print the messages the tool sent to Alteryx')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(run_scenario(args, args.schema)))
+        return
+
+    # each schema runs in its own process so peak memory is measured per run
+    schemas = sorted(SCHEMAS) if args.schema == 'all' else [args.schema]
+    forwarded = [arg for arg in (argv if argv is not None else sys.argv[1:])]
+    results = []
+    for schema in schemas:
+        command = [sys.executable, os.path.abspath(__file__)] + forwarded + ['--schema', schema, '--child']
+        completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+        if completed.returncode:
+            results.append({'schema': schema, 'rows': args.rows, 'errors': [f'benchmark process exited with {completed.returncode}']})
+            continue
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print_report(results, args.messages)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if any(result.get('errors') or result.get('verify') for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Startup benchmark for the Snowflake Output tool.
+Measures, each time in a fresh process, how long importing the plugin and instantiating it take for the calls Designer makes
+without uploading anything: metadata refreshes while a workflow is edited (UpdateOnly) and runs with output disabled
+(DisableAllOutput). It also lists the heavy modules each scenario loaded, so a dependency creeping back into the startup
+path shows up. An installed Snowflake connector is used if there is one, otherwise the stand-in from the fakes folder.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 20 --tools 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKES = os.path.join(HERE, 'fakes')
+PLUGIN = os.path.join(os.path.dirname(HERE), 'Snowflake')
+
+# modules only an upload should load
+HEAVY: tuple = ('snowflake.connector', 'cryptography', 'OpenSSL', 'botocore', 'boto3', 'pyarrow', 'zstandard',
+                'concurrent.futures', 'sqlite3', 'tempfile')
+
+# scenario: the Alteryx init vars it runs with
+SCENARIOS: dict = {
+    'update_only': {'UpdateOnly': 'True'},
+    'disabled': {'DisableAllOutput': 'True'},
+}
+
+CONFIG = ('<Configuration><account>bench</account><user>bench</user><password>drowssap</password><warehouse>bench_wh</warehouse>'
+          '<database>bench_db</database><schema>public</schema><table>bench_table</table><auth_type>snowflake</auth_type>'
+          '<sql_type>create</sql_type><case_sensitive>False</case_sensitive><delete_tempfiles>True</delete_tempfiles></Configuration>')
+
+
+class Engine:
+    """
+    Stand-in for AlteryxEngine answering the init vars of a scenario.
+    """
+
+    def __init__(self, init_vars: dict):
+        self.init_vars: dict = dict(init_vars, TempPath=HERE)
+
+    def get_init_var(self, n_tool_id: int, str_init_var: str) -> str:
+        return self.init_vars.get(str_init_var, 'False')
+
+    def output_message(self, n_tool_id: int, message_type: str, message: str):
+        pass
+
+    def output_tool_progress(self, n_tool_id: int, d_percent: float):
+        pass
+
+
+def run_child(scenario: str, tools: int) -> dict:
+    """
+    Imports the plugin and takes the given number of tool instances through the scenario.
+    :return: The import and instantiation times in ms and the heavy modules loaded.
+    """
+
+    sys.path.insert(0, PLUGIN)
+    # installed packages come first, the fakes stand in for whatever is missing
+    sys.path.append(FAKES)
+    loaded = set(sys.modules)
+
+    start = time.perf_counter()
+    import SnowflakeEngine
+    import_ms = (time.perf_counter() - start) * 1000
+
+    engine = Engine(SCENARIOS[scenario])
+    start = time.perf_counter()
+    for tool_id in range(1, tools + 1):
+        plugin = SnowflakeEngine.AyxPlugin(tool_id, engine, None)
+        plugin.pi_init(CONFIG)
+        incoming = plugin.pi_add_incoming_connection('Input', '#1')
+        # metadata refreshes pass the record info and close straight away
+        incoming.ii_init([])
+        incoming.ii_close()
+        plugin.pi_close(False)
+    init_ms = (time.perf_counter() - start) * 1000
+
+    modules = [name for name in HEAVY if name in sys.modules and name not in loaded]
+    return {'import_ms': import_ms, 'init_ms': init_ms, 'heavy_modules': modules}
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', default='all', choices=sorted(SCENARIOS) + ['all'])
+    parser.add_argument('--repeat', type=int, default=10, help='fresh processes per scenario')
+    parser.add_argument('--tools', type=int, default=1, help='tool instances per process, as in a workflow with several of them')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        print(json.dumps(run_child(args.scenario, args.tools)))
+        return
+
+    scenarios = sorted(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+    results = []
+    for scenario in scenarios:
+        runs = []
+        for repeat in range(args.repeat):
+            command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario, '--tools', str(args.tools), '--child']
+            completed = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+            if completed.returncode:
+                sys.exit(f'{scenario}: benchmark process exited with {completed.returncode}')
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        results.append({'scenario': scenario, 'tools': args.tools,
+                        'import_ms': statistics.median(run['import_ms'] for run in runs),
+                        'init_ms': statistics.median(run['init_ms'] for run in runs),
+                        'max_total_ms': max(run['import_ms'] + run['init_ms'] for run in runs),
+                        'heavy_modules': sorted(set(name for run in runs for name in run['heavy_modules']))})
+
+    print(f"{'scenario':>12} {'tools':>5} {'import ms':>9} {'init ms':>8} {'max ms':>7}  heavy modules loaded")
+    for result in results:
+        print(f"{result['scenario']:>12} {result['tools']:>5} {result['import_ms']:>9.1f} {result['init_ms']:>8.2f} "
+              f"{result['max_total_ms']:>7.1f}  {', '.join(result['heavy_modules']) or '-'}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+"""
+Stand-in for the AlteryxPythonSDK module, providing only the members used by the Snowflake Output tool.
+"""
+
+
+class EngineMessageType:
+    error = 'error'
+    warning = 'warning'
+    info = 'info'
+
+
+class Status:
+    file_output = 'file_output'
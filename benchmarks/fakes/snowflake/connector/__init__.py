@@ -0,0 +1,494 @@
+"""
+Local stand-in for snowflake.connector used by the benchmark harness.
+Statements are executed against an in-process account: PUT records the file, or the content of its file_stream, on the named stage,
+gzipping files that are not already compressed unless AUTO_COMPRESS=FALSE, as Snowflake does,
+COPY INTO moves the staged files into the table, decoding them with the statement's FILE_FORMAT when
+verification is on, INSERT through executemany adds the bound rows, MERGE counts the rows of the source table,
+SHOW WAREHOUSES and ALTER WAREHOUSE read and set the size of the one warehouse. Every statement is timed and logged per thread.
+Statements submitted with execute_async run on a thread of their own, and EXECUTE IMMEDIATE blocks run their statements in turn.
+The stand-in has every call the tool makes whatever connector version is pinned, so it does not catch a pin too old for them:
+the asynchronous queries and PUT file_stream need snowflake-connector-python 2.5.0 or later.
+"""
+
+import enum
+import gzip
+import io
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+
+class Error(Exception):
+    """
+    Mirrors the attributes the tool reads from connector errors.
+    """
+
+    def __init__(self, msg: str = '', errno: int = -1, sqlstate: str = '', sfqid: str = None):
+        super().__init__(msg)
+        self.msg: str = msg
+        self.errno: int = errno
+        self.sqlstate: str = sqlstate
+        self.sfqid: str = sfqid
+
+
+class DatabaseError(Error):
+    pass
+
+
+class ProgrammingError(DatabaseError):
+    pass
+
+
+class QueryStatus(enum.Enum):
+    """
+    The statuses of an asynchronous query the tool can see, as in snowflake.connector.constants.
+    """
+
+    RUNNING = 0
+    SUCCESS = 2
+    FAILED_WITH_ERROR = 4
+    NO_DATA = 10
+
+
+class Account:
+    """
+    The state shared by every fake connection in the process.
+    """
+
+    def __init__(self, put_mbps: float = 0, latency: float = 0, verify: bool = False, fail_on: str = None, fail_times: int = 0,
+                 warehouse_size: str = 'X-Small'):
+        """
+        Constructor for Account.
+        :param put_mbps: Simulated upload bandwidth in MB/s, 0 for no delay.
+        :param latency: Simulated round trip in seconds added to every statement.
+        :param verify: True to decode the loaded files and keep their rows, otherwise only the files are counted.
+        :param fail_on: Raise a ProgrammingError for statements starting with this text.
+        :param fail_times: Only fail this many of those statements, 0 to fail them all.
+        :param warehouse_size: The size SHOW WAREHOUSES reports until it is altered.
+        """
+
+        self.put_mbps: float = put_mbps
+        self.latency: float = latency
+        self.verify: bool = verify
+        self.fail_on: str = fail_on
+        self.fail_times: int = fail_times
+        self.failures: int = 0
+        self.warehouse_size: str = warehouse_size
+        self.warehouse_sizes: list = []
+        self.stages: dict = {}
+        # the temporary tables, whose stages are dropped with the session
+        self.temporary: set = set()
+        self.tables: dict = {}
+        self.row_counts: dict = {}
+        self.columns: dict = {}
+        self.queries: list = []
+        self.connections: int = 0
+        # query ID: the thread running it, its rows and its error
+        self.async_queries: dict = {}
+        self.lock = threading.Lock()
+
+    def join_async(self):
+        """
+        Waits for the asynchronous queries, e.g. a detached load, before the tables are compared.
+        """
+
+        for query in list(self.async_queries.values()):
+            query['thread'].join()
+
+
+account = Account()
+
+
+def reset(keep_stages: bool = False, **kwargs) -> Account:
+    """
+    Replaces the shared account, called by the harness before each run.
+    :param keep_stages: True to keep the files on the stages of permanent tables, as a resumed run finds them.
+    :return: The new account.
+    """
+
+    global account
+    previous = account
+    account = Account(**kwargs)
+    if keep_stages:
+        account.stages = {name: files for name, files in previous.stages.items() if name not in previous.temporary}
+    return account
+
+
+def _name(identifier: str) -> str:
+    return identifier.strip().lower() if not identifier.startswith('"') else identifier.strip()
+
+
+def _columns(sql: str) -> dict:
+    """
+    Parses the column definitions of a CREATE TABLE statement into information_schema.columns rows.
+    """
+
+    body = sql[sql.index('(') + 1:sql.rindex(')')]
+    columns = {}
+    for definition in re.findall(r'("[^"]+"|\w+)\s+(\w+)\s*(?:\((\d+)(?:,\s*(\d+))?\))?\s*(NOT NULL)?', body):
+        name, data_type, size, scale, not_null = definition
+        if name.upper() == 'PRIMARY':
+            continue
+        name = name.strip('"') if name.startswith('"') else name.upper()
+        data_type = data_type.upper()
+        if data_type == 'VARCHAR':
+            columns[name] = ('TEXT', int(size), None, None, 'NO' if not_null else 'YES')
+        elif data_type == 'NUMBER':
+            columns[name] = ('NUMBER', None, int(size) if size else 38, int(scale or 0), 'NO' if not_null else 'YES')
+        else:
+            columns[name] = (data_type, None, None, None, 'NO' if not_null else 'YES')
+    return columns
+
+
+def _option(file_format: str, name: str, default: str = None) -> str:
+    # lists may nest one level, e.g. NULL_IF=() inside FILE_FORMAT=(...)
+    match = re.search(name + r"""\s*=\s*(?:'((?:[^']|'')*)'|\(((?:[^()]|\([^)]*\))*)\)|(\w+))""", file_format, re.IGNORECASE)
+    if not match:
+        return default
+    if match.group(2) is not None:
+        return match.group(2)
+    return match.group(1) if match.group(1) is not None else match.group(3)
+
+
+# the leading bytes of gzip, zstd and Parquet files, which PUT stages as they are
+compressed_magic: tuple = (b'\x1f\x8b', b'\x28\xb5\x2f\xfd', b'PAR1')
+
+
+def _open(file_path: str, compression: str):
+    # files PUT from a stream are staged as bytes
+    if isinstance(file_path, bytes):
+        file_path = io.BytesIO(file_path)
+    if not isinstance(file_path, str):
+        if (compression or '').upper() == 'ZSTD':
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(file_path, closefd=True)
+        return gzip.open(file_path, 'rb') if (compression or '').upper() == 'GZIP' else file_path
+    compression = (compression or 'AUTO').upper()
+    if compression == 'GZIP' or (compression == 'AUTO' and file_path.endswith('.gz')):
+        return gzip.open(file_path, 'rb')
+    if compression == 'ZSTD' or (compression == 'AUTO' and file_path.endswith('.zst')):
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return open(file_path, 'rb')
+
+
+def read_csv(file_path: str, file_format: str) -> list:
+    """
+    Decodes a staged CSV file the way COPY INTO would with the given FILE_FORMAT.
+    NULL_IF matches enclosed and unenclosed values alike, EMPTY_FIELD_AS_NULL only unenclosed ones.
+    ESCAPE_UNENCLOSED_FIELD, a backslash by default, takes the next character of an unenclosed value as it is.
+    :return: The rows as lists of strings, None for NULL.
+    """
+
+    delimiter = _option(file_format, 'FIELD_DELIMITER', ',')
+    enclosed_by = _option(file_format, 'FIELD_OPTIONALLY_ENCLOSED_BY', 'NONE')
+    skip_header = int(_option(file_format, 'SKIP_HEADER', '0'))
+    null_if = _option(file_format, 'NULL_IF', r"'\\N'")
+    null_if = set(value.replace("''", "'") for value in re.findall(r"'((?:[^']|'')*)'", null_if)) if "'" in null_if else {null_if} if null_if else set()
+    empty_as_null = (_option(file_format, 'EMPTY_FIELD_AS_NULL', 'TRUE') or '').upper() == 'TRUE'
+    quote = enclosed_by if enclosed_by and enclosed_by.upper() != 'NONE' else None
+    escape = _option(file_format, 'ESCAPE_UNENCLOSED_FIELD', '\\\\').replace('\\\\', '\\')
+    escape = escape if escape.upper() != 'NONE' else None
+
+    with _open(file_path, _option(file_format, 'COMPRESSION')) as stream:
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        rows = _split_records(text.read(), delimiter, quote, escape)
+    rows = rows[skip_header:]
+    return [[None if value in null_if or (value == '' and not quoted and empty_as_null) else value
+             for value, quoted in row] for row in rows]
+
+
+def _split_records(data: str, delimiter: str, quote: str, escape: str = None) -> list:
+    # a small state machine so quoted empty strings can be told apart from empty fields
+    rows: list = []
+    row: list = []
+    value: list = []
+    quoted: bool = False
+    in_quotes: bool = False
+    i: int = 0
+    length: int = len(data)
+    while i < length:
+        char = data[i]
+        if in_quotes:
+            if char == quote:
+                if i + 1 < length and data[i + 1] == quote:
+                    value.append(quote)
+                    i += 1
+                else:
+                    in_quotes = False
+            else:
+                value.append(char)
+        elif char == quote and not value:
+            in_quotes = quoted = True
+        elif char == escape and not quoted and i + 1 < length:
+            value.append(data[i + 1])
+            i += 1
+        elif char == delimiter:
+            row.append((''.join(value), quoted))
+            value, quoted = [], False
+        elif char in '\r\n':
+            if char == '\r' and i + 1 < length and data[i + 1] == '\n':
+                i += 1
+            row.append((''.join(value), quoted))
+            rows.append(row)
+            row, value, quoted = [], [], False
+        else:
+            value.append(char)
+        i += 1
+    if value or row or quoted:
+        row.append((''.join(value), quoted))
+        rows.append(row)
+    return rows
+
+
+def read_parquet(file_path: str) -> list:
+    """
+    Decodes a staged Parquet file.
+    :return: The rows as lists of typed values.
+    """
+
+    import pyarrow.parquet
+    table = pyarrow.parquet.read_table(io.BytesIO(file_path) if isinstance(file_path, bytes) else file_path)
+    return [list(row) for row in zip(*[column.to_pylist() for column in table.columns])]
+
+
+class SnowflakeCursor:
+
+    def __init__(self, con: object):
+        self.connection = con
+        self.sfqid: str = None
+        self.rowcount: int = -1
+        self._rows: list = []
+        self._params: list = []
+
+    def executemany(self, command: str, seqparams: list, **kwargs) -> object:
+        # array binding runs the statement once with every row of parameters
+        self._params = seqparams
+        try:
+            return self.execute(command, **kwargs)
+        finally:
+            self._params = []
+
+    def execute_async(self, command: str, params=None, **kwargs) -> dict:
+        self.sfqid = str(uuid.uuid4())
+        query = {'rows': None, 'error': None}
+
+        def run():
+            try:
+                query['rows'] = SnowflakeCursor(self.connection).execute(command, params, _sfqid=query['sfqid'], **kwargs)._rows
+            except Error as e:
+                query['error'] = e
+
+        query.update(sfqid=self.sfqid, thread=threading.Thread(target=run, name=f'async {self.sfqid[:8]}', daemon=True))
+        with account.lock:
+            account.async_queries[self.sfqid] = query
+        query['thread'].start()
+        return {'queryId': self.sfqid}
+
+    def get_results_from_sfqid(self, sfqid: str):
+        query = account.async_queries[sfqid]
+        query['thread'].join()
+        if query['error']:
+            raise query['error']
+        self.sfqid = sfqid
+        self._rows = query['rows']
+        self.rowcount = len(self._rows)
+
+    def execute(self, command: str, params=None, **kwargs) -> object:
+        self.sfqid = kwargs.pop('_sfqid', None) or str(uuid.uuid4())
+        self._file_stream = kwargs.get('file_stream')
+        start = time.perf_counter()
+        state = account
+        if state.latency:
+            time.sleep(state.latency)
+        sql = ' '.join(command.split())
+        kind = sql.split(' ', 1)[0].upper()
+        try:
+            if state.fail_on and sql.upper().startswith(state.fail_on.upper()) and not (state.fail_times and state.failures >= state.fail_times):
+                state.failures += 1
+                raise ProgrammingError(f'Simulated failure of {kind}', 100000, '42000', self.sfqid)
+            handler = getattr(self, '_' + kind.lower(), None)
+            self._rows = handler(sql) if handler else []
+            self.rowcount = len(self._rows)
+        finally:
+            with state.lock:
+                state.queries.append({'thread': threading.current_thread().name, 'kind': kind, 'sfqid': self.sfqid,
+                                      'seconds': time.perf_counter() - start, 'sql': sql[:200]})
+        return self
+
+    def fetchall(self) -> list:
+        return self._rows
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def close(self):
+        pass
+
+    def _put(self, sql: str) -> list:
+        match = re.match(r"PUT 'file://(.*?)' @%?(\S+)", sql, re.IGNORECASE)
+        file_path = match.group(1)
+        # the staged file is named after the path, its content is read from the stream if one is given
+        content = self._file_stream.read() if self._file_stream else file_path
+        size = len(content) if self._file_stream else os.path.getsize(file_path)
+        name = os.path.basename(file_path)
+        # AUTO_COMPRESS defaults to TRUE: files not recognised as compressed are gzipped and staged with .gz added
+        if (_option(sql, 'AUTO_COMPRESS', 'TRUE') or '').upper() == 'TRUE':
+            if self._file_stream:
+                head = content[:4]
+            else:
+                with open(file_path, 'rb') as file:
+                    head = file.read(4)
+            if not head.startswith(compressed_magic):
+                if not self._file_stream:
+                    with open(file_path, 'rb') as file:
+                        content = file.read()
+                content, name = gzip.compress(content), name + '.gz'
+        if account.put_mbps:
+            time.sleep(size / (account.put_mbps * 1024 * 1024))
+        with account.lock:
+            stage = account.stages.setdefault(_name(match.group(2)), {})
+            stage[name] = content
+        return [(os.path.basename(file_path), name, size, len(content) if isinstance(content, bytes) else size, 'NONE', 'NONE', 'UPLOADED', '')]
+
+    def _create(self, sql: str) -> list:
+        match = re.search(r'TABLE\s+("[^"]+"|[^\s(]+)', sql, re.IGNORECASE)
+        with account.lock:
+            account.tables[_name(match.group(1))] = []
+            account.row_counts[_name(match.group(1))] = 0
+            account.columns[_name(match.group(1))] = _columns(sql)
+            if re.search(r'\bTEMPORARY\s+TABLE', sql, re.IGNORECASE):
+                account.temporary.add(_name(match.group(1)))
+        return [('Table successfully created.',)]
+
+    def _insert(self, sql: str) -> list:
+        name = _name(re.match(r'INSERT INTO ("[^"]+"|[^\s(]+)', sql, re.IGNORECASE).group(1))
+        rows = [list(row) for row in self._params]
+        with account.lock:
+            if account.verify:
+                account.tables.setdefault(name, []).extend(rows)
+            account.row_counts[name] = account.row_counts.get(name, 0) + len(rows)
+        return [(len(rows),)]
+
+    def _truncate(self, sql: str) -> list:
+        name = _name(re.search(r'TABLE\s+(?:IF EXISTS\s+)?("[^"]+"|\S+)', sql, re.IGNORECASE).group(1))
+        with account.lock:
+            account.tables[name] = []
+            account.row_counts[name] = 0
+        return [('Statement executed successfully.',)]
+
+    def _copy(self, sql: str) -> list:
+        match = re.match(r'COPY INTO ("[^"]+"|\S+)', sql, re.IGNORECASE)
+        name = _name(match.group(1))
+        source = re.search(r'\sFROM\s+@%?("[^"]+"|[^\s(]+)', sql, re.IGNORECASE)
+        file_format = _option(sql, 'FILE_FORMAT', '') or ''
+        with account.lock:
+            stage = account.stages.get(_name(source.group(1)) if source else name, {})
+            files = list(stage.items())
+        results = []
+        for file_name, file_path in files:
+            if not account.verify:
+                results.append((file_name, 'LOADED', None, None, 1, 0, None, None, None, None))
+                continue
+            rows = read_parquet(file_path) if _option(file_format, 'TYPE', 'CSV').upper() == 'PARQUET' else read_csv(file_path, file_format)
+            with account.lock:
+                account.tables.setdefault(name, []).extend(rows)
+                account.row_counts[name] = account.row_counts.get(name, 0) + len(rows)
+            results.append((file_name, 'LOADED', len(rows), len(rows), 1, 0, None, None, None, None))
+        if re.search(r'PURGE\s*=\s*TRUE', sql, re.IGNORECASE):
+            with account.lock:
+                for file_name, file_path in files:
+                    stage.pop(file_name, None)
+        return results
+
+    def _select(self, sql: str) -> list:
+        if 'INFORMATION_SCHEMA.COLUMNS' in sql.upper():
+            table = re.search(r"table_name = '([^']*)'", sql, re.IGNORECASE).group(1)
+            with account.lock:
+                columns = account.columns.get(table.lower(), account.columns.get(f'"{table}"', {}))
+            return [(name,) + column for name, column in columns.items()]
+        if 'QUERY_HISTORY' not in sql.upper():
+            return []
+        # the client side time stands in for the server side timings
+        query_ids = set(re.findall(r"'([0-9a-f-]{36})'", sql))
+        with account.lock:
+            return [(query['sfqid'], int(query['seconds'] * 1000), 0, 0, int(query['seconds'] * 1000))
+                    for query in account.queries if query['sfqid'] in query_ids]
+
+    def _show(self, sql: str) -> list:
+        match = re.match(r"SHOW WAREHOUSES LIKE '([^']*)'", sql, re.IGNORECASE)
+        if not match:
+            return []
+        return [(match.group(1).upper(), 'STARTED', 'STANDARD', account.warehouse_size)]
+
+    def _alter(self, sql: str) -> list:
+        match = re.search(r"WAREHOUSE_SIZE\s*=\s*'([^']*)'", sql, re.IGNORECASE)
+        if match:
+            with account.lock:
+                # reported back the way SHOW WAREHOUSES spells it
+                account.warehouse_size = match.group(1).title()
+                account.warehouse_sizes.append(account.warehouse_size)
+        return [('Statement executed successfully.',)]
+
+    def _execute(self, sql: str) -> list:
+        # the statements of an EXECUTE IMMEDIATE block, split on the semicolons outside quotes
+        body = re.search(r'\$\$\s*BEGIN\s(.*)\sEND;?\s*\$\$', sql, re.IGNORECASE | re.DOTALL).group(1)
+        for statement in re.split(r";(?=(?:[^']*'[^']*')*[^']*$)", body):
+            if statement.strip():
+                SnowflakeCursor(self.connection).execute(statement)
+        return [('anonymous block',)]
+
+    def _merge(self, sql: str) -> list:
+        match = re.match(r'MERGE INTO ("[^"]+"|\S+).*?USING ("[^"]+"|\w+)', sql, re.IGNORECASE)
+        with account.lock:
+            source = account.row_counts.get(_name(match.group(2)), 0)
+            account.row_counts[_name(match.group(1))] = account.row_counts.get(_name(match.group(1)), 0) + source
+        return [(0, source)]
+
+
+class SnowflakeConnection:
+
+    def __init__(self, **kwargs):
+        self.kwargs: dict = kwargs
+        self._closed: bool = False
+        with account.lock:
+            account.connections += 1
+        logging.info(f"Fake connection opened for {kwargs.get('user')}@{kwargs.get('account')}")
+
+    def cursor(self) -> SnowflakeCursor:
+        return SnowflakeCursor(self)
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def get_query_status(self, sfqid: str) -> QueryStatus:
+        query = account.async_queries.get(sfqid)
+        if query is None:
+            return QueryStatus.NO_DATA
+        if query['thread'].is_alive():
+            return QueryStatus.RUNNING
+        return QueryStatus.FAILED_WITH_ERROR if query['error'] else QueryStatus.SUCCESS
+
+    def get_query_status_throw_if_error(self, sfqid: str) -> QueryStatus:
+        status = self.get_query_status(sfqid)
+        if status == QueryStatus.FAILED_WITH_ERROR:
+            raise account.async_queries[sfqid]['error']
+        return status
+
+    @staticmethod
+    def is_still_running(status: QueryStatus) -> bool:
+        return status in (QueryStatus.RUNNING, QueryStatus.NO_DATA)
+
+
+# the tool annotates with snowflake.connector.connection
+connection = SnowflakeConnection
+
+
+def connect(**kwargs) -> SnowflakeConnection:
+    return SnowflakeConnection(**kwargs)